@@ -1,13 +1,14 @@
 import os
+import math
+import collections
+import numpy as np
 from PIL import Image
 # set max image pixel of PIL
 Image.MAX_IMAGE_PIXELS = None
 
-import datatypes as dt
-import utilities as utils
 import generateBaseImages as baseIm
+import segmentStore
 from removeUnderground import removeUnderground
-import pandas as pd
 
 import warnings
 from shapely.errors import ShapelyDeprecationWarning
@@ -23,6 +24,9 @@ warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning)
 # Sets max image sizes. If image is too big, rescaling will happen
 maxImageWidth=65000
 maxImageHeight=2000
+# number of frames of the finest resolution that are rendered at once. Only the zoom
+# segments of this part of the trip are kept in memory
+assembleWindowFrames=20000
 
 # Crops an image at a certain depth. This is important since sometimes the auto zoom of the
 # Fishfinder zooms to for example 80 m for one frame but the actual depth is just 10 m.
@@ -41,54 +45,80 @@ def cropImageAtDept(depth,image,maxDepth):
     return imagecrop
 
 # Generates properties necessary to stitch the images of different zoom levels together
-# propertyList[in] list containing the properties of each base image
+# They are read from the summary in the index of the store, the segments are not touched
+# pathToData[in] path of the channel
 # returns image assembly properties
-def generateAssembleProperties(propertyList):
-    #find biggest depth
-   assembleProp=dt.assembleProperties()
-   for prop in propertyList:
-       assembleProp.maxDept=max(assembleProp.maxDept,prop.maxRange)
-       assembleProp.minDept=min(assembleProp.minDept,prop.maxRange)
-       assembleProp.finestRes=min(assembleProp.finestRes,prop.maxRange/prop.pixelY)
-       assembleProp.framesTotal=assembleProp.framesTotal+prop.frames
+def generateAssembleProperties(pathToData):
+   assembleProp=segmentStore.readSummary(segmentStore.storePath(pathToData))
    #print("max dept "+str(assembleProp.maxDept))
    #print("finest res "+str(assembleProp.finestRes))
    #print("framesTotal "+str(assembleProp.framesTotal))
-    # create final image
-   assembleProp.yRes=int(assembleProp.maxDept/assembleProp.finestRes)
    return assembleProp
 
-# Function to assemble single images with fixed depth to one big image
-# new_im[in,out]    assembled image to be generated from the function
-# propertyList[in]  list with properties of all sub images
+# Function to assemble single images with fixed depth to one image
+# Every zoom segment is scaled straight to the resolution of the output, so the image at the
+# finest resolution over the full length of the trip is never created.
+# propertyList[in]  list with properties of the sub images, all segments or only those overlapping the window
+# imageList[in]     rendered images of the zoom segments (numpy arrays, upside down)
 # assembleProp[in]  information to assemble single images
 # side[in]          is it a side scan? Otherwise it is a Downscan or primary     
-# pathForImages[in] path to where the singe images are stored
-def assembleScan(new_im,propertyList,assembleProp,side:bool,pathForImages):
-    new_width, new_height = new_im.size
-    new_half_height=new_height/2
-    currentFrame=0
-    for oneProp in propertyList:
-        #print("maxRange "+str(oneProp.maxRange))
-        #print("pixy "+str(oneProp.pixelY))
-        imgPath=pathForImages+"/fig_"+oneProp.name+".png"
-        img=Image.open(imgPath)
-
-        #img=img.transpose(Image.FLIP_TOP_BOTTOM)
-        img=img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-        
+# sourceSize[in]    width and height of the part of the finest resolution image that is shown (crop)
+# outSize[in]       width and height of the complete output
+# window[in]        first and last (exclusive) column of the output to generate, None for all columns
+# target[in,out]    image of the window the segments are pasted into, None for a new image
+# return: assembled image with the columns of the window
+def assembleScan(propertyList,imageList,assembleProp,side:bool,sourceSize,outSize,window=None,target=None):
+    if(window is None):
+        window=(0,outSize[0])
+    new_im=target
+    if(new_im is None):
+        new_im=Image.new('RGB',(window[1]-window[0],outSize[1]))
+    scaleX=outSize[0]/sourceSize[0]
+    scaleY=outSize[1]/sourceSize[1]
+    new_half_height=assembleProp.yRes/2
+    for oneProp, image in zip(propertyList,imageList):
+        # position of the segment in the image with the finest resolution
+        frameStart=oneProp.startIndex
+        currentFrame=frameStart+oneProp.frames
         resizeFactor=oneProp.maxRange/assembleProp.minDept
-        #print("resizefaktor "+str(resizeFactor))
-        newsize=(oneProp.frames,int(oneProp.pixelY*resizeFactor))
-        #img.thumbnail(size)
-        img=img.resize(newsize)
-        width, height = img.size
-        height_half=height/2
-        #print("current frame "+str(currentFrame))
-        yShift=int(new_half_height-height_half)*side
-        new_im.paste(img, (currentFrame,yShift))
-        currentFrame=currentFrame+oneProp.frames
+        height=int(oneProp.pixelY*resizeFactor)
+        yShift=int(new_half_height-height/2)*side
 
+        # visible part of the segment
+        sourceLeft=max(frameStart,window[0]/scaleX)
+        sourceRight=min(currentFrame,sourceSize[0],window[1]/scaleX)
+        sourceTop=max(yShift,0)
+        sourceBottom=min(yShift+height,sourceSize[1])
+        if(sourceRight<=sourceLeft or sourceBottom<=sourceTop):
+            continue
+        # position in the output, rounded the same way for neighbouring segments so there are no gaps
+        left=int(round(sourceLeft*scaleX))
+        right=int(round(sourceRight*scaleX))
+        top=int(round(sourceTop*scaleY))
+        bottom=int(round(sourceBottom*scaleY))
+        if(right<=left or bottom<=top):
+            continue
+        # part of the rendered segment that is visible
+        rowsPerPixel=oneProp.pixelY/height
+        box=(sourceLeft-frameStart,(sourceTop-yShift)*rowsPerPixel,
+             sourceRight-frameStart,(sourceBottom-yShift)*rowsPerPixel)
+        img=Image.fromarray(np.ascontiguousarray(image[::-1]))
+        img=img.resize((right-left,bottom-top),Image.BICUBIC,box=box)
+        new_im.paste(img,(left-window[0],top))
+    return new_im
+
+# Returns the part of the image with the finest resolution that is shown, cut off at a depth
+# assembleProp[in,out] information to assemble single images, maxDept is set to the cut off depth
+# cutOffDept[in]       maximum depth in meters to cut the image off
+# return: width and height
+def getSourceSize(assembleProp,cutOffDept):
+    sourceSize=(assembleProp.framesTotal,assembleProp.yRes)
+    if(assembleProp.maxDept>cutOffDept):
+        # same area as cropImageAtDept
+        deptPerPixel=assembleProp.maxDept/assembleProp.yRes
+        sourceSize=(max(assembleProp.framesTotal-5,1),max(int(cutOffDept/deptPerPixel),1))
+        assembleProp.maxDept=cutOffDept
+    return sourceSize
 
 # pathToData[in]  path to image csv files
 # side[in]        is it a side scan? Otherwise its a Downscan or primary 
@@ -111,35 +141,263 @@ def printLegendAndSave(img, assembleProp,pathToData,side:bool, legend,filename="
     LegendLabel="L" if legend == True else "NL"
     img.save(savepath+"/" + filename + LegendLabel + ".jpg", "JPEG" , quality = 90)
 
-# Process one view of the sonar with all its zoom levels. (like a full Downscan or full Sidescan)    
-# The final image will be saved one folder above the path to data
-# pathToData[in]  path to image csv files
-# pathToImg[in]   path to where the singe zoom level images should be stored
-# side[in]        is it a side scan? Otherwise its a Downscan or primary 
+# Renders all zoom segments of one channel
+# pathToData[in]  path of the channel, the zoom segments are read from its store (see segmentStore)
+# pathToImg[in]   path to where the singe zoom level images are stored, if settings.saveImages is set
 # cmap[in]        colour map
-# cutOffDept[in]  maximum depth in meters to cut the image off
-def processOneView(pathToData,pathToImg,side:bool,cmap:str,cutOffDept):
-    
-    allFiles=utils.sorted_alphanumeric(os.listdir(pathToData))
+# settings[in]    renderSettings, if None the default settings are used
+# segmentIndices[in] numbers of the zoom segments to render, None for all
+# executor[in]    process pool to render in (see generateBaseImages.createExecutor), None for a pool of its own
+# return: list with the properties and list with the images of the zoom segments
+def renderView(pathToData,pathToImg,cmap:str,settings=None,segmentIndices=None,executor=None):
+    segments=segmentStore.readStore(segmentStore.storePath(pathToData))
+    if(segmentIndices is not None):
+        segments=[segments[index] for index in segmentIndices]
+    cachePath=os.path.dirname(pathToData)+"/renderCache"
+    return baseIm.generateImagesAndPropertyList(segments,pathToImg,cmap,settings,cachePath,executor)
 
-    #create images
-    propertyList=baseIm.generateImagesAndPropertyList(allFiles,pathToData,pathToImg,cmap)
-        
-    # get assemble properties
-    assembleProp=generateAssembleProperties(propertyList)
+# Processing plan of one trip. Several views need the same channel rendered with the
+# same colour map (for example the down scan for the down scan image and the combined view,
+# the side scan for the side scan image and the mosaic). Views that are rendered together
+# (see renderViews) share the batches of one rendering, so they cost one rendering and the
+# memory of one batch. If a channel is still needed after that (the mosaic needs all segments
+# at once, see getView), the complete rendered channel is kept in the plan and released after
+# its last use.
+# All views of the trip render in the same process pool, close releases it.
+class viewPlan:
+    def __init__(self,settings=None):
+        self.settings=settings
+        # number of times each (channel, colour map) will still be requested
+        self.remainingUses=collections.Counter()
+        # rendered (properties, images) per (channel, colour map)
+        self.rendered={}
+        # process pool of the trip, None if the segments are rendered in this process
+        self.executor=baseIm.createExecutor(settings)
 
-    # generate empty image
-    new_im = Image.new('RGB', (assembleProp.framesTotal,assembleProp.yRes))
+    # stops the worker processes of the plan and releases the kept channels
+    def close(self):
+        if(self.executor is not None):
+            self.executor.shutdown()
+            self.executor=None
+        self.rendered={}
 
-    # assemble image
-    assembleScan(new_im,propertyList,assembleProp,side,pathToImg)
+    # registers that a channel will be needed with a colour map
+    # pathToData[in] path of the channel
+    # cmap[in]       colour map
+    def require(self,pathToData,cmap):
+        self.remainingUses[(pathToData,cmap)]+=1
 
-    if(assembleProp.maxDept>cutOffDept):
-        new_im=cropImageAtDept(cutOffDept,new_im,assembleProp.maxDept)
-        assembleProp.maxDept=cutOffDept
+    # returns the rendered zoom segments of a channel, see renderView
+    # pathToData[in]     path of the channel
+    # pathToImg[in]      path to where the singe zoom level images are stored, if settings.saveImages is set
+    # cmap[in]           colour map
+    # segmentIndices[in] numbers of the zoom segments that are needed, None for all
+    def getView(self,pathToData,pathToImg,cmap,segmentIndices=None):
+        key=(pathToData,cmap)
+        self.remainingUses[key]-=1
+        if(key in self.rendered):
+            view=self.rendered[key]
+        elif(segmentIndices is not None and self.remainingUses[key]<=0):
+            # nobody else needs this channel, render only the requested segments
+            return renderView(pathToData,pathToImg,cmap,self.settings,segmentIndices,self.executor)
+        else:
+            view=renderView(pathToData,pathToImg,cmap,self.settings,executor=self.executor)
+        if(self.remainingUses[key]>0):
+            self.rendered[key]=view
+        else:
+            self.rendered.pop(key,None)
+        if(segmentIndices is not None):
+            view=([view[0][index] for index in segmentIndices],[view[1][index] for index in segmentIndices])
+        return view
+
+    # takes a channel for several views that are rendered together
+    # pathToData[in] path of the channel
+    # cmap[in]       colour map
+    # uses[in]       number of views
+    # return: rendered (properties, images) if the plan holds the channel, otherwise None.
+    #         True if the channel is needed again later and has to be kept (see keep)
+    def take(self,pathToData,cmap,uses):
+        key=(pathToData,cmap)
+        self.remainingUses[key]-=uses
+        if(self.remainingUses[key]>0):
+            return self.rendered.get(key), True
+        return self.rendered.pop(key,None), False
+
+    # keeps a rendered channel for its later uses
+    # pathToData[in] path of the channel
+    # cmap[in]       colour map
+    # view[in]       rendered (properties, images) of all zoom segments
+    def keep(self,pathToData,cmap,view):
+        self.rendered[(pathToData,cmap)]=view
+
+# View of a channel that is assembled directly at its output size, scaled down to
+# maxImageWidth and maxImageHeight (see processOneView)
+class scaledView:
+    # pathToData[in] path of the channel, the zoom segments are read from its store (see segmentStore)
+    # pathToImg[in]  path to where the singe zoom level images are stored, if settings.saveImages is set
+    # side[in]       is it a side scan? Otherwise its a Downscan or primary
+    # cmap[in]       colour map
+    # cutOffDept[in] maximum depth in meters to cut the image off
+    # filename[in]   the image is saved with a legend under this name when it is finished, "" = not saved
+    def __init__(self,pathToData,pathToImg,side:bool,cmap:str,cutOffDept,filename=""):
+        self.pathToData=pathToData
+        self.pathToImg=pathToImg
+        self.side=side
+        self.cmap=cmap
+        self.filename=filename
+        self.assembleProp=generateAssembleProperties(pathToData)
+        self.sourceSize=getSourceSize(self.assembleProp,cutOffDept)
+        self.size=min(self.assembleProp.framesTotal,maxImageWidth),min(self.assembleProp.yRes,maxImageHeight)
+        self.image=Image.new('RGB',self.size)
+
+    # pastes rendered zoom segments into the view
+    def add(self,propertyList,imageList):
+        assembleScan(propertyList,imageList,self.assembleProp,self.side,self.sourceSize,self.size,target=self.image)
+
+    # called after the last zoom segment
+    def finish(self):
+        if(self.filename!=""):
+            printLegendAndSave(self.image,self.assembleProp,self.pathToData,self.side,legend=True,filename=self.filename)
+
+# View of a channel that is saved in horizontal tiles with one pixel per frame (see processOneViewTiled).
+# A tile is saved as soon as all zoom segments overlapping it are rendered, then the segments
+# that do not reach the next tile are released
+class tiledView:
+    # pathToData[in] path of the channel, the zoom segments are read from its store (see segmentStore)
+    # pathToImg[in]  path to where the singe zoom level images are stored, if settings.saveImages is set
+    # side[in]       is it a side scan? Otherwise its a Downscan or primary
+    # cmap[in]       colour map
+    # cutOffDept[in] maximum depth in meters to cut the image off
+    # tileWidth[in]  width of one tile in pixels
+    # filename[in]   part of the name of the tiles to save
+    def __init__(self,pathToData,pathToImg,side:bool,cmap:str,cutOffDept,tileWidth,filename):
+        self.pathToData=pathToData
+        self.pathToImg=pathToImg
+        self.side=side
+        self.cmap=cmap
+        self.filename=filename
+        self.assembleProp=generateAssembleProperties(pathToData)
+        self.sourceSize=getSourceSize(self.assembleProp,cutOffDept)
+        self.size=self.sourceSize[0],min(self.assembleProp.yRes,maxImageHeight)
+        numberTiles=math.ceil(self.size[0]/tileWidth)
+        self.windows=[(tile*tileWidth,min((tile+1)*tileWidth,self.size[0])) for tile in range(numberTiles)]
+        self.scaleX=self.size[0]/self.sourceSize[0]
+        self.nextTile=0
+        # rendered zoom segments that reach tiles which are not saved yet
+        self.propertyList=[]
+        self.imageList=[]
+
+    # adds rendered zoom segments and saves the tiles that are complete
+    def add(self,propertyList,imageList):
+        if(len(propertyList)==0):
+            return
+        self.propertyList+=propertyList
+        self.imageList+=imageList
+        # the segments arrive in order, so all frames before the end of the last one are rendered
+        lastProp=propertyList[-1]
+        self._saveTiles(lastProp.startIndex+lastProp.frames)
 
-    size=min(assembleProp.framesTotal,maxImageWidth),min(assembleProp.yRes,maxImageHeight)
-    resizedImg=new_im.resize(size)
+    # called after the last zoom segment, saves the remaining tiles
+    def finish(self):
+        self._saveTiles(math.inf)
+
+    # saves the tiles that end before a frame
+    # renderedFrames[in] number of frames that are rendered
+    def _saveTiles(self,renderedFrames):
+        while(self.nextTile<len(self.windows) and self.windows[self.nextTile][1]/self.scaleX<=renderedFrames):
+            window=self.windows[self.nextTile]
+            img=assembleScan(self.propertyList,self.imageList,self.assembleProp,self.side,self.sourceSize,self.size,window)
+            printLegendAndSave(img,self.assembleProp,self.pathToData,self.side,legend=True,filename=self.filename+"_"+str(self.nextTile))
+            self.nextTile+=1
+            print("saved tile "+str(self.nextTile)+" out of "+str(len(self.windows)))
+            if(self.nextTile<len(self.windows)):
+                first=self.windows[self.nextTile][0]/self.scaleX
+                keep=[index for index,oneProp in enumerate(self.propertyList) if oneProp.startIndex+oneProp.frames>first]
+                self.propertyList=[self.propertyList[index] for index in keep]
+                self.imageList=[self.imageList[index] for index in keep]
+
+# Creates the view of a channel that is saved with a legend when it is finished
+# pathToData[in] path of the channel, the zoom segments are read from its store (see segmentStore)
+# pathToImg[in]  path to where the singe zoom level images are stored, if settings.saveImages is set
+# side[in]       is it a side scan? Otherwise its a Downscan or primary
+# cmap[in]       colour map
+# cutOffDept[in] maximum depth in meters to cut the image off
+# filename[in]   name of the image to save
+# settings[in]   renderSettings, with settings.tileWidth>0 the view is saved in tiles
+# return: tiledView or scaledView
+def savedView(pathToData,pathToImg,side:bool,cmap:str,cutOffDept,filename,settings):
+    if(settings.tileWidth>0):
+        return tiledView(pathToData,pathToImg,side,cmap,cutOffDept,settings.tileWidth,filename)
+    return scaledView(pathToData,pathToImg,side,cmap,cutOffDept,filename)
+
+# Renders the zoom segments of a channel in batches of about assembleWindowFrames frames
+# pathToData[in] path of the channel, the zoom segments are read from its store (see segmentStore)
+# pathToImg[in]  path to where the singe zoom level images are stored, if settings.saveImages is set
+# cmap[in]       colour map
+# settings[in]   renderSettings
+# executor[in]   process pool to render in, None for a pool per batch
+# return: generator of the properties and the images of one batch
+def renderBatches(pathToData,pathToImg,cmap,settings,executor=None):
+    propertyList=segmentStore.readProperties(segmentStore.storePath(pathToData))
+    batch=[]
+    frames=0
+    for index,oneProp in enumerate(propertyList):
+        batch.append(index)
+        frames+=oneProp.frames
+        if(frames>=assembleWindowFrames or index==len(propertyList)-1):
+            yield renderView(pathToData,pathToImg,cmap,settings,batch,executor)
+            batch=[]
+            frames=0
+
+# Renders several views. Each channel is rendered only once per colour map: the batches of
+# renderBatches are passed to all views of that channel and colour map, so only the zoom
+# segments of one batch are in memory. A channel the plan already holds is not rendered again,
+# a channel the plan needs again later is kept there.
+# views[in]    list of scaledView and tiledView
+# settings[in] renderSettings, if None the default settings are used
+# plan[in]     viewPlan of the trip or None
+def renderViews(views,settings=None,plan=None):
+    # all channels are rendered in the pool of the plan or in one pool for these views
+    executor=plan.executor if plan is not None else baseIm.createExecutor(settings)
+    groups={}
+    for view in views:
+        groups.setdefault((view.pathToData,view.cmap),[]).append(view)
+    for (pathToData,cmap), group in groups.items():
+        print("render "+os.path.basename(pathToData)+" with "+cmap+" for "+str(len(group))+" views")
+        rendered, keep=None, False
+        if(plan is not None):
+            rendered, keep=plan.take(pathToData,cmap,len(group))
+        if(rendered is None):
+            batches=renderBatches(pathToData,group[0].pathToImg,cmap,settings,executor)
+        else:
+            batches=[rendered]
+        kept=([],[])
+        for propertyList, imageList in batches:
+            for view in group:
+                view.add(propertyList,imageList)
+            if(keep and rendered is None):
+                kept[0].extend(propertyList)
+                kept[1].extend(imageList)
+        if(keep and rendered is None):
+            plan.keep(pathToData,cmap,kept)
+        for view in group:
+            view.finish()
+    if(plan is None and executor is not None):
+        executor.shutdown()
+
+# Process one view of the sonar with all its zoom levels. (like a full Downscan or full Sidescan)    
+# The final image will be saved one folder above the path to data
+# pathToData[in]  path of the channel, the zoom segments are read from its store (see segmentStore)
+# pathToImg[in]   path to where the singe zoom level images are stored, if settings.saveImages is set
+# side[in]        is it a side scan? Otherwise its a Downscan or primary 
+# cmap[in]        colour map
+# cutOffDept[in]  maximum depth in meters to cut the image off
+# settings[in]    renderSettings, if None the default settings are used
+# plan[in]        viewPlan of the trip, if given the rendered segments are shared with other views
+def processOneView(pathToData,pathToImg,side:bool,cmap:str,cutOffDept,settings=None,plan=None):
+    view=scaledView(pathToData,pathToImg,side,cmap,cutOffDept)
+    renderViews([view],settings,plan)
+    resizedImg, assembleProp=view.image, view.assembleProp
 
     return resizedImg, assembleProp
 
@@ -157,24 +415,27 @@ def processOneView(pathToData,pathToImg,side:bool,cmap:str,cutOffDept):
     resizedImg.save(savepath+"/"+typeOfImg+"finalIamge"+LegendLabel+".jpg", "JPEG",quality=90)
     # resizedImg.save(savepath+"/"+typeOfImg+"finalIamge.png", "PNG")
 
+# Process one view like processOneView, but the image is saved in horizontal tiles with one
+# pixel per frame instead of one image that is scaled down to maxImageWidth.
+# Only the zoom segments of one batch and those reaching the next tile are in memory at a time (see tiledView).
+# The tiles will be saved one folder above the path to data as <filename>_<tile number>
+# pathToData[in]  path of the channel, the zoom segments are read from its store (see segmentStore)
+# pathToImg[in]   path to where the singe zoom level images are stored, if settings.saveImages is set
+# side[in]        is it a side scan? Otherwise its a Downscan or primary 
+# cmap[in]        colour map
+# cutOffDept[in]  maximum depth in meters to cut the image off
+# tileWidth[in]   width of one tile in pixels
+# filename[in]    part of the name of the tiles to save
+# settings[in]    renderSettings, if None the default settings are used
+# plan[in]        viewPlan of the trip, if given the rendered segments are shared with other views
+def processOneViewTiled(pathToData,pathToImg,side:bool,cmap:str,cutOffDept,tileWidth,filename,settings=None,plan=None):
+    renderViews([tiledView(pathToData,pathToImg,side,cmap,cutOffDept,tileWidth,filename)],settings,plan)
+
+# Returns the smaller of the maximum depths of the down scan and the primary scan
+# Only the headers of the stores are read
+# pathDown[in]  path of the down scan channel
+# pathPrime[in] path of the primary scan channel
 def getSmallerDepth(pathDown,pathPrime):
-    
-    maxDeptDown=0
-    allFiles=utils.sorted_alphanumeric(os.listdir(pathDown))
-    for file in allFiles:
-        properties=dt.dataProperties()
-        data = pd.read_csv(pathDown+"/"+file,header=0, dtype=str)
-        baseIm.fillProperties(data,properties)
-        maxDeptDown=max(maxDeptDown,properties.maxRange)
-    
-    maxDeptPrime=0
-    allFiles=utils.sorted_alphanumeric(os.listdir(pathPrime))
-    for file in allFiles:
-        properties=dt.dataProperties()
-        data = pd.read_csv(pathPrime+"/"+file,header=0, dtype=str)
-        baseIm.fillProperties(data,properties)
-        maxDeptPrime=max(maxDeptPrime,properties.maxRange)
-        
-    
+    maxDeptDown=segmentStore.readSummary(segmentStore.storePath(pathDown)).maxDept
+    maxDeptPrime=segmentStore.readSummary(segmentStore.storePath(pathPrime)).maxDept
     return min(maxDeptDown,maxDeptPrime)
-    
@@ -18,6 +18,65 @@ class dataProperties:
         self.frames=0
         self.name=""
         self.startIndex=0
+
+# One zoom segment together with its intensity values
+# The data is a numpy array with pixelY rows and one column per frame.
+# If data is None the values are read on demand with the loader function
+class segmentData:
+    def __init__(self):
+        self.properties=dataProperties()
+        self.data=None
+        self.loader=None
+        # store the segment was read from and its position in there (see segmentStore)
+        self.storePath=""
+        self.index=0
+
+    # returns the intensity values of the segment
+    def getData(self):
+        if(self.data is None):
+            return self.loader()
+        return self.data
+        
+# Settings how the zoom segments are rendered to images
+class renderSettings:
+    def __init__(self):
+        # "raster" maps every value to exactly one pixel with a colour lookup table
+        # "contour" uses matplotlib contourf (slow)
+        self.mode="raster"
+        # sigma of a gaussian smoothing in pixels before the colour mapping, 0 = no smoothing
+        self.smoothing=0
+        # number of processes rendering the segments in parallel
+        self.workers=1
+        # save the images of the single zoom segments as png files (fig_<nr>.png) for debugging
+        self.saveImages=False
+        # maximum size of the render cache of the contour rendering per trip folder in MB, 0 = no cache
+        self.cacheSizeMB=0
+        # width in pixels of the tiles the views are saved in at full length, 0 = one image scaled to the maximum width
+        self.tileWidth=0
+        
+# Settings of the ai based image segmentation
+class segmentationSettings:
+    def __init__(self):
+        # number of tiles the network predicts at once
+        self.batchSize=8
+        # overlap of neighbouring tiles in pixels, the predictions are blended in the overlap
+        self.overlap=100
+        # save the probability of every class as image (for example ground.jpg) for debugging
+        self.debugImages=False
+        # number of rows of the strips the segmented and cleaned images are computed in
+        self.stripHeight=256
+        # folder of the model (seg3.h5)
+        self.modelPath="models"
+        # runtime of the model: "keras" (needs tensorflow), "onnx" or "tflite" for the exported model
+        self.backend="keras"
+        # number of threads for the prediction, 0 = default of the runtime
+        self.threads=0
+        # run the segmentation in a separate worker process that keeps the model loaded for the next trips and runs
+        self.useWorker=False
+        # port on localhost the worker listens on
+        self.workerPort=6008
+        # the worker stops after this many minutes without a request
+        self.workerIdleMinutes=30
         
 # properties to assemble several zoom segments 
 # to one image
@@ -47,8 +106,10 @@ class processingSelection:
         self.track=False
         # correct the coordinates
         self.coordCorr=False
-        # call R
+        # do the preprocessing of the sl2 files
         self.callR=False
+        # which reader to use for the preprocessing: "python" or "R"
+        self.reader="python"
         # process combined Down and Prime image
         self.combinedDownPrime=False
         
@@ -62,8 +123,15 @@ class processingSelection:
         
         self.basepath=""
         self.files=[]
+        # names of the sl2 files as given in the config
+        self.sl2Files=[]
 
         self.segmentation=False
+        # settings of the segmentation
+        self.ai=segmentationSettings()
+
+        # how the zoom segments are rendered
+        self.render=renderSettings()
         
 # Class to hold meta information to the image
 class MetaInformation:
@@ -87,6 +155,20 @@ class Geocord:
         self.east=east
         self.west=west
         self.pixelSizeMeters=0.5
+        # "splat" draws every ping into the mosaic and closes holes afterwards
+        # "gather" searches the ping for every pixel of the mosaic, there are no holes
+        self.mosaicMode="splat"
+        # number of passes of closing holes in the splat mosaic
+        self.closeHolesPasses=1
+        # merge the mosaics of all files into one (MergedMosaic.tif in the basepath)
+        self.mergeTrips=False
+        # which file is used where files overlap in the merged mosaic
+        # "last": the file added last, "max": the brightest colour, "nadir": the file with the track closest to the pixel
+        self.mergeRule="last"
+        # export the mosaic as web mercator tiles: "none", "xyz" (folder z/x/y.png) or "mbtiles"
+        self.webTiles="none"
+        # highest zoom level of the web tiles, 0 = the level that fits pixelSizeMeters
+        self.webMaxZoom=0
 
 
 # reads the config from a config file
@@ -107,13 +189,21 @@ def readConfig(pathToConfig):
     selection.combinedDownPrime = bool(config['views']['combinedDownAndPrimeView']=="True")
     
     selection.callR = bool(config['preprocessing']['callIt']=="True")
+    selection.reader = config['preprocessing'].get('reader',"python")
 
     selection.coordCorr = bool(config['settings']['coordinateCorrection']=="True")
     selection.cmapPrime = config['settings']['colourMap']
     selection.cutOffDept=int(config['settings']['maxDepth'])
+    selection.render.mode = config['settings'].get('renderMode',"raster")
+    selection.render.smoothing = float(config['settings'].get('smoothing',"0"))
+    selection.render.workers = int(config['settings'].get('workers',"1"))
+    selection.render.saveImages = bool(config['settings'].get('saveSegmentImages',"False")=="True")
+    selection.render.cacheSizeMB = float(config['settings'].get('renderCacheSizeMB',"0"))
+    selection.render.tileWidth = int(config['settings'].get('tileWidth',"0"))
 
     selection.basepath = config['files']['basepath']
     selection.files=config['files']['files'].replace('.','').split(',')
+    selection.sl2Files=config['files']['files'].split(',')
 
     north = float(config['settingsGeoreference']['north'])
     south = float(config['settingsGeoreference']['south'])
@@ -121,6 +211,22 @@ def readConfig(pathToConfig):
     west = float(config['settingsGeoreference']['west'])
     geo=Geocord(north,south,east,west)
     geo.pixelSizeMeters = float(config['settingsGeoreference']['pixelSizeMeters'])
+    geo.mosaicMode = config['settingsGeoreference'].get('mosaicMode',"splat")
+    geo.closeHolesPasses = int(config['settingsGeoreference'].get('closeHolesPasses',"1"))
+    geo.mergeTrips = config['settingsGeoreference'].get('mergeTrips',"False")=="True"
+    geo.mergeRule = config['settingsGeoreference'].get('mergeRule',"last")
+    geo.webTiles = config['settingsGeoreference'].get('webTiles',"none")
+    geo.webMaxZoom = int(config['settingsGeoreference'].get('webMaxZoom',"0"))
 
     selection.segmentation = bool(config['ai']['segmentation']=="True")
+    selection.ai.batchSize = int(config['ai'].get('batchSize',"8"))
+    selection.ai.overlap = int(config['ai'].get('overlap',"100"))
+    selection.ai.debugImages = bool(config['ai'].get('debugImages',"False")=="True")
+    selection.ai.stripHeight = int(config['ai'].get('stripHeight',"256"))
+    selection.ai.modelPath = config['ai'].get('modelPath',"models")
+    selection.ai.backend = config['ai'].get('backend',"keras")
+    selection.ai.threads = int(config['ai'].get('threads',"0"))
+    selection.ai.useWorker = bool(config['ai'].get('useWorker',"False")=="True")
+    selection.ai.workerPort = int(config['ai'].get('workerPort',"6008"))
+    selection.ai.workerIdleMinutes = float(config['ai'].get('workerIdleMinutes',"30"))
     return selection, geo
\ No newline at end of file
@@ -1,166 +1,240 @@
 import matplotlib.pyplot as plt
-import pandas as pd
-import os
+import io
 import math
+import copy
+import itertools
+import concurrent.futures
+import functools
+import numpy as np
+import cv2
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw 
 
 # internal libraries
 import datatypes as dt
+import segmentStore
+import renderCache
 
 ##################################################
-# This file generates based on the image csv files png files
+# This file generates png files out of the zoom segments
 # Author: Tobias Ranft & Kimberly Mason
 # Date: 2022-08-27
 ##################################################
 
-# This function extracts the properties of a single image csv file
-# data[in]           pandas csv file
-# properties[in,out] properties of this file
-def fillProperties(data,properties):
-    numberOfLines=len(data)
-    properties.frames=len(data.columns)-1
-    properties.pixelY=numberOfLines-3
-    lastCell=data.iloc[numberOfLines-1]["Unnamed: 0"]
-    splitCell=lastCell.split(" ")
-    properties.minRange=float(splitCell[1])
-    properties.maxRange=float(splitCell[2])
-    #print(str(properties.frames)+"X"+str(properties.pixelY))
-    
-# Generates an png image out of an image csv file
+# Renders the intensity values of one segment to an image
 # This version of the function uses matplotlib and the colour profile can easily be changed
 # However the number of colour gradients must be smaller otherwise it will take for ever
-# path[in]       path to the image csv file
-# nr[in]         number of the image processed, for naming the saved image
-# imgPath[in]    path where the image should be saved 
+# data[in]       numpy array with the intensities (pixelY x frames)
+# properties[in] properties of the segment
 # cmapString[in] color map
-def processOneFrame(path,nr,imgPath,cmapString):
-    #print(path)
-    data = pd.read_csv(path,header=0, dtype=str)
+# return: rgb image as numpy array, upside down
+def renderFrame(data,properties,cmapString):
+    if (data.shape[1]<2):
+        data=np.repeat(data,2,axis=1)
     
-    properties=dt.dataProperties()
-    fillProperties(data,properties)
-    properties.name=nr
+    fig, ax = plt.subplots()
+    ax = plt.contourf(data,antialiased=True,cmap=cmapString,levels=50)
+    plt.axis('off')
     
-    #create image if it does not exits
-    image_path=imgPath+"/fig_"+str(nr)+".png"
-    if (not os.path.exists(image_path)):
-        
-        data = data[:-1]
-        data = data.drop('Unnamed: 0', axis = 1)
-        data = data.dropna()
-        data=data.astype(int)
-        
-        if (len(data.columns)<2):
-            data['copy'] = data['V1']
-        
-        fig, ax = plt.subplots()
-        ax = plt.contourf(data,antialiased=True,cmap=cmapString,levels=50)
-        plt.axis('off')
-        
-        
-        figure = plt.gcf()
-        
-        # matplotlib can not be asked to give the image a certain number of pixels. Therefore the ratio and 
-        # the dpi values are calculated
-        inchesY=10
-        dpiVal=math.ceil(properties.pixelY/inchesY)
-        #print("dpiVal "+str(dpiVal))
-        inchesX=properties.frames/dpiVal
-        #print("inchesX "+str(inchesX))
-        figure.set_size_inches(inchesX, inchesY)
-        plt.savefig(image_path, transparent=False, bbox_inches='tight', pad_inches=0,dpi=dpiVal+100)
-        plt.close("all")
-    return properties
-
-
-# Generates an png image out of an image csv file
-# This version of the function is an own implementation. It produces an image with exactly the
-# right number of pixels and can produce a higher level of details. However the colour map is fix.
-# path[in]    path to the image csv file
-# nr[in]      number of the image processed, for naming the saved image
-# imgPath[in] path where the image should be saved 
-def processOneFrameSelf(path,nr,imgPath):
-    # print(path)
-    data = pd.read_csv(path,header=0, dtype=str)
-        
-    properties=dt.dataProperties()
-    fillProperties(data,properties)
-    properties.name=nr
     
-    #create image if it does not exits
-    image_path=imgPath+"/fig_"+str(nr)+".png"
-    if (not os.path.exists(image_path)):
-        
-        data = data[:-1]
-        data = data.drop('Unnamed: 0', axis = 1)
-        data = data.dropna()
-        data=data.astype(int)
-        # convert dataframe to list -> faster access
-        dataList=data.values.tolist()
-        
-        #max value of data list        
-        maxYValue=int(max(max(dataList)))
-        #print("max "+str(maxYValue))
-        
-        # create an empty image
-        new_im = Image.new('RGB', (properties.frames,properties.pixelY))
-        #print("image size "+str(properties.frames)+" "+str(properties.pixelY))
-        pixels = new_im.load()
-        
-        #create value dict for all colour to speed up
-        valDict={}
-        for i in range(maxYValue+10):
-            pixval=int(255/maxYValue*i)
-            r=int(pixval/255*78)
-            g=int(pixval/255*255)
-            b=int(pixval/255*174)
-            valDict[i]=(r,g,b)
-        #print(valDict)
-            
-        # loop over the image and transfer the intensities to colour values
-        for row in range (0,properties.pixelY,1):
-            for col in range (0,properties.frames,1):
-                pixval=valDict[dataList[row][col]]
-                pixels[col,row]=pixval#(pixval,pixval,pixval)
-        new_im=new_im.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-        new_im.save(image_path, "PNG")
-    return properties
-
-
-# This function will loop over all image csv files and create png image files out of them.
-# Moreover it will create a list with the properties of this files
-# Already created images will not be recreated
-# allFiles[in] list with the names to all files to process
-# path[in]     base path of where the image csv files are located
-# imgPath[in]  path to where the png image files should be saved
-# cmap[in]     colour map that should be used. use "self" for detailed processing
-# return: returns a list with the properties of for each image. This list will be as well created if
-#         the image are all already present
-def generateImagesAndPropertyList(allFiles,path,imgPath,cmap):
-    propertyList=[]
-    fameCounter=0
-    numberImages=len(allFiles)
-    imageCounter=1
-    for file in allFiles:
-        res1=file.find("_")
-        res2=file.find(".")
-        nr=file[res1+1:res2]
-        #print(nr)
+    figure = plt.gcf()
+    
+    # matplotlib can not be asked to give the image a certain number of pixels. Therefore the ratio and 
+    # the dpi values are calculated
+    inchesY=10
+    dpiVal=math.ceil(properties.pixelY/inchesY)
+    #print("dpiVal "+str(dpiVal))
+    inchesX=properties.frames/dpiVal
+    #print("inchesX "+str(inchesX))
+    figure.set_size_inches(inchesX, inchesY)
+    buffer=io.BytesIO()
+    plt.savefig(buffer, format="png", transparent=False, bbox_inches='tight', pad_inches=0,dpi=dpiVal+100)
+    plt.close("all")
+    buffer.seek(0)
+    return np.array(Image.open(buffer).convert("RGB"))
+
+# Renders the intensity values of one segment to an image without matplotlib
+# The image has exactly one pixel per value. Like contourf the colour map spans
+# from the smallest to the largest value of the segment
+# data[in]       numpy array with the intensities (pixelY x frames)
+# properties[in] properties of the segment
+# cmapString[in] color map
+# smoothing[in]  sigma of a gaussian smoothing in pixels, 0 = no smoothing
+# return: rgb image as numpy array, upside down
+def renderFrameRaster(data,properties,cmapString,smoothing=0):
+    values=data[:properties.pixelY,:properties.frames].astype(np.float32)
+    if(smoothing>0):
+        values=cv2.GaussianBlur(values,(0,0),smoothing)
+    minValue=values.min()
+    valueRange=max(float(values.max()-minValue),1e-6)
+    index=np.minimum((values-minValue)*(255/valueRange),255).astype(np.uint8)
+    rgb=getColourLut(cmapString)[index]
+    # the image is stored upside down
+    return np.ascontiguousarray(rgb[::-1])
+
+# Returns a lookup table with 256 rgb colours for a colour map
+# cmap[in] "self" for the own green colour map or the name of a matplotlib colour map
+#          https://matplotlib.org/stable/tutorials/colors/colormaps.html
+# return: numpy array 256 x 3 (uint8)
+@functools.lru_cache(maxsize=None)
+def getColourLut(cmap):
+    ramp=np.arange(256)
+    if(cmap=="self"):
+        # black to (78,255,174)
+        lut=np.stack([ramp/255*78,ramp,ramp/255*174],axis=1)
+    else:
+        lut=plt.get_cmap(cmap)(ramp)[:,:3]*255
+    return lut.astype(np.uint8)
+
+# Maps the intensities of a segment to colours
+# The intensities are scaled so that the maximum value of the segment gets the last colour
+# data[in] numpy array with the intensities (pixelY x frames)
+# cmap[in] colour map, see getColourLut
+# return: rgb image as numpy array (pixelY x frames x 3)
+def colouriseFrame(data,cmap):
+    maxValue=max(int(data.max()),1)
+    index=np.minimum(255/maxValue*data,255).astype(np.uint8)
+    return getColourLut(cmap)[index]
+
+# Renders the intensity values of one segment to an image
+# This version of the function is an own implementation. It produces an image with exactly the
+# right number of pixels and can produce a higher level of details.
+# data[in]       numpy array with the intensities (pixelY x frames)
+# properties[in] properties of the segment
+# cmap[in]       colour map, see getColourLut
+# return: rgb image as numpy array, upside down
+def renderFrameSelf(data,properties,cmap="self"):
+    rgb=colouriseFrame(data[:properties.pixelY,:properties.frames],cmap)
+    # the image is stored upside down
+    return np.ascontiguousarray(rgb[::-1])
+
+# Generates an image out of one zoom segment
+# The colour profile can easily be changed. Depending on the settings the image is
+# rendered directly (raster) or with matplotlib (contour)
+# segment[in]    segmentData of the zoom segment
+# cmapString[in] color map
+# settings[in]   renderSettings
+# return: rgb image as numpy array, upside down
+def processOneFrame(segment,cmapString,settings):
+    if(settings.mode=="contour"):
+        return renderFrame(segment.getData(),segment.properties,cmapString)
+    return renderFrameRaster(segment.getData(),segment.properties,cmapString,settings.smoothing)
+
+
+# Generates an image out of one zoom segment
+# This version of the function is an own implementation which maps the intensities
+# with a lookup table to colours.
+# segment[in] segmentData of the zoom segment
+# cmap[in]    "self" or the name of a matplotlib colour map
+# return: rgb image as numpy array, upside down
+def processOneFrameSelf(segment,cmap="self"):
+    return renderFrameSelf(segment.getData(),segment.properties,cmap)
+
+
+# Renders one zoom segment. This function is executed in the worker processes
+# If a cache folder is given, the image is taken from the cache if the segment was
+# already rendered with the same parameters, otherwise it is added to the cache.
+# If settings.saveImages is set, the image is saved as png file for debugging
+# segment[in]   segmentData of the zoom segment
+# imgPath[in]   path to where the png image file should be saved
+# cmap[in]      colour map that should be used. use "self" for detailed processing
+# settings[in]  renderSettings
+# cachePath[in] folder of the render cache, "" = no cache (see renderCache)
+# return: properties of the segment, rgb image as numpy array (upside down),
+#         cache key and size of the cached file
+def processOneSegment(segment,imgPath,cmap,settings,cachePath=""):
+    properties=copy.copy(segment.properties)
+    if(segment.data is None and segment.storePath!=""):
+        # the worker maps its segment itself instead of getting the data sent
+        segment=segmentStore.readSegment(segment.storePath,segment.index)
+
+    key=""
+    image=None
+    cacheSize=0
+    if(cachePath!=""):
+        key=renderCache.segmentKey(segment.getData(),cmap,settings)
+        image, cacheSize=renderCache.loadImage(cachePath,key)
+    if(image is None):
         if(cmap=="self"):
-            oneProperty=processOneFrameSelf(path+"/"+file,nr,imgPath)
+            image=processOneFrameSelf(segment)
         else:
-            oneProperty=processOneFrame(path+"/"+file,nr,imgPath,cmap)
-        #set frame counting from start
-        oneProperty.startIndex=fameCounter
-        fameCounter+=oneProperty.frames
+            image=processOneFrame(segment,cmap,settings)
+        if(cachePath!=""):
+            cacheSize=renderCache.storeImage(cachePath,key,image)
+    if(settings.saveImages):
+        Image.fromarray(image).save(imgPath+"/fig_"+str(properties.name)+".png", "PNG")
+    return properties, image, key, cacheSize
+
+# Returns a copy of the segment that can be sent cheaply to a worker process
+def _segmentForWorker(segment):
+    if(segment.storePath==""):
+        workerSegment=copy.copy(segment)
+        workerSegment.data=np.asarray(segment.getData())
+        workerSegment.loader=None
+        return workerSegment
+    workerSegment=dt.segmentData()
+    workerSegment.properties=segment.properties
+    workerSegment.storePath=segment.storePath
+    workerSegment.index=segment.index
+    return workerSegment
+
+# Creates the process pool the zoom segments are rendered in
+# settings[in] renderSettings, if None the default settings are used
+# return: ProcessPoolExecutor, None if settings.workers<=1 and the segments are rendered in this process
+def createExecutor(settings=None):
+    if(settings is None or settings.workers<=1):
+        return None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=settings.workers)
+
+# This function will loop over all zoom segments of a channel and render them to images.
+# Moreover it will create a list with the properties of this images
+# The segments are independent of each other, so with settings.workers>1 they are
+# rendered in parallel in several processes
+# Already rendered segments are taken from the render cache, see renderCache. The cache
+# is only used for the contour rendering, all other renderings are faster than the cache
+# segments[in]  list with segmentData of all zoom segments (see segmentStore)
+# imgPath[in]   path to where the png image files are saved, if settings.saveImages is set
+# cmap[in]      colour map that should be used. use "self" for detailed processing
+# settings[in]  renderSettings, if None the default settings are used
+# cachePath[in] folder of the render cache, "" = no cache
+# executor[in]  process pool to render in (see createExecutor), if None a pool is created for this call
+# return: returns a list with the properties of for each image and a list with the images
+#         as numpy arrays (upside down)
+def generateImagesAndPropertyList(segments,imgPath,cmap,settings=None,cachePath="",executor=None):
+    if(settings is None):
+        settings=dt.renderSettings()
+    if(settings.cacheSizeMB<=0 or cmap=="self" or settings.mode!="contour"):
+        cachePath=""
+    numberImages=len(segments)
+    # the pool is only shut down here if it was created for this call
+    ownExecutor=None
+    if(executor is None and numberImages>1):
+        executor=ownExecutor=createExecutor(settings)
+    if(executor is not None and numberImages>1):
+        workerSegments=(_segmentForWorker(segment) for segment in segments)
+        results=executor.map(processOneSegment,workerSegments,itertools.repeat(imgPath),
+                             itertools.repeat(cmap),itertools.repeat(settings),itertools.repeat(cachePath))
+    else:
+        results=(processOneSegment(segment,imgPath,cmap,settings,cachePath) for segment in segments)
+
+    propertyList=[]
+    imageList=[]
+    usedCacheImages={}
+    imageCounter=1
+    for oneProperty, image, key, cacheSize in results:
         propertyList.append(oneProperty)
-        
+        imageList.append(image)
+        if(key!=""):
+            usedCacheImages[key]=cacheSize
         #print progress
         print("processed image "+str(imageCounter) + " out of "+str(numberImages))
         imageCounter=imageCounter+1
-    return propertyList
+    if(ownExecutor is not None):
+        ownExecutor.shutdown()
+    if(cachePath!=""):
+        renderCache.updateManifest(cachePath,usedCacheImages,settings.cacheSizeMB)
+    return propertyList, imageList
 
 # Labels the image with dept distance lines and numbers
 # For Primary,Secondary and Downscan
@@ -5,14 +5,20 @@ import numpy as np
 import pandas as pd
 import os
 import math
+import concurrent.futures
 from PIL import Image
 from pyproj import Transformer
+import rasterio.transform
+from scipy.spatial import cKDTree
 import cv2
 import sys
 
 import datatypes as dt
 import utilities as utils
 import generateBaseImages as baseIm
+import segmentStore
+import mosaicStore
+import webTiles
 
 import warnings
 from shapely.errors import ShapelyDeprecationWarning
@@ -31,6 +37,18 @@ warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning)
     else:
         print("pixel outside") """
         
+# maximum number of points that are rasterized at once
+maxPointsPerBatch=pow(2,22)
+# width and height of the tiles the mosaic is rendered in, a multiple of utils.geoTifBlockSize
+mosaicTileSize=2048
+# maximum number of subdivisions of one quad edge when rasterizing
+maxSubdivisions=256
+# gather mosaic: number of pings before and after the found ping that are checked for every pixel
+gatherNeighbours=2
+# gather mosaic: maximum number of search steps and pings per step to find the ping of a pixel
+gatherIterations=10
+gatherMaxJump=256
+
 def sweepToImage(pixpos,angle,index):
     angle=angle+math.pi
     cos=math.cos(-angle)
@@ -41,6 +59,277 @@ def sweepToImage(pixpos,angle,index):
     #return posRot
     return (int(posRot[0]),int(posRot[1]))
     
+# Transforms the positions of all pings to pixel positions in the mosaic with one call
+# transformer[in] transformer from WGS84 to the local coordinate system
+# lat[in]         latitudes of the pings
+# lon[in]         longitudes of the pings
+# bottomleft[in]  position of the bottom left corner of the mosaic in the local coordinate system
+# pixelSize[in]   size of one pixel in meters
+# return: pixel positions, shape (pings,2)
+def pingsToImage(transformer,lat,lon,bottomleft,pixelSize):
+    globalX,globalY=transformer.transform(np.asarray(lat,dtype=np.float64),np.asarray(lon,dtype=np.float64))
+    pixX=(np.asarray(globalX)-bottomleft[0])/pixelSize[0]
+    pixY=(np.asarray(globalY)-bottomleft[1])/pixelSize[1]
+    return np.stack((pixX,pixY),axis=1)
+
+# Same as sweepToImage, but for all samples across the swath of many pings at once
+# pixpos[in]     pixel positions of the pings, shape (pings,2)
+# heading[in]    headings of the pings in radians
+# pixInWidth[in] number of samples on each side of the swath
+# return: integer pixel positions of the samples, shape (pings,2*pixInWidth,2)
+def sweepsToImage(pixpos,heading,pixInWidth):
+    angle=np.asarray(heading,dtype=np.float64)+math.pi
+    index=np.arange(-pixInWidth,pixInWidth,1)
+    x=np.trunc(pixpos[:,0,None]+index*np.cos(-angle)[:,None])
+    y=np.trunc(pixpos[:,1,None]+index*np.sin(-angle)[:,None])
+    return np.stack((x,y),axis=2).astype(np.int64)
+
+# Fills many quads at once. The quads are sampled densely enough that no pixel inside
+# is missed, if quads overlap the one drawn last wins (like drawing them one after another)
+# cvImage[in,out] image with 4 channels to draw on
+# corners[in]     corners of the quads in drawing order, shape (quads,4,2), going around the quad
+# colours[in]     rgb colour of each quad, shape (quads,3)
+def drawQuads(cvImage,corners,colours):
+    numberQuads=len(corners)
+    if(numberQuads==0):
+        return
+    height,width=cvImage.shape[:2]
+    corners=corners.astype(np.float64)
+    # the length of the edges decides how often a quad is subdivided in each direction
+    # (first direction from corner 0 to 1, second direction from corner 0 to 3)
+    edges=np.linalg.norm(corners-np.roll(corners,1,axis=1),axis=2)
+    subdivisionsS=np.clip(np.ceil(2*np.maximum(edges[:,1],edges[:,3])),1,maxSubdivisions).astype(np.int64)
+    subdivisionsT=np.clip(np.ceil(2*np.maximum(edges[:,0],edges[:,2])),1,maxSubdivisions).astype(np.int64)
+    groups=subdivisionsS*(maxSubdivisions+1)+subdivisionsT
+    # x and y of the corners in rows, so the points of a quad are a matrix product with the weights
+    cornersXY=corners.transpose(0,2,1)
+
+    pixelIndices=[]
+    quadIndices=[]
+    for group in np.unique(groups):
+        quads=np.flatnonzero(groups==group)
+        nS=subdivisionsS[quads[0]]
+        nT=subdivisionsT[quads[0]]
+        # bilinear weights of the four corners for a grid of (nS+1)x(nT+1) points
+        s,t=np.meshgrid(np.arange(nS+1)/nS,np.arange(nT+1)/nT)
+        s=s.ravel()
+        t=t.ravel()
+        weights=np.stack(((1-s)*(1-t),s*(1-t),s*t,(1-s)*t))
+        batch=max(1,maxPointsPerBatch//len(s))
+        for start in range(0,len(quads),batch):
+            batchQuads=quads[start:start+batch]
+            points=np.matmul(cornersXY[batchQuads],weights)
+            x=np.floor(points[:,0]+0.5).astype(np.int64)
+            y=np.floor(points[:,1]+0.5).astype(np.int64)
+            inside=(x>=0)&(x<width)&(y>=0)&(y<height)
+            pixelIndices.append((y*width+x)[inside])
+            quadIndices.append(np.broadcast_to(batchQuads[:,None],x.shape)[inside])
+    pixelIndices=np.concatenate(pixelIndices)
+    quadIndices=np.concatenate(quadIndices)
+    if(len(pixelIndices)==0):
+        return
+
+    # sort by pixel and drawing order and keep the quad drawn last for every pixel
+    keys=pixelIndices*numberQuads+quadIndices
+    keys.sort()
+    pixelIndices=keys//numberQuads
+    quadIndices=keys%numberQuads
+    last=np.append(pixelIndices[1:]!=pixelIndices[:-1],True)
+    pixels=cvImage.reshape(-1,cvImage.shape[2])
+    pixels[pixelIndices[last],:3]=colours[quadIndices[last]]
+    pixels[pixelIndices[last],3]=255
+
+# Scales the rendered images of the zoom segments to the pixel size of the mosaic
+# Every ping gets 2*pixInWidth samples, one per pixel across the swath
+# propertyList[in] properties of the zoom segments
+# imageList[in]    rendered images of the zoom segments
+# pixelSize[in]    size of one pixel in meters
+# return: list of rgb images with 2*pixInWidth rows and one column per ping
+def getSwathImages(propertyList,imageList,pixelSize):
+    swathImages=[]
+    for oneProp, image in zip(propertyList,imageList):
+        pixInWidth=int(oneProp.maxRange/pixelSize[1])
+        img=Image.fromarray(image)
+        newsize=(oneProp.frames,max(pixInWidth*2,1))
+        img=img.resize(newsize)
+        swathImages.append(np.asarray(img)[:pixInWidth*2])
+    return swathImages
+
+# Draws the pings of all segments into a window of the mosaic. Every sample of a ping is projected
+# into the image and the quads between neighbouring samples of two pings are filled. Only pings
+# whose swath reaches the window are drawn
+# cvImage[in,out]  window of the mosaic with 4 channels to draw on
+# origin[in]       pixel position of the window in the mosaic
+# pingPixels[in]   pixel positions of all side scan pings, shape (pings,2)
+# headings[in]     headings of all side scan pings in radians
+# propertyList[in] properties of the zoom segments
+# swathImages[in]  images of the zoom segments scaled to the mosaic (see getSwathImages)
+# pings[in]        sorted indices of the pings that reach the window, None = check all pings
+def splatSegments(cvImage,origin,pingPixels,headings,propertyList,swathImages,pings=None):
+    height,width=cvImage.shape[:2]
+    pingPixels=np.trunc(pingPixels).astype(np.int64)
+    for oneProp, pixelsInputImg in zip(propertyList,swathImages):
+        pixInWidth=pixelsInputImg.shape[0]//2
+        numberQuads=2*pixInWidth-2
+        if(numberQuads<=0 or oneProp.frames<2):
+            continue
+        segmentPixels=pingPixels[oneProp.startIndex:oneProp.startIndex+oneProp.frames]
+        segmentHeadings=headings[oneProp.startIndex:oneProp.startIndex+oneProp.frames]
+
+        # a quad is spanned by two neighbouring samples of a ping and the same samples
+        # of the previous ping, it gets the colour of the second sample.
+        # It is drawn if one of the two pings reaches the window
+        if(pings is None):
+            local=segmentPixels-origin
+            reach=((local[:,0]+pixInWidth>=-1)&(local[:,0]-pixInWidth<=width)&
+                   (local[:,1]+pixInWidth>=-1)&(local[:,1]-pixInWidth<=height))
+        else:
+            first,last=np.searchsorted(pings,[oneProp.startIndex,oneProp.startIndex+oneProp.frames])
+            reach=np.zeros(oneProp.frames,dtype=bool)
+            reach[pings[first:last]-oneProp.startIndex]=True
+        drawnPings=np.flatnonzero(reach[1:]|reach[:-1])+1
+
+        pingsPerBatch=max(1,maxPointsPerBatch//(9*numberQuads))
+        for start in range(0,len(drawnPings),pingsPerBatch):
+            batchPings=drawnPings[start:start+pingsPerBatch]
+            # pixel positions of every sample of the pings
+            current=sweepsToImage(segmentPixels[batchPings],segmentHeadings[batchPings],pixInWidth)-origin
+            previous=sweepsToImage(segmentPixels[batchPings-1],segmentHeadings[batchPings-1],pixInWidth)-origin
+            corners=np.stack((current[:,:numberQuads],current[:,1:numberQuads+1],
+                              previous[:,1:numberQuads+1],previous[:,:numberQuads]),axis=2).reshape(-1,4,2)
+            colours=pixelsInputImg[1:numberQuads+1,batchPings].transpose(1,0,2).reshape(-1,3)
+            drawQuads(cvImage,corners,colours)
+
+# Fills a window of the mosaic the other way round: for every pixel the ping it belongs to
+# and the distance across the track are searched and the colour is read from there.
+# The search starts at the nearest ping (kd tree) and walks along the track to the ping
+# whose swath goes through the pixel (see _walkToSwath). There are no holes between the
+# pings, so closeHoles is not needed.
+# cvImage[in,out]  window of the mosaic with 4 channels to draw on
+# origin[in]       pixel position of the window in the mosaic
+# pingPixels[in]   pixel positions of all side scan pings, shape (pings,2)
+# headings[in]     headings of all side scan pings in radians
+# propertyList[in] properties of the zoom segments
+# swathImages[in]  images of the zoom segments scaled to the mosaic (see getSwathImages)
+# tree[in]         kd tree of pingPixels
+def gatherSegments(cvImage,origin,pingPixels,headings,propertyList,swathImages,tree):
+    height,width=cvImage.shape[:2]
+    numberPings=len(pingPixels)
+    if(numberPings==0):
+        return
+    # direction across the track (same as sweepToImage) and along the track of every ping
+    across=np.stack((-np.cos(headings),np.sin(headings)),axis=1)
+    along=np.stack((np.sin(headings),np.cos(headings)),axis=1)
+    # segment and swath width of every ping
+    segmentOfPing=np.full(numberPings,-1,dtype=np.int64)
+    pixInWidth=np.zeros(numberPings,dtype=np.int64)
+    for nr,(oneProp,image) in enumerate(zip(propertyList,swathImages)):
+        indices=slice(oneProp.startIndex,oneProp.startIndex+oneProp.frames)
+        segmentOfPing[indices]=nr
+        pixInWidth[indices]=image.shape[0]//2
+    maxWidth=pixInWidth.max()
+    if(maxWidth==0):
+        return
+
+    blockSize=32
+    rowsPerStrip=max(blockSize,(maxPointsPerBatch//(width*(2*gatherNeighbours+1)))//blockSize*blockSize)
+    for row in range(0,height,rowsPerStrip):
+        rowEnd=min(row+rowsPerStrip,height)
+        # skip blocks of pixels without a ping in reach
+        blockY,blockX=np.mgrid[row:rowEnd:blockSize,0:width:blockSize]
+        blockCentre=np.stack((blockX.ravel()+origin[0]+blockSize/2,blockY.ravel()+origin[1]+blockSize/2),axis=1)
+        distance,_=tree.query(blockCentre,k=1,distance_upper_bound=maxWidth+blockSize)
+        usedBlocks=np.flatnonzero(np.isfinite(distance))
+        if(len(usedBlocks)==0):
+            continue
+        # pixel centres of the used blocks
+        offsetY,offsetX=np.mgrid[0:blockSize,0:blockSize]
+        pixX=(blockX.ravel()[usedBlocks,None]+offsetX.ravel()).ravel()
+        pixY=(blockY.ravel()[usedBlocks,None]+offsetY.ravel()).ravel()
+        inside=(pixX<width)&(pixY<rowEnd)
+        pixX=pixX[inside]
+        pixY=pixY[inside]
+        centre=np.stack((pixX+origin[0]+0.5,pixY+origin[1]+0.5),axis=1)
+
+        _,nearest=tree.query(centre,k=1,distance_upper_bound=maxWidth+1)
+        inReach=nearest<numberPings
+        centre=centre[inReach]
+        pixX=pixX[inReach]
+        pixY=pixY[inReach]
+        ping=_walkToSwath(pingPixels,along,centre,nearest[inReach])
+        # check the pings around the one found
+        candidates=np.clip(ping[:,None]+np.arange(-gatherNeighbours,gatherNeighbours+1),0,numberPings-1)
+        valid=np.ones(candidates.shape,dtype=bool)
+        difference=centre[:,None,:]-pingPixels[candidates]
+        distanceAcross=np.einsum('pkd,pkd->pk',difference,across[candidates])
+        distanceAlong=np.abs(np.einsum('pkd,pkd->pk',difference,along[candidates]))
+        # the pixel must be inside the swath and not further along the track than half the
+        # distance to the neighbouring pings at this range
+        spacing=np.maximum(_pingSpacing(pingPixels,across,candidates,distanceAcross,1,segmentOfPing),
+                           _pingSpacing(pingPixels,across,candidates,distanceAcross,-1,segmentOfPing))
+        valid&=(np.abs(distanceAcross)<pixInWidth[candidates])
+        valid&=(distanceAlong<=0.5*spacing+0.5)
+        distanceAlong=np.where(valid,distanceAlong,np.inf)
+        best=np.argmin(distanceAlong,axis=1)
+        found=np.isfinite(distanceAlong[np.arange(len(centre)),best])
+        ping=candidates[found,best[found]]
+        sampleAcross=distanceAcross[found,best[found]]
+        pixX=pixX[found]
+        pixY=pixY[found]
+
+        # read the colours from the images of the segments
+        segmentNr=segmentOfPing[ping]
+        sample=np.floor(sampleAcross).astype(np.int64)+pixInWidth[ping]
+        for nr in np.unique(segmentNr):
+            if(nr<0):
+                continue
+            selection=segmentNr==nr
+            image=swathImages[nr]
+            column=ping[selection]-propertyList[nr].startIndex
+            rowInImage=np.clip(sample[selection],0,image.shape[0]-1)
+            cvImage[pixY[selection],pixX[selection],:3]=image[rowInImage,column]
+            cvImage[pixY[selection],pixX[selection],3]=255
+
+# Searches the ping whose swath goes through a pixel. Starting at the nearest ping, the
+# search steps along the track by the distance of the pixel to the swath of the current ping.
+# This also works if the swath is not perpendicular to the track (for example drift)
+# pingPixels[in] pixel positions of all pings
+# along[in]      direction along the track of all pings
+# centre[in]     pixel positions to search for
+# pings[in]      nearest ping of every pixel
+# return: ping of every pixel
+def _walkToSwath(pingPixels,along,centre,pings):
+    lastPing=len(pingPixels)-1
+    if(lastPing==0):
+        return pings
+    for step in range(gatherIterations):
+        distanceAlong=np.einsum('pd,pd->p',centre-pingPixels[pings],along[pings])
+        # distance the track moves from one ping to the next in the direction of the swath
+        current=np.minimum(pings,lastPing-1)
+        advance=np.einsum('pd,pd->p',pingPixels[current+1]-pingPixels[current],along[pings])
+        moving=np.abs(advance)>1e-6
+        jump=np.zeros(len(pings))
+        jump[moving]=np.clip(distanceAlong[moving]/advance[moving],-gatherMaxJump,gatherMaxJump)
+        jump=np.rint(jump).astype(np.int64)
+        if(not jump.any()):
+            break
+        pings=np.clip(pings+jump,0,lastPing)
+    return pings
+
+# Distance between a ping and its neighbouring ping at a distance across the track
+# pingPixels[in]     pixel positions of all pings
+# across[in]         direction across the track of all pings
+# pings[in]          indices of the pings
+# distanceAcross[in] distance across the track in pixels
+# step[in]           1 for the next ping, -1 for the previous one
+# segmentOfPing[in]  segment of all pings, only pings of the same segment are neighbours
+# return: distances in pixels, 0 if there is no neighbouring ping
+def _pingSpacing(pingPixels,across,pings,distanceAcross,step,segmentOfPing):
+    neighbour=np.clip(pings+step,0,len(pingPixels)-1)
+    difference=(pingPixels[neighbour]-pingPixels[pings])+distanceAcross[...,None]*(across[neighbour]-across[pings])
+    sameSegment=(neighbour!=pings)&(segmentOfPing[neighbour]==segmentOfPing[pings])
+    return np.where(sameSegment,np.linalg.norm(difference,axis=-1),0)
+
 # Return a colour, if enough colours are non zero (black)
 # colourVect[in] vector of colours in
 # return colour to use
@@ -58,53 +347,547 @@ def returnNonZeroColour(colourVect):
 # When the images get georeferenced there are sometimes small holes.
 # I don't know where they are coming from. Since actually with
 # the drawing function the should not be holes.
-# However this functions closes them with the colour values around
+# However this functions closes them with the colour values around.
+# A black pixel is filled if more than two of its four neighbours are not black. It gets the
+# colour of the last non black neighbour in the order below, above, right, left (see returnNonZeroColour).
+# The image is processed in strips of rows, all neighbours are taken from the image before the pass.
 # img[in,out] image to process    
-def closeHoles(img):
-    width = img.shape[1]
-    height = img.shape[0]
-    
-    	
-    grayImage = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    (thresh, bwImg) = cv2.threshold(grayImage, 0, 255, cv2.THRESH_BINARY)
-    bwImg=(bwImg/255).astype(np.byte)
-
+# passes[in]  number of passes, holes that are bigger than one pixel get smaller with every pass
+def closeHoles(img,passes=1):
     print("closing holes")
-    numberOfRows=width/10
-    rowCounter=0
-    rowPrintProgress=0
-
-    #imgOut=img.copy()
-    for j in range(1,width-1,1):
-        for i in range(1,height-1,1):
-            if(bwImg[i,j]==0):
-                counter=bwImg[i+1,j]+bwImg[i-1,j]+bwImg[i,j+1]+bwImg[i,j-1]
-                #if(counter>0):
-                   # print(str(counter)+" "+str(bwImg[i+1,j])+" "+str(bwImg[i-1,j])+" "+str(bwImg[i,j+1])+" "+str(bwImg[i,j-1]))
-                if(counter>2):
-                    #print("close hole")
-                    pos1=img[i+1,j]
-                    pos2=img[i-1,j]
-                    pos3=img[i,j+1]
-                    pos4=img[i,j-1]
-                    outColour=returnNonZeroColour([pos1,pos2,pos3,pos4])
-                    img[i,j]=outColour
-        if(j>rowCounter):
-            rowCounter=rowCounter+numberOfRows
-            print(str(rowPrintProgress)+"%")
-            rowPrintProgress+=10
+    height = img.shape[0]
+    if(height<3 or img.shape[1]<3):
+        return img
+    rowsPerStrip=max(1,maxPointsPerBatch//img.shape[1])
+    for onePass in range(passes):
+        filled=0
+        previousRow=None
+        for row in range(1,height-1,rowsPerStrip):
+            rowEnd=min(row+rowsPerStrip,height-1)
+            block=img[row-1:rowEnd+1].copy()
+            if(previousRow is not None):
+                # the row above was already changed in this pass, use the one from before
+                block[0]=previousRow
+            previousRow=img[rowEnd-1].copy()
+            filled+=_closeHolesBlock(img,block,row)
+        print("pass "+str(onePass+1)+": closed "+str(filled)+" holes")
+        if(filled==0):
+            break
     return img
-                
-    
+
+# Closes the holes of one strip of rows, see closeHoles
+# img[in,out] image to write the result to
+# block[in]   rows of the strip with one extra row above and below
+# row[in]     first row of the strip in the image
+# return: number of holes that got a colour
+def _closeHolesBlock(img,block,row):
+    grayImage = cv2.cvtColor(block, cv2.COLOR_BGR2GRAY)
+    bwImg=grayImage>0
+    centre=bwImg[1:-1,1:-1]
+    counter=(bwImg[2:,1:-1].astype(np.uint8)+bwImg[:-2,1:-1]+bwImg[1:-1,2:]+bwImg[1:-1,:-2])
+    holes=(~centre)&(counter>2)
+    if(not holes.any()):
+        return 0
+    # neighbours below, above, right and left of the holes, the last non black one wins
+    holeY,holeX=np.nonzero(holes)
+    holeY+=1
+    holeX+=1
+    outColour=np.zeros((len(holeY),block.shape[2]),dtype=block.dtype)
+    colourCounter=np.zeros(len(holeY),dtype=np.uint8)
+    for shiftY,shiftX in ((1,0),(-1,0),(0,1),(0,-1)):
+        neighbour=block[holeY+shiftY,holeX+shiftX]
+        nonZero=(neighbour[:,:3]>0).any(axis=1)
+        colourCounter+=nonZero
+        outColour[nonZero]=neighbour[nonZero]
+    outColour[colourCounter<3]=0
+    img[row+holeY-1,holeX]=outColour
+    return int((colourCounter>=3).sum())
+
+# Searches the pings whose swath can reach the area of the mosaic. This only uses latitude
+# and longitude, so it can be done before the positions are transformed
+# coord[in]        Coordinate window which should be processed
+# lat[in]          latitudes of all side scan pings
+# lon[in]          longitudes of all side scan pings
+# propertyList[in] properties of the zoom segments (only the index of the store is needed)
+# return: list of runs of neighbouring pings in the area (segment number, first ping, last ping exclusive)
+def selectPingsInArea(coord,lat,lon,propertyList):
+    lat=np.asarray(lat,dtype=np.float64)
+    lon=np.asarray(lon,dtype=np.float64)
+    metersPerDegree=111320.0
+    # the longitude degrees get shorter to the poles, use the shortest in the area
+    cosLat=max(math.cos(math.radians(max(abs(coord.north),abs(coord.south)))),1e-6)
+    runs=[]
+    for nr,oneProp in enumerate(propertyList):
+        start=oneProp.startIndex
+        end=min(start+oneProp.frames,len(lat))
+        if(end<=start):
+            continue
+        # area expanded by the range of the swath and one pixel
+        margin=oneProp.maxRange+coord.pixelSizeMeters
+        marginLat=margin/metersPerDegree
+        marginLon=margin/(metersPerDegree*cosLat)
+        inArea=((lat[start:end]>=coord.south-marginLat)&(lat[start:end]<=coord.north+marginLat)&
+                (lon[start:end]>=coord.west-marginLon)&(lon[start:end]<=coord.east+marginLon))
+        # keep the neighbours, so the quads to the pings outside are drawn as well
+        inArea[1:]|=inArea[:-1].copy()
+        inArea[:-1]|=inArea[1:].copy()
+        # runs of pings in the area
+        changes=np.flatnonzero(np.diff(np.concatenate(([0],inArea.astype(np.int8),[0]))))
+        for first,last in zip(changes[0::2],changes[1::2]):
+            runs.append((nr,start+int(first),start+int(last)))
+    return runs
+
+# Cuts the runs of pings in the area out of the zoom segments. Every run becomes its own segment
+# runs[in]         runs of pings, see selectPingsInArea
+# propertyList[in] properties of the zoom segments
+# imageList[in]    rendered images of the zoom segments, None for segments without run
+# return: properties and images of the runs, indices of the pings of all runs
+def cutRuns(runs,propertyList,imageList):
+    runProperties=[]
+    runImages=[]
+    pingIndices=[]
+    startIndex=0
+    for nr,first,last in runs:
+        oneProp=propertyList[nr]
+        runProp=dt.dataProperties()
+        runProp.name=oneProp.name
+        runProp.minRange=oneProp.minRange
+        runProp.maxRange=oneProp.maxRange
+        runProp.pixelY=oneProp.pixelY
+        runProp.frames=last-first
+        runProp.startIndex=startIndex
+        startIndex+=runProp.frames
+        runProperties.append(runProp)
+        runImages.append(imageList[nr][:,first-oneProp.startIndex:last-oneProp.startIndex])
+        pingIndices.append(np.arange(first,last))
+    if(len(pingIndices)==0):
+        return runProperties, runImages, np.zeros(0,dtype=np.int64)
+    return runProperties, runImages, np.concatenate(pingIndices)
+
+# Splits the mosaic into tiles and assigns every ping to the tiles its swath can reach
+# The footprint of a ping is the square around its position with the width of the swath
+# numberPixel[in] size of the whole mosaic in pixels
+# pingPixels[in]  pixel positions of all side scan pings, shape (pings,2)
+# pingWidth[in]   number of samples on each side of the swath of every ping
+# margin[in]      additional pixels around each tile
+# return: list of windows (left, bottom, right, top) of the tiles that are reached by a ping,
+#         list with the sorted indices of the pings of each of these tiles
+def assignPingsToTiles(numberPixel,pingPixels,pingWidth,margin):
+    tilesX=math.ceil(numberPixel[0]/mosaicTileSize)
+    tilesY=math.ceil(numberPixel[1]/mosaicTileSize)
+    reach=pingWidth+margin+1
+    left=np.floor((pingPixels[:,0]-reach)/mosaicTileSize)
+    right=np.floor((pingPixels[:,0]+reach)/mosaicTileSize)
+    bottom=np.floor((pingPixels[:,1]-reach)/mosaicTileSize)
+    top=np.floor((pingPixels[:,1]+reach)/mosaicTileSize)
+    # only pings with a swath inside the mosaic
+    inside=(pingWidth>0)&(right>=0)&(left<tilesX)&(top>=0)&(bottom<tilesY)
+    pings=np.flatnonzero(inside)
+    left=np.clip(left[pings],0,tilesX-1).astype(np.int64)
+    right=np.clip(right[pings],0,tilesX-1).astype(np.int64)
+    bottom=np.clip(bottom[pings],0,tilesY-1).astype(np.int64)
+    top=np.clip(top[pings],0,tilesY-1).astype(np.int64)
+
+    # one entry for every pair of ping and tile
+    countX=right-left+1
+    count=countX*(top-bottom+1)
+    pairPing=np.repeat(np.arange(len(pings)),count)
+    pairNumber=np.arange(len(pairPing))-np.repeat(np.cumsum(count)-count,count)
+    tileX=left[pairPing]+pairNumber%countX[pairPing]
+    tileY=bottom[pairPing]+pairNumber//countX[pairPing]
+    tiles=tileY*tilesX+tileX
+    order=np.argsort(tiles,kind='stable')
+    tiles=tiles[order]
+    pairPing=pings[pairPing[order]]
+
+    windows=[]
+    tilePings=[]
+    usedTiles,starts=np.unique(tiles,return_index=True)
+    for tile,start,end in zip(usedTiles,starts,np.append(starts[1:],len(tiles))):
+        tileX=tile%tilesX
+        tileY=tile//tilesX
+        windows.append((int(tileX*mosaicTileSize),int(tileY*mosaicTileSize),
+                        int(min((tileX+1)*mosaicTileSize,numberPixel[0])),int(min((tileY+1)*mosaicTileSize,numberPixel[1]))))
+        tilePings.append(pairPing[start:end])
+    return windows, tilePings
+
+# Renders one window of the mosaic
+# The window is rendered with a margin, so the holes at its border are closed the same way
+# as in one big image
+# window[in]       left, bottom, right and top pixel of the window in the mosaic (right and top exclusive)
+# numberPixel[in]  size of the whole mosaic in pixels
+# pingPixels[in]   pixel positions of all side scan pings, shape (pings,2)
+# headings[in]     headings of all side scan pings in radians
+# propertyList[in] properties of the zoom segments
+# swathImages[in]  images of the zoom segments scaled to the mosaic (see getSwathImages)
+# coord[in]        Coordinate window and settings of the mosaic
+# tree[in]         kd tree of pingPixels, only needed for the gather mode
+# pings[in]        sorted indices of the pings that reach the window, None = check all pings
+# return: image of the window with 4 channels, the first row is the southern one
+def renderMosaicWindow(window,numberPixel,pingPixels,headings,propertyList,swathImages,coord,tree=None,pings=None):
+    margin=0 if coord.mosaicMode=="gather" else coord.closeHolesPasses
+    left=max(window[0]-margin,0)
+    bottom=max(window[1]-margin,0)
+    right=min(window[2]+margin,numberPixel[0])
+    top=min(window[3]+margin,numberPixel[1])
+    cvImage=np.zeros((top-bottom,right-left,4),np.uint8)
+    origin=np.array([left,bottom])
+    if(coord.mosaicMode=="gather"):
+        gatherSegments(cvImage,origin,pingPixels,headings,propertyList,swathImages,tree)
+    else:
+        splatSegments(cvImage,origin,pingPixels,headings,propertyList,swathImages,pings)
+        # close holes in the image
+        cvImage=closeHoles(cvImage,coord.closeHolesPasses)
+    return cvImage[window[1]-bottom:window[3]-bottom,window[0]-left:window[2]-left]
+
+# Returns the kd tree of the ping positions needed by the gather mode, None for the splat mode
+def _mosaicTree(pingPixels,coord):
+    if(coord.mosaicMode=="gather" and len(pingPixels)>0):
+        return cKDTree(pingPixels)
+    return None
+
+# Data of the mosaic in a worker process, see _initMosaicWorker
+_mosaicWorkerData=None
+
+# Sets the data of the mosaic that all tiles share. Called once in every worker process,
+# so the data is sent only once to each process and not with every tile
+def _initMosaicWorker(numberPixel,pingPixels,headings,propertyList,swathImages,coord):
+    global _mosaicWorkerData
+    tree=_mosaicTree(pingPixels,coord)
+    _mosaicWorkerData=(numberPixel,pingPixels,headings,propertyList,swathImages,coord,tree)
+
+# Renders one tile of the mosaic with the data set by _initMosaicWorker
+# window[in] window of the tile
+# pings[in]  sorted indices of the pings that reach the tile
+# return: image of the tile, see renderMosaicWindow
+def _renderMosaicTile(window,pings):
+    numberPixel,pingPixels,headings,propertyList,swathImages,coord,tree=_mosaicWorkerData
+    return renderMosaicWindow(window,numberPixel,pingPixels,headings,propertyList,swathImages,coord,tree,pings)
+
+# Returns the local coordinate system of the mosaic and the transformer to it
+# Geocord[in] area the coordinate system has to fit
+def getMosaicTransformer(Geocord):
+    localCoordSystem=utils.getLocalGeoCoordinateSystem(Geocord)
+    print("Use local geo coordinate system: "+str(localCoordSystem))
+    return localCoordSystem, Transformer.from_crs("epsg:4326", localCoordSystem)
+
+# Returns the position and size of the mosaic in the local coordinate system
+# coord[in]       Coordinate window which should be processed
+# transformer[in] transformer to the local coordinate system
+# return: position of the bottom left corner, size of a pixel in meters, number of pixels (x,y)
+def getMosaicGrid(coord,transformer):
+    #image border
+    bottomleft=transformer.transform(coord.south,coord.west)
+    topright=transformer.transform(coord.north,coord.east)
+    distance=np.subtract(topright,bottomleft)
+    print("distance "+ str(distance))
+    pixelSize=(coord.pixelSizeMeters,coord.pixelSizeMeters)
+    numberPixel=np.divide(distance,pixelSize)
+    numberPixel=(int(numberPixel[0]),int(numberPixel[1]))
+    print("number pixels "+str(numberPixel))
+    if(numberPixel[0]<1 or numberPixel[1]<1):
+        sys.exit("Error area of the mosaic is empty")
+    return bottomleft, pixelSize, numberPixel
+
+# Loads the side scan pings of one trip that reach the area of the mosaic and renders their zoom segments
+# coord[in]       Coordinate window which should be processed
+# transformer[in] transformer to the local coordinate system of the mosaic
+# bottomleft[in]  position of the bottom left corner of the mosaic in the local coordinate system
+# pixelSize[in]   size of a pixel in meters (x,y)
+# pathToData[in]  Path of the side scan channel (see segmentStore)
+# pathToImg[in]   Path to single depth level folder, used if settings.saveImages is set
+# metaInfo[in]    meta information of the trip
+# cmap[in]        Colour map
+# settings[in]    renderSettings
+# plan[in]        viewPlan of the trip or None
+# segmentNumbers[in] numbers of the zoom segments to load, None for all
+# return: pixel positions of the pings, headings of the pings, properties of the zoom segments, swath images,
+#         number of the zoom segment in the store of every ping
+def loadMosaicTrip(coord,transformer,bottomleft,pixelSize,pathToData,pathToImg,metaInfo,cmap,settings,plan=None,segmentNumbers=None):
+    # only the pings and zoom segments that can reach the area are used
+    pathToStore=segmentStore.storePath(pathToData)
+    runs=selectPingsInArea(coord,metaInfo.sideLat,metaInfo.sideLon,segmentStore.readProperties(pathToStore))
+    if(segmentNumbers is not None):
+        segmentNumbers=set(segmentNumbers)
+        runs=[run for run in runs if run[0] in segmentNumbers]
+    usedSegments=sorted(set(nr for nr,_,_ in runs))
+    print("pings in the area: "+str(sum(last-first for _,first,last in runs))+" in "+str(len(usedSegments))+" zoom segments")
+
+    #create images of the used segments and generate property list
+    if(plan is None):
+        segments=segmentStore.readStore(pathToStore)
+        cachePath=os.path.dirname(pathToData)+"/renderCache"
+        propertyList, imageList=baseIm.generateImagesAndPropertyList([segments[nr] for nr in usedSegments],pathToImg,cmap,settings,cachePath)
+    else:
+        propertyList, imageList=plan.getView(pathToData,pathToImg,cmap,usedSegments)
+    allImages=[None]*(max(usedSegments)+1 if len(usedSegments)>0 else 0)
+    allProperties=[None]*len(allImages)
+    for nr,oneProp,image in zip(usedSegments,propertyList,imageList):
+        allProperties[nr]=oneProp
+        allImages[nr]=image
+    propertyList, imageList, pingIndices=cutRuns(runs,allProperties,allImages)
+    swathImages=getSwathImages(propertyList,imageList,pixelSize)
+    # positions of the used side scan pings in the image
+    pingPixels=pingsToImage(transformer,np.asarray(metaInfo.sideLat)[pingIndices],np.asarray(metaInfo.sideLon)[pingIndices],bottomleft,pixelSize)
+    headings=np.asarray(metaInfo.sideHeading,dtype=np.float64)[pingIndices]
+    pingSegments=np.repeat(np.array([nr for nr,_,_ in runs],dtype=np.int64),[last-first for _,first,last in runs])
+    return pingPixels, headings, propertyList, swathImages, pingSegments
+
+# Splits the mosaic into tiles and assigns the pings of one trip to them, see assignPingsToTiles
+# numberPixel[in] size of the whole mosaic in pixels
+# trip[in]        pixel positions, headings, properties and swath images of the trip, see loadMosaicTrip
+# coord[in]       Coordinate window and settings of the mosaic
+# return: windows of the tiles reached by the trip, sorted indices of the pings of each tile
+def assignTripToTiles(numberPixel,trip,coord):
+    pingPixels,_,propertyList,swathImages=trip
+    pingWidth=np.zeros(len(pingPixels),dtype=np.int64)
+    for oneProp, image in zip(propertyList,swathImages):
+        pingWidth[oneProp.startIndex:oneProp.startIndex+oneProp.frames]=image.shape[0]//2
+    margin=0 if coord.mosaicMode=="gather" else coord.closeHolesPasses
+    return assignPingsToTiles(numberPixel,pingPixels,pingWidth,margin)
+
+# Returns the value that decides which trip is used for a pixel of the mosaic, bigger values win
+# image[in]     window of the mosaic of one trip with 4 channels, see renderMosaicWindow
+# origin[in]    pixel position of the window in the mosaic
+# pingTree[in]  kd tree of the pixel positions of the pings of the trip, only needed for "nadir"
+# rule[in]      "last": the trip added last wins, "max": the brightest colour wins,
+#               "nadir": the trip with the track closest to the pixel wins
+# tripNumber[in] number of the trip in the order it was added to the mosaic, used for "last"
+# return: value for every pixel of the window, -inf for pixels without data
+def mergeValue(image,origin,pingTree,rule,tripNumber):
+    data=image[:,:,:3].any(axis=2)
+    value=np.full(data.shape,-np.inf)
+    if(rule=="max"):
+        value[data]=image[:,:,:3][data].sum(axis=1,dtype=np.int64)
+    elif(rule=="nadir"):
+        rows,cols=np.nonzero(data)
+        distance,_=pingTree.query(np.column_stack((cols+origin[0]+0.5,rows+origin[1]+0.5)))
+        value[rows,cols]=-distance
+    else:
+        value[data]=tripNumber
+    return value
+
+# Renders one tile of the mosaic and blends it with what is already in the tile. Every trip is
+# rendered on its own and replaces the pixels where its merge value is at least as big (see mergeValue)
+# window[in]      window of the tile
+# numberPixel[in] size of the whole mosaic in pixels
+# trips[in]       list of trips (pixel positions, headings, properties, swath images), see loadMosaicTrip
+# tripPings[in]   list of (index of the trip, sorted indices of the pings of the trip to draw into the tile)
+# coord[in]       Coordinate window and settings of the mosaic
+# trees[in]       kd trees of the pings of the trips, needed for the gather mode and the rule "nadir"
+# tripNumbers[in] number of every trip in the order it was added to the mosaic
+# base[in]        image already in the tile or None for an empty tile
+# baseValue[in]   merge values of base
+# return: image of the tile (see renderMosaicWindow), merge value of every pixel
+def renderMergedWindow(window,numberPixel,trips,tripPings,coord,trees,tripNumbers,base=None,baseValue=None):
+    if(base is None):
+        merged=np.zeros((window[3]-window[1],window[2]-window[0],4),np.uint8)
+        mergedValue=np.full(merged.shape[:2],-np.inf)
+    else:
+        merged=base
+        mergedValue=baseValue
+    for index,pings in tripPings:
+        pingPixels,headings,propertyList,swathImages=trips[index]
+        image=renderMosaicWindow(window,numberPixel,pingPixels,headings,propertyList,swathImages,coord,trees[index],pings)
+        value=mergeValue(image,window[:2],trees[index],coord.mergeRule,tripNumbers[index])
+        # on equal values the trip drawn later wins
+        replace=(value>=mergedValue)&(value>-np.inf)
+        merged[replace]=image[replace]
+        mergedValue[replace]=value[replace]
+    return merged, mergedValue
+
+# Sets the trips of the mosaic in a worker process, see _initMosaicWorker
+def _initMergeWorker(numberPixel,trips,coord,tripNumbers):
+    global _mosaicWorkerData
+    # the nadir rule needs the trees in the splat mode as well
+    trees=[cKDTree(trip[0]) if (coord.mosaicMode=="gather" or coord.mergeRule=="nadir") and len(trip[0])>0 else None for trip in trips]
+    _mosaicWorkerData=(numberPixel,trips,coord,trees,tripNumbers)
+
+# Renders one tile of the mosaic with the data set by _initMergeWorker, see renderMergedWindow
+def _renderMergedTile(window,tripPings,base,baseValue):
+    numberPixel,trips,coord,trees,tripNumbers=_mosaicWorkerData
+    return renderMergedWindow(window,numberPixel,trips,tripPings,coord,trees,tripNumbers,base,baseValue)
+
+# Returns the number of a tile of the mosaic from its window
+def _tileOfWindow(window,tilesX):
+    return (window[1]//mosaicTileSize)*tilesX+window[0]//mosaicTileSize
+
+# Returns the window of a tile of the mosaic, see assignPingsToTiles
+def _windowOfTile(tile,tilesX,numberPixel):
+    tileX=tile%tilesX
+    tileY=tile//tilesX
+    return (tileX*mosaicTileSize,tileY*mosaicTileSize,
+            min((tileX+1)*mosaicTileSize,numberPixel[0]),min((tileY+1)*mosaicTileSize,numberPixel[1]))
+
+# Renders or updates a mosaic of one or several trips.
+# The mosaic has a store next to it (see mosaicStore) that records which zoom segments are already
+# burned into which tiles, and the merge value of every pixel. A run only draws the zoom segments
+# that are new since the last run on top of the tiles they reach, and rewrites only these tiles and
+# the parts of the overviews above them. If burned data of a trip changed or a trip was removed, the
+# tiles it reached are rendered again from all trips. If the area or a setting of the mosaic changes,
+# the mosaic is rendered again completely.
+# Where trips overlap the pixel is chosen with coord.mergeRule (see mergeValue).
+# coord[in]       Coordinate window and settings of the mosaic
+# trips[in]       list of (path of the side scan channel, path to single depth level folder, meta information)
+# pathToOut[in]   path of the geotif
+# cmap[in]        Colour map
+# settings[in]    renderSettings
+# transformer[in] transformer to the local coordinate system the mosaic is rendered in
+# crs[in]         coordinate system written to the geotif, None = WGS84 with the borders of coord
+# plan[in]        viewPlan, only used if there is one trip
+def updateMosaic(coord,trips,pathToOut,cmap,settings,transformer,crs=None,plan=None):
+    bottomleft,pixelSize,numberPixel=getMosaicGrid(coord,transformer)
+    width,height=numberPixel
+    tilesX=math.ceil(width/mosaicTileSize)
+    if(len(trips)!=1):
+        plan=None
+
+    # everything that changes the whole mosaic
+    parameters=("crs="+str(crs)+";bottomleft="+str(bottomleft)+";pixels="+str(numberPixel)+
+                ";pixelSize="+str(pixelSize)+";cmap="+cmap+";mode="+settings.mode+";smoothing="+str(settings.smoothing)+
+                ";mosaicMode="+coord.mosaicMode+";closeHolesPasses="+str(coord.closeHolesPasses)+
+                ";rule="+coord.mergeRule+";tileSize="+str(mosaicTileSize))
+    pathToStore=mosaicStore.storePath(pathToOut)
+    state=mosaicStore.readState(pathToStore)
+    rebuild=state.get("parameters")!=parameters or not os.path.exists(pathToOut)
+    if(rebuild):
+        mosaicStore.clearStore(pathToStore)
+        state={"parameters":parameters,"nextNumber":0,"trips":{}}
+
+    # tiles that are rendered again from all trips
+    rebuildTiles=set()
+    tripPaths=[pathToData for pathToData,_,_ in trips]
+    for pathToData in list(state["trips"]):
+        if(pathToData not in tripPaths):
+            print("trip removed from the mosaic "+pathToData)
+            for tiles in state["trips"].pop(pathToData)["segments"].values():
+                rebuildTiles.update(tiles)
+    # zoom segments of every trip that are not burned in yet
+    records=[]
+    newSegments=[]
+    for pathToData,_,metaInfo in trips:
+        record=state["trips"].get(pathToData)
+        keys,fingerprint=mosaicStore.tripKeys(record,pathToData,metaInfo)
+        if(record is None):
+            record={"number":state["nextNumber"],"segments":{}}
+            state["nextNumber"]+=1
+            state["trips"][pathToData]=record
+        elif(not set(record["segments"]).issubset(keys)):
+            # data that is already burned in changed, the trip is drawn again
+            print("trip changed, drawing it again "+pathToData)
+            for tiles in record["segments"].values():
+                rebuildTiles.update(tiles)
+            record["segments"]={}
+        record["fingerprint"]=fingerprint
+        record["keys"]=keys
+        records.append((record,keys))
+        newSegments.append([nr for nr,key in enumerate(keys) if key not in record["segments"]])
+    print("new zoom segments: "+str(sum(len(segments) for segments in newSegments))+", tiles to render again: "+str(len(rebuildTiles)))
+
+    # load the new zoom segments and the burned ones that reach a tile which is rendered again
+    loaded=[]
+    for tripNr,((pathToData,pathToImg,metaInfo),(record,keys)) in enumerate(zip(trips,records)):
+        needed=set(newSegments[tripNr])
+        for nr,key in enumerate(keys):
+            if(key in record["segments"] and not rebuildTiles.isdisjoint(record["segments"][key])):
+                needed.add(nr)
+        if(len(needed)>0):
+            loaded.append((tripNr,loadMosaicTrip(coord,transformer,bottomleft,pixelSize,pathToData,pathToImg,metaInfo,
+                                                 cmap,settings,plan,sorted(needed))))
+
+    # pings to draw into every tile. Tiles that are rendered again get all loaded pings,
+    # the other tiles only the pings of the new zoom segments
+    tiles={tile:[] for tile in rebuildTiles}
+    segmentTiles=[{} for _ in trips]
+    for index,(tripNr,trip) in enumerate(loaded):
+        isNew=np.isin(trip[4],newSegments[tripNr])
+        windows,tilePings=assignTripToTiles(numberPixel,trip[:4],coord)
+        for window,pings in zip(windows,tilePings):
+            tile=_tileOfWindow(window,tilesX)
+            for nr in np.unique(trip[4][pings[isNew[pings]]]):
+                segmentTiles[tripNr].setdefault(int(nr),[]).append(tile)
+            if(tile not in rebuildTiles):
+                pings=pings[isNew[pings]]
+            if(len(pings)>0):
+                tiles.setdefault(tile,[]).append((index,pings))
+    order=sorted(tiles)
+    windows=[_windowOfTile(tile,tilesX,numberPixel) for tile in order]
+    print("mosaic tiles to render: "+str(len(windows)))
+
+    # render the tiles and write them to the geotif, tiles without data stay empty
+    if(rebuild):
+        if(crs is None):
+            geoTif=utils.openGeoTif(pathToOut,coord,width,height)
+        else:
+            transform=rasterio.transform.from_origin(bottomleft[0],bottomleft[1]+height*pixelSize[1],pixelSize[0],pixelSize[1])
+            geoTif=utils.openGeoTif(pathToOut,coord,width,height,crs=crs,transform=transform)
+        utils.addOverviews(geoTif)
+    else:
+        geoTif=utils.updateGeoTif(pathToOut)
+    workerData=(numberPixel,[trip[:4] for _,trip in loaded],coord,[records[tripNr][0]["number"] for tripNr,_ in loaded])
+    if(settings.workers>1 and len(windows)>1):
+        executor=concurrent.futures.ProcessPoolExecutor(max_workers=settings.workers,
+                                                        initializer=_initMergeWorker,initargs=workerData)
+    else:
+        executor=None
+        _initMergeWorker(*workerData)
+    # the tiles are handed out in small groups, so only a few tiles are in memory at the same time
+    group=max(1,2*settings.workers)
+    with geoTif:
+        for start in range(0,len(windows),group):
+            groupTiles=order[start:start+group]
+            groupWindows=windows[start:start+group]
+            bases=[]
+            baseValues=[]
+            for tile,window in zip(groupTiles,groupWindows):
+                if(tile in rebuildTiles or rebuild):
+                    bases.append(None)
+                    baseValues.append(None)
+                else:
+                    bases.append(utils.readGeoTifWindow(geoTif,window[0],height-window[3],window[2]-window[0],window[3]-window[1]))
+                    baseValues.append(mosaicStore.loadTileValue(pathToStore,tile,bases[-1].shape[:2]))
+            tripPings=[tiles[tile] for tile in groupTiles]
+            if(executor is not None):
+                results=executor.map(_renderMergedTile,groupWindows,tripPings,bases,baseValues)
+            else:
+                results=map(_renderMergedTile,groupWindows,tripPings,bases,baseValues)
+            for counter,(tile,window,(cvImage,value)) in enumerate(zip(groupTiles,groupWindows,results)):
+                utils.writeGeoTifWindow(geoTif,cvImage,window[0],height-window[3])
+                mosaicStore.storeTileValue(pathToStore,tile,value)
+                print("mosaic tile "+str(start+counter+1)+" out of "+str(len(windows)))
+    if(executor is not None):
+        executor.shutdown()
+    utils.updateOverviews(pathToOut,[(window[0],height-window[3],window[2]-window[0],window[3]-window[1]) for window in windows])
+
+    # record the burned zoom segments
+    for tripNr,(record,keys) in enumerate(records):
+        for nr in newSegments[tripNr]:
+            record["segments"][keys[nr]]=sorted(segmentTiles[tripNr].get(nr,[]))
+    mosaicStore.writeState(pathToStore,state)
+    print("saved mosaic "+pathToOut)
+    if(coord.webTiles!="none"):
+        # after an update only the web tiles above the changed mosaic tiles are produced again
+        changed=None if rebuild else [(window[0],height-window[3],window[2]-window[0],window[3]-window[1]) for window in windows]
+        webTiles.exportTiles(pathToOut,coord.webTiles,coord.pixelSizeMeters,coord.webMaxZoom,changed)
+
 # Georeference side scan sonar data. So called mosaic.
-# coord[in]       Coordinate window which should be processed    
-# pathToData[in]  Path to image csv files
-# pathToImg[in]   Path to single depth level folder
+# The mosaic is split into tiles, every ping is assigned to the tiles its swath reaches.
+# The tiles are rendered (with settings.workers>1 in parallel in several processes) and
+# written directly to a tiled geotif (GeoMosaic.tif) next to the data, so the memory needed
+# does not depend on the size of the area. If the mosaic already exists, only the zoom segments
+# that were added since the last run are drawn (see updateMosaic)
+# coord[in]       Coordinate window which should be processed
+# pathToData[in]  Path of the side scan channel (see segmentStore)
+# pathToImg[in]   Path to single depth level folder, used if settings.saveImages is set
 # pathToMeta[in]  Path to meta data
-# cmap[in]        Colour map 
-def mosaic(coord,pathToData,pathToImg,pathToMeta,cmap):
+# cmap[in]        Colour map
+# settings[in]    renderSettings, if None the default settings are used
+# plan[in]        viewPlan of the trip (see assembleImages), if given the rendered segments are shared with other views
+def mosaic(coord,pathToData,pathToImg,pathToMeta,cmap,settings=None,plan=None):
     print("####### mosaic processing #######")
-    
+    if(settings is None):
+        settings=dt.renderSettings()
+
     # get the meta information
     metaInfo=utils.readMetaInformation(pathToMeta)
     # we want to transfer from global coordinate system WGS84 = epsg4326
@@ -116,96 +899,24 @@ def mosaic(coord,pathToData,pathToImg,pathToMeta,cmap):
     print(max(metaInfo.sideLon))
     print(min(metaInfo.sideLon))
     Geocord=dt.Geocord(max(metaInfo.sideLat),min(metaInfo.sideLat),max(metaInfo.sideLon),min(metaInfo.sideLon))
-    localCoordSystem=utils.getLocalGeoCoordinateSystem(Geocord)
-    
-    print("Use local geo coordinate system: "+str(localCoordSystem))
-    transformer = Transformer.from_crs("epsg:4326", localCoordSystem)
-    #image border
-    bottomleft=transformer.transform(coord.south,coord.west)
-    topright=transformer.transform(coord.north,coord.east)
-    distance=np.subtract(topright,bottomleft)
-    print("distance "+ str(distance))
-    pixelSize=(coord.pixelSizeMeters,coord.pixelSizeMeters)
-    numberPixel=np.divide(distance,pixelSize)
-    numberPixel=(int(numberPixel[0]),int(numberPixel[1]))
-    print("number pixels "+str(numberPixel))
-    maxPixel=pow(2,16)
-    if(numberPixel[0]>maxPixel or numberPixel[1]>maxPixel):
-        sys.exit("Error too many pixels. Reduce area or resolution") 
-        
-    #get all files to process
-    allFiles=utils.sorted_alphanumeric(os.listdir(pathToData))
-        
-    #create an empty image    
-    cvImage = np.zeros((numberPixel[1],numberPixel[0],4), np.uint8)
-        
+    _,transformer=getMosaicTransformer(Geocord)
+    updateMosaic(coord,[(pathToData,pathToImg,metaInfo)],os.path.dirname(pathToData)+"/GeoMosaic.tif",cmap,settings,transformer,plan=plan)
 
-    #create images and generate property list
-    
-    propertyList=baseIm.generateImagesAndPropertyList(allFiles,pathToData,pathToImg,cmap)
-    for oneProp in propertyList:
-        indices=range(oneProp.startIndex,oneProp.startIndex+oneProp.frames,1)
-        pixInWidth=int(oneProp.maxRange/pixelSize[1])
-        #open image
-        imgPath=pathToImg+"/fig_"+oneProp.name+".png"
-        img=Image.open(imgPath)
-        newsize=(oneProp.frames,pixInWidth*2)
-        img=img.resize(newsize)
-        pixelsInputImg = img.load()
-                
-        prevPixPosList=[]
-        firstRound=True
-        
-        for index in indices:
-            #print("index "+str(index))
-            globalCoord=transformer.transform(metaInfo.sideLat[index],metaInfo.sideLon[index])
-            localCoord=np.subtract(globalCoord,bottomleft)
-            #print("local cord "+str(localCoord))
-            pixpos=(int(localCoord[0]/pixelSize[0]),int(localCoord[1]/pixelSize[1]))
-            heading=metaInfo.sideHeading[index]
-            imgInX=index-oneProp.startIndex
-            #print("heading " +str(heading))
-            pixPosList=[]
-            pixValList=[]
- 
-            for onePixel in range(-pixInWidth,pixInWidth,1):
-                pixInImage=sweepToImage(pixpos,heading,onePixel)
-                pixPosList.append(pixInImage)
-               
-                imgInY=onePixel+pixInWidth
-                #print("img in coord "+str(imgInX)+"  "+str(imgInY))
-                value=pixelsInputImg[imgInX,imgInY]
-                pixValList.append(value)
-            if(not firstRound):
-                for i in range(0,(pixInWidth-1),1):
-                    pos1=pixPosList[i]
-                    pos2=pixPosList[i+1]
-                    pos3=prevPixPosList[i]
-                    pos4=prevPixPosList[i+1]
-                    area = np.array( [pos1, pos2, pos3, pos4] )
-                    pixval=pixValList[i+1]
-                    pixvalWithAlpha=(pixval[0],pixval[1],pixval[2],255)
-                    cv2.drawContours(cvImage, [area], 0,pixvalWithAlpha , -1)
-                      
-                for i in range((pixInWidth-1),2*(pixInWidth-1),1):
-                    pos1=pixPosList[i]
-                    #print("pos1 " +str(pos1))
-                    pos2=pixPosList[i+1]
-                    pos3=prevPixPosList[i]
-                    pos4=prevPixPosList[i+1]
-                    area = np.array( [pos1, pos2, pos3, pos4] )
-                    pixval=pixValList[i+1]
-                    pixvalWithAlpha=(pixval[0],pixval[1],pixval[2],255)
-                    cv2.drawContours(cvImage, [area], 0, pixvalWithAlpha, -1)
-
-            firstRound=False
-            prevPixPosList=pixPosList.copy()
-    # close holes in the image
-    cvImage=closeHoles(cvImage)
-    # flip image
-    cvImage=cv2.flip(cvImage, 0)
-    # save image
-    outPath=os.path.dirname(pathToData)+"/MosaicCV.png"
-    cv2.imwrite(outPath, cvImage) 
-    # convert image to geotif
-    utils.convertToGeoTif(outPath,coord)
\ No newline at end of file
+# Georeference the side scan sonar data of several trips into one mosaic (MergedMosaic.tif).
+# All trips are projected into one local UTM grid which fits the area of the mosaic. Where trips
+# overlap the pixel is chosen with coord.mergeRule (see mergeValue). Like the mosaic of one trip
+# it is updated, only new zoom segments and trips are drawn (see updateMosaic)
+# coord[in]      Coordinate window and settings of the mosaic
+# trips[in]      list of (path of the side scan channel, path to single depth level folder, path to meta data)
+# pathToOut[in]  path of the merged geotif
+# cmap[in]       Colour map
+# settings[in]   renderSettings, if None the default settings are used
+def mergedMosaic(coord,trips,pathToOut,cmap,settings=None):
+    print("####### merged mosaic processing #######")
+    if(settings is None):
+        settings=dt.renderSettings()
+
+    # one grid for all trips, the coordinate system fits the area of the mosaic
+    localCoordSystem,transformer=getMosaicTransformer(coord)
+    trips=[(pathToData,pathToImg,utils.readMetaInformation(pathToMeta)) for pathToData,pathToImg,pathToMeta in trips]
+    updateMosaic(coord,trips,pathToOut,cmap,settings,transformer,crs=localCoordSystem)
@@ -0,0 +1,148 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from pathlib import Path
+
+import segmentStore
+
+##################################################
+# Persistent state of a mosaic
+# Every mosaic (for example GeoMosaic.tif) gets a
+# folder next to it (GeoMosaic.mosaic) that records
+# what is already burned into it:
+# - the parameters the mosaic was rendered with
+# - for every trip and zoom segment a key of its data
+#   and positions and the tiles it reaches
+# - for every trip a fingerprint of its segment store,
+#   so the keys only have to be computed again if the
+#   store or the positions changed
+# - for every tile the merge value of each pixel
+#   (see georef.mergeValue)
+# With this a new run only has to draw the zoom
+# segments that were added since the last run.
+##################################################
+
+stateName="state.json"
+
+# Returns the path of the store belonging to a mosaic
+# pathToMosaic[in] path of the geotif of the mosaic
+def storePath(pathToMosaic):
+    return os.path.splitext(pathToMosaic)[0]+".mosaic"
+
+# Returns the keys of all zoom segments of a side scan channel. A key changes if the
+# intensities or the positions of the pings of the segment change
+# pathToData[in] path of the side scan channel (see segmentStore)
+# metaInfo[in]   meta information of the trip
+# return: list with one key (hex string) per zoom segment
+def segmentKeys(pathToData,metaInfo):
+    lat=np.asarray(metaInfo.sideLat,dtype=np.float64)
+    lon=np.asarray(metaInfo.sideLon,dtype=np.float64)
+    heading=np.asarray(metaInfo.sideHeading,dtype=np.float64)
+    keys=[]
+    for segment in segmentStore.readStore(segmentStore.storePath(pathToData)):
+        prop=segment.properties
+        first=prop.startIndex
+        last=first+prop.frames
+        h=hashlib.blake2b(digest_size=20)
+        h.update(("frames="+str(prop.frames)+";pixelY="+str(prop.pixelY)+";minRange="+str(prop.minRange)+
+                  ";maxRange="+str(prop.maxRange)+";start="+str(first)).encode())
+        h.update(np.ascontiguousarray(segment.data))
+        for values in (lat,lon,heading):
+            h.update(np.ascontiguousarray(values[first:last]))
+        keys.append(h.hexdigest())
+    return keys
+
+# Returns a fingerprint of a side scan channel that is cheap to compute: the size, the modification
+# time and the header with the summary of the segment store and the positions of the pings.
+# As long as it is the same, the keys of the zoom segments are the same, see tripKeys
+# pathToData[in] path of the side scan channel (see segmentStore)
+# metaInfo[in]   meta information of the trip
+# return: fingerprint as string
+def channelFingerprint(pathToData,metaInfo):
+    path=segmentStore.storePath(pathToData)
+    info=os.stat(path)
+    h=hashlib.blake2b(digest_size=20)
+    with open(path,"rb") as f:
+        h.update(f.read(segmentStore.storeHeaderSize))
+    for values in (metaInfo.sideLat,metaInfo.sideLon,metaInfo.sideHeading):
+        h.update(np.ascontiguousarray(values,dtype=np.float64))
+    return str(info.st_size)+"-"+str(info.st_mtime_ns)+"-"+h.hexdigest()
+
+# Returns the keys of the zoom segments of a trip. They are taken from the record of the trip
+# if the fingerprint of the channel did not change, only otherwise the data of the segments is read
+# record[in]     record of the trip in the state (see readState), None for a new trip
+# pathToData[in] path of the side scan channel (see segmentStore)
+# metaInfo[in]   meta information of the trip
+# return: list of keys (see segmentKeys), fingerprint (see channelFingerprint)
+def tripKeys(record,pathToData,metaInfo):
+    fingerprint=channelFingerprint(pathToData,metaInfo)
+    if(record is not None and record.get("fingerprint")==fingerprint):
+        return record["keys"], fingerprint
+    return segmentKeys(pathToData,metaInfo), fingerprint
+
+# Reads the state of a mosaic: the parameters, for every trip its number and for every zoom segment
+# the tiles it reaches
+# pathToStore[in] path of the store, see storePath
+# return: dictionary, empty if there is no state
+def readState(pathToStore):
+    path=pathToStore+"/"+stateName
+    if(not os.path.exists(path)):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        # broken state, the mosaic is rendered again
+        return {}
+
+# Writes the state of a mosaic, see readState
+# pathToStore[in] path of the store, see storePath
+# state[in]       dictionary to write
+def writeState(pathToStore,state):
+    Path(pathToStore).mkdir(parents=True, exist_ok=True)
+    path=pathToStore+"/"+stateName
+    tmpPath=path+".tmp"
+    with open(tmpPath,"w") as f:
+        json.dump(state,f)
+    os.replace(tmpPath,path)
+
+# Removes the state and all tiles of a store, used before the mosaic is rendered again completely
+# pathToStore[in] path of the store, see storePath
+def clearStore(pathToStore):
+    if(os.path.exists(pathToStore)):
+        shutil.rmtree(pathToStore)
+
+# Returns the path of the merge values of a tile
+def _tilePath(pathToStore,tile):
+    return pathToStore+"/tile_"+str(tile)+".npz"
+
+# Loads the merge values of a tile
+# pathToStore[in] path of the store, see storePath
+# tile[in]        number of the tile
+# shape[in]       shape of the tile (rows, columns)
+# return: merge value of every pixel of the tile, -inf for pixels without data
+def loadTileValue(pathToStore,tile,shape):
+    path=_tilePath(pathToStore,tile)
+    if(not os.path.exists(path)):
+        return np.full(shape,-np.inf)
+    with np.load(path) as data:
+        return data["value"].astype(np.float64)
+
+# Stores the merge values of a tile, tiles without data are removed
+# pathToStore[in] path of the store, see storePath
+# tile[in]        number of the tile
+# value[in]       merge value of every pixel of the tile, see loadTileValue
+def storeTileValue(pathToStore,tile,value):
+    path=_tilePath(pathToStore,tile)
+    if(not np.isfinite(value).any()):
+        if(os.path.exists(path)):
+            os.remove(path)
+        return
+    Path(pathToStore).mkdir(parents=True, exist_ok=True)
+    # without data the file is mostly -inf, which compresses well
+    tmpPath=path+".tmp"
+    with open(tmpPath,"wb") as f:
+        np.savez_compressed(f,value=value.astype(np.float32))
+    os.replace(tmpPath,path)
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from pathlib import Path
+
+##################################################
+# Cache for the rendered images of the zoom segments
+# Only used for the slow contour rendering, the raster
+# rendering is faster than reading an image from disk.
+# The images are stored uncompressed (.npy), so reading
+# them is not slower than the raw segment data.
+# The images are stored under a key built from the
+# content of the segment and the render parameters.
+# If the data or a parameter changes, the key changes
+# and the segment is rendered again. A manifest per
+# trip folder keeps track of the size and the last use
+# of every image, the least recently used images are
+# removed when the cache gets too big.
+##################################################
+
+manifestName="manifest.json"
+
+# Returns the cache key of a segment
+# data[in]     intensities of the segment
+# cmap[in]     colour map
+# settings[in] renderSettings
+# return: key as hex string
+def segmentKey(data,cmap,settings):
+    data=np.ascontiguousarray(data)
+    # everything that changes the rendered image goes into the key
+    parameters="cmap="+cmap
+    if(cmap!="self"):
+        # the own colour map ignores the render mode
+        parameters+=";mode="+settings.mode+";smoothing="+str(settings.smoothing)
+    parameters+=";shape="+str(data.shape)+";dtype="+str(data.dtype)
+    h=hashlib.blake2b(digest_size=20)
+    h.update(parameters.encode())
+    h.update(data)
+    return h.hexdigest()
+
+# Returns the path of a cached image
+def _imagePath(cachePath,key):
+    return cachePath+"/"+key+".npy"
+
+# Loads an image from the cache
+# cachePath[in] cache folder
+# key[in]       key of the segment, see segmentKey
+# return: rgb image as numpy array or None if it is not cached, size of the cached file in bytes
+def loadImage(cachePath,key):
+    path=_imagePath(cachePath,key)
+    if(not os.path.exists(path)):
+        return None, 0
+    return np.load(path), os.path.getsize(path)
+
+# Stores an image in the cache. The manifest is not touched, see updateManifest
+# cachePath[in] cache folder
+# key[in]       key of the segment, see segmentKey
+# image[in]     rgb image as numpy array
+# return: size of the cached file in bytes
+def storeImage(cachePath,key,image):
+    Path(cachePath).mkdir(parents=True, exist_ok=True)
+    path=_imagePath(cachePath,key)
+    # several processes may render the same segment, so write to a unique file and rename it
+    tmpPath=path+"."+str(os.getpid())+".tmp"
+    with open(tmpPath,"wb") as f:
+        np.save(f,np.ascontiguousarray(image))
+    os.replace(tmpPath,path)
+    return os.path.getsize(path)
+
+# Reads the manifest of a cache folder
+def _readManifest(cachePath):
+    path=cachePath+"/"+manifestName
+    if(not os.path.exists(path)):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        # broken manifest, the images get registered again when they are used
+        return {}
+
+# Registers the used images in the manifest and removes the least recently used
+# images if the cache is bigger than allowed
+# cachePath[in]  cache folder
+# usedImages[in] dictionary key -> size in bytes of the images used in this run
+# maxSizeMB[in]  maximum size of the cache in MB
+def updateManifest(cachePath,usedImages,maxSizeMB):
+    if(len(usedImages)==0):
+        return
+    Path(cachePath).mkdir(parents=True, exist_ok=True)
+    manifest=_readManifest(cachePath)
+    now=time.time()
+    for key,size in usedImages.items():
+        manifest[key]={"size":size,"lastUsed":now}
+
+    # evict the least recently used images
+    maxSize=maxSizeMB*1024*1024
+    totalSize=sum(entry["size"] for entry in manifest.values())
+    for key in sorted(manifest,key=lambda k: manifest[k]["lastUsed"]):
+        if(totalSize<=maxSize):
+            break
+        if(key in usedImages):
+            # never remove images of the current run
+            continue
+        totalSize-=manifest[key]["size"]
+        del manifest[key]
+        path=_imagePath(cachePath,key)
+        if(os.path.exists(path)):
+            os.remove(path)
+
+    tmpPath=cachePath+"/"+manifestName+".tmp"
+    with open(tmpPath,"w") as f:
+        json.dump(manifest,f)
+    os.replace(tmpPath,cachePath+"/"+manifestName)
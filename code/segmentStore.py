@@ -0,0 +1,245 @@
+import os
+import functools
+import numpy as np
+import pandas as pd
+
+import datatypes as dt
+import utilities as utils
+
+##################################################
+# Binary storage of the zoom segments of one channel
+# All segments of a channel are stored in one file.
+# The header holds the properties of each segment,
+# followed by the raw intensity matrices (uint8 or uint16).
+# Reading maps the file into memory, so only the parts
+# that are used get loaded.
+# The header and the segment table form the index of
+# the channel. They are written once during the import
+# and can be queried without touching the intensities.
+#
+# file layout:
+# magic (8 bytes) | version (uint32) | number of segments (uint32) | channel summary (see summaryDtype) | padding to 64 bytes
+# segment table (one record per segment, see segmentRecordDtype)
+# data of each segment, starting at a multiple of 64 bytes
+##################################################
+
+storeMagic=b"SONARSEG"
+storeVersion=2
+storeHeaderSize=64
+storeAlignment=64
+
+# summary of all segments of a channel, stored in the header
+summaryDtype=np.dtype([('framesTotal','<u8'),
+                       ('maxRange','<f8'),
+                       ('minRange','<f8'),
+                       ('finestRes','<f8')])
+
+# one entry in the segment table
+segmentRecordDtype=np.dtype([('name','S16'),
+                             ('frames','<u4'),
+                             ('pixelY','<u4'),
+                             ('minRange','<f8'),
+                             ('maxRange','<f8'),
+                             ('itemSize','<u1'),
+                             ('offset','<u8'),
+                             ('startIndex','<u8')])
+
+# Returns the path of the store belonging to a channel
+# pathToData[in] path of the channel (for example trip/Downscan)
+def storePath(pathToData):
+    return pathToData+".seg"
+
+# Rounds up to the next aligned position
+def _align(position):
+    return (position+storeAlignment-1)//storeAlignment*storeAlignment
+
+# Computes the channel summary of a segment table
+# table[in] segment table
+# return: summary as record of summaryDtype
+def _summarize(table):
+    summary=np.zeros((),dtype=summaryDtype)
+    if(len(table)==0):
+        return summary
+    summary['framesTotal']=table['frames'].sum()
+    summary['maxRange']=table['maxRange'].max()
+    summary['minRange']=table['maxRange'].min()
+    summary['finestRes']=(table['maxRange']/table['pixelY']).min()
+    return summary
+
+# Writes all zoom segments of one channel to a store file
+# The data of the segments is written one after another, so only one segment
+# has to be in memory at a time
+# pathToStore[in] path of the store file
+# segments[in]    list of segmentData
+def writeStore(pathToStore,segments):
+    table=np.zeros(len(segments),dtype=segmentRecordDtype)
+    startIndex=0
+    tableEnd=storeHeaderSize+table.nbytes
+    # write to a temporary file first, so an interrupted run does not leave a broken store
+    tmpPath=pathToStore+".tmp"
+    with open(tmpPath,"wb") as f:
+        f.write(b"\0"*_align(tableEnd))
+        for i,segment in enumerate(segments):
+            data=np.asarray(segment.getData())
+            dtype=np.uint8 if data.size==0 or data.max()<256 else np.uint16
+            data=np.ascontiguousarray(data,dtype=dtype)
+            offset=f.tell()
+            f.write(data.tobytes())
+            f.write(b"\0"*(_align(f.tell())-f.tell()))
+
+            prop=segment.properties
+            table[i]=(str(prop.name).encode(),data.shape[1],data.shape[0],
+                      prop.minRange,prop.maxRange,data.itemsize,offset,startIndex)
+            startIndex+=data.shape[1]
+        # header and segment table at the beginning of the file
+        f.seek(0)
+        f.write(storeMagic)
+        f.write(np.array([storeVersion,len(segments)],dtype='<u4').tobytes())
+        f.write(_summarize(table).tobytes())
+        f.seek(storeHeaderSize)
+        f.write(table.tobytes())
+    os.replace(tmpPath,pathToStore)
+
+# Reads the header of a store
+# f[in]           opened store file
+# pathToStore[in] path of the store file, used for error messages
+# return: number of segments, summary
+def _readHeader(f,pathToStore):
+    header=f.read(16+summaryDtype.itemsize)
+    if(header[:8]!=storeMagic):
+        raise ValueError("not a segment store: "+pathToStore)
+    version, count=np.frombuffer(header[8:16],dtype='<u4')
+    if(version!=storeVersion):
+        raise ValueError("unsupported segment store version "+str(version)+": "+pathToStore)
+    summary=np.frombuffer(header[16:],dtype=summaryDtype)[0]
+    return int(count), summary
+
+# Reads the segment table of a store
+# pathToStore[in] path of the store file
+# return: numpy array with one record per segment
+def readSegmentTable(pathToStore):
+    with open(pathToStore,"rb") as f:
+        count, _=_readHeader(f,pathToStore)
+        f.seek(storeHeaderSize)
+        table=np.frombuffer(f.read(count*segmentRecordDtype.itemsize),dtype=segmentRecordDtype)
+    return table
+
+# Reads the summary of all segments of a channel. Only the header of the store is read
+# pathToStore[in] path of the store file
+# return: assembleProperties of the channel
+def readSummary(pathToStore):
+    with open(pathToStore,"rb") as f:
+        _, summary=_readHeader(f,pathToStore)
+    assembleProp=dt.assembleProperties()
+    if(summary['framesTotal']>0):
+        assembleProp.maxDept=float(summary['maxRange'])
+        assembleProp.minDept=float(summary['minRange'])
+        assembleProp.finestRes=float(summary['finestRes'])
+        assembleProp.framesTotal=int(summary['framesTotal'])
+    assembleProp.yRes=int(assembleProp.maxDept/assembleProp.finestRes)
+    return assembleProp
+
+# Converts one record of the segment table to segment properties
+def _recordToProperties(record):
+    properties=dt.dataProperties()
+    properties.name=record['name'].decode()
+    properties.frames=int(record['frames'])
+    properties.pixelY=int(record['pixelY'])
+    properties.minRange=float(record['minRange'])
+    properties.maxRange=float(record['maxRange'])
+    properties.startIndex=int(record['startIndex'])
+    return properties
+
+# Reads only the properties of all segments of a store. The intensities are not touched
+# pathToStore[in] path of the store file
+# return: list of dataProperties
+def readProperties(pathToStore):
+    return [_recordToProperties(record) for record in readSegmentTable(pathToStore)]
+
+# Creates a segment whose data is a memory mapped view into the store
+# raw[in]         whole store file memory mapped as uint8
+# pathToStore[in] path of the store file
+# index[in]       position of the segment in the store
+# record[in]      record of the segment in the segment table
+# return: segmentData
+def _mapSegment(raw,pathToStore,index,record):
+    segment=dt.segmentData()
+    segment.properties=_recordToProperties(record)
+    segment.storePath=pathToStore
+    segment.index=index
+    dtype=np.uint8 if record['itemSize']==1 else np.uint16
+    offset=int(record['offset'])
+    size=int(record['frames'])*int(record['pixelY'])*int(record['itemSize'])
+    segment.data=raw[offset:offset+size].view(dtype).reshape(int(record['pixelY']),int(record['frames']))
+    return segment
+
+# Opens a store. The data of the segments are memory mapped views into the file
+# pathToStore[in] path of the store file
+# return: list of segmentData
+def readStore(pathToStore):
+    table=readSegmentTable(pathToStore)
+    if(len(table)==0):
+        return []
+    raw=np.memmap(pathToStore,dtype=np.uint8,mode='r')
+    return [_mapSegment(raw,pathToStore,index,record) for index,record in enumerate(table)]
+
+# Opens a single segment of a store. Only its record of the segment table is read,
+# so the cost does not depend on the number of segments in the store
+# pathToStore[in] path of the store file
+# index[in]       position of the segment in the store
+# return: segmentData, the data is a memory mapped view into the file
+def readSegment(pathToStore,index):
+    with open(pathToStore,"rb") as f:
+        count, _=_readHeader(f,pathToStore)
+        if(index<0 or index>=count):
+            raise IndexError("segment "+str(index)+" not in store: "+pathToStore)
+        f.seek(storeHeaderSize+index*segmentRecordDtype.itemsize)
+        record=np.frombuffer(f.read(segmentRecordDtype.itemsize),dtype=segmentRecordDtype)[0]
+    raw=np.memmap(pathToStore,dtype=np.uint8,mode='r')
+    return _mapSegment(raw,pathToStore,index,record)
+
+# This function extracts the properties of a single image csv file
+# data[in]           pandas csv file
+# properties[in,out] properties of this file
+def fillProperties(data,properties):
+    numberOfLines=len(data)
+    properties.frames=len(data.columns)-1
+    properties.pixelY=numberOfLines-3
+    lastCell=data.iloc[numberOfLines-1]["Unnamed: 0"]
+    splitCell=lastCell.split(" ")
+    properties.minRange=float(splitCell[1])
+    properties.maxRange=float(splitCell[2])
+    #print(str(properties.frames)+"X"+str(properties.pixelY))
+
+# Reads one image csv file written by the R preprocessing
+# path[in]        path to the image csv file
+# segment[in,out] segment, its properties get filled
+# return: intensities of the segment
+def readImageCsv(path,segment):
+    data = pd.read_csv(path,header=0, dtype=str)
+    fillProperties(data,segment.properties)
+    data = data[:-1]
+    data = data.drop('Unnamed: 0', axis = 1)
+    data = data.dropna()
+    data = data.astype(int)
+    return data.values[:segment.properties.pixelY]
+
+# Converts the image csv files of the R preprocessing of one channel to a store
+# pathToData[in] path to the folder with the image csv files
+# overwrite[in]  convert even if the store already exists
+def importCsvFolder(pathToData,overwrite):
+    pathToStore=storePath(pathToData)
+    if(not os.path.isdir(pathToData) or (os.path.exists(pathToStore) and not overwrite)):
+        return
+    print("convert image csv files of "+pathToData)
+    allFiles=utils.sorted_alphanumeric(os.listdir(pathToData))
+    segments=[]
+    for file in allFiles:
+        res1=file.find("_")
+        res2=file.find(".")
+        # the csv file is only parsed when the store is written
+        segment=dt.segmentData()
+        segment.loader=functools.partial(readImageCsv,pathToData+"/"+file,segment)
+        segments.append(segment)
+        segment.properties.name=file[res1+1:res2]
+    writeStore(pathToStore,segments)
@@ -1,14 +1,13 @@
 import os
+import sys
 import cv2
-import keras
+import json
 import numpy as np
 import matplotlib.pyplot as plt
-import albumentations as A
-from tensorflow.keras.callbacks import TensorBoard
-import tensorflow as tf
-import segmentation_models as sm
 import math
 
+import datatypes as dt
+
 # define colours for the different classes
 fishCol=(0,255,0)
 vegbigCol=(255,100,0)
@@ -49,82 +48,91 @@ def generateColourOverlayThreshold(mask):
 
 
 
+# colours of the classes in the order of the channels of the network output
+classColours=np.array([backgroundCol,groundCol,vegsmallCol,vegbigCol,fishCol], np.uint8)
+classNames=["background","ground","vegsmall","vegbig","fish"]
+
 def generateColourOverlayMax(mask):
     """
     Generates an overlay mask where the classes are coloured
-    The maximal class value is used to determine colouration
-    """
-    # split the mask into its layes, representing the different classes
-    background=mask[..., 0].squeeze()
-    ground=mask[..., 1].squeeze()
-    vegsmall=mask[..., 2].squeeze()
-    vegbig=mask[..., 3].squeeze()
-    fish=mask[..., 4].squeeze()
-
-    cv2.imwrite("background.jpg", background)
-    cv2.imwrite("ground.jpg", ground)
-    cv2.imwrite("vegsmall.jpg", vegsmall)
-    cv2.imwrite("vegbig.jpg", vegbig)
-    cv2.imwrite("fish.jpg", fish)
+    The maximal class value is used to determine colouration. If several classes
+    have the same value the last one wins
 
-    threshold=0.2
-
-    mask_dim = mask.shape
-    overlay = np.zeros((model_patch_size[0],model_patch_size[1],3), np.uint8)
-    overlay.fill(0)
-
-    # for each class create a list array where it has the highes value
-    listOfMaks=[background,ground,vegsmall,vegbig,fish]
-    def compareMasks(currentMask, pos):
-        if(pos<len(listOfMaks)):
-            return np.logical_and(np.greater_equal(currentMask, listOfMaks[pos]), compareMasks(currentMask, pos+1))
-        else:
-            return np.ones((model_patch_size[0],model_patch_size[1]))
-    backgroundBiggest=compareMasks(background,0)
-    groundBiggest=compareMasks(ground,0)
-    vegsmallBiggest=compareMasks(vegsmall,0)
-    vegbigBiggest=compareMasks(vegbig,0)
-    fishBiggest=compareMasks(fish,0)
-
-    # colour the areas of the highest value with the corresponding colour
-    overlay[backgroundBiggest] = backgroundCol
-    overlay[groundBiggest] = groundCol
-    overlay[vegsmallBiggest] = vegsmallCol
-    overlay[vegbigBiggest] = vegbigCol
-    overlay[fishBiggest] = fishCol
+    Args:
+        mask: class probabilities with the classes in the last axis
+    """
+    mask=mask[..., :len(classColours)]
+    # index of the biggest class, searched from the end so the last class wins on equal values
+    biggest=mask.shape[-1]-1-np.argmax(mask[..., ::-1], axis=-1)
+    return classColours[biggest]
 
-    overlay= cv2.resize(overlay, patch_size, interpolation = cv2.INTER_AREA)
-    return overlay
+def preprocessTiles(tiles, preprocess_input):
+    """
+    Prepares a batch of tiles for the network: resizes them to the size the model
+    was trained on, converts them to RGB and applies the preprocessing of the backbone
+    to the whole batch at once
+    """
+    batch = np.stack([cv2.resize(tile, model_patch_size, interpolation = cv2.INTER_AREA) for tile in tiles])
+    batch = np.ascontiguousarray(batch[..., ::-1])
+    return preprocess_input(batch)
 
-def extract_background_mask(mask):
+def tilePositions(length: int, tilesize: int, overlap: int):
     """
-    Extracts the background mask for background supression
+    Returns the start positions of the tiles along one axis. The tiles overlap by at
+    least overlap pixels and the last tile ends at the end of the image
     """
-    background=mask[..., 0].squeeze()
-    background= cv2.resize(background, patch_size, interpolation = cv2.INTER_AREA)
-    overlay = np.expand_dims(background, axis=2)
-    return overlay
+    stride = max(tilesize-overlap, 1)
+    lastStart = max(length-tilesize, 0)
+    positions = list(range(0, lastStart, stride))
+    positions.append(lastStart)
+    return positions
 
-def preprocess(imageRaw,preprocessingFu):
-    image= cv2.resize(imageRaw, model_patch_size, interpolation = cv2.INTER_AREA)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    sample = preprocessingFu(image=image)
-    image = sample['image']
-    image = np.expand_dims(image, axis=0)
-    return image
+def tileWeight(tilesize: int, overlap: int):
+    """
+    Weight of every pixel of a tile for blending overlapping tiles. It rises
+    linearly over the overlap towards the middle of the tile, so seams fade out
+    """
+    ramp = np.arange(tilesize, dtype=np.float32)+0.5
+    ramp = np.minimum(np.minimum(ramp, tilesize-ramp)/max(overlap, 1), 1.0)
+    return np.outer(ramp, ramp)
 
-def get_preprocessing(preprocessing_fn):   
-    _transform = [
-        A.Lambda(image=preprocessing_fn),
-    ]
-    return A.Compose(_transform)
+def tileBatches(img, positions, batchSize: int, preprocess_input):
+    """
+    Cuts the tiles at the given positions out of the image and yields them in
+    preprocessed batches, so only one batch is in memory at a time
+    """
+    tilesize = patch_size[0]
+    for start in range(0, len(positions), batchSize):
+        batchPositions = positions[start:start+batchSize]
+        tiles = [img[y:y+tilesize, x:x+tilesize] for x,y in batchPositions]
+        yield batchPositions, preprocessTiles(tiles, preprocess_input)
 
-def tileImage(imgPath: str, model, preprocess_input):
+def finishColumns(probabilities, weights, count: int):
+    """
+    Finishes the first count columns of the blended probabilities, no later tile reaches
+    them: divides them by the sum of the weights and creates the coloured overlay (black where
+    nothing was predicted), the background probability and the probability of every class,
+    all as uint8 (probability 1 = 255)
     """
-    This function reads the image, cuts it into tiles, prepares these tiles
-    feeds them into the segmentation network and creates a class based coloured 
-    overlay
+    probabilities = probabilities[:, :count]
+    weights = weights[:, :count]
+    covered = weights > 0
+    probabilities[covered] /= weights[covered][..., None]
+    overlay = generateColourOverlayMax(probabilities)
+    overlay[~covered] = 0
+    classImages = np.clip(np.round(probabilities*255), 0, 255).astype(np.uint8)
+    return overlay, classImages
+
+def tileImage(imgPath: str, model, preprocess_input, settings=None):
     """
+    This function reads the image, cuts it into overlapping tiles, feeds them in batches
+    into the segmentation network and blends the predicted tiles into one probability map.
+    From this the class based coloured overlay and the background mask are created.
+    The tiles are predicted column by column. The probabilities are only kept for the columns
+    the current tiles reach, all columns left of them are finished and converted to uint8
+    """
+    if(settings is None):
+        settings = dt.segmentationSettings()
     # check if image path exsists
     if(not os.path.isfile(imgPath)):
         print("path to image does not exsit. I will quit the programm")
@@ -138,29 +146,58 @@ def tileImage(imgPath: str, model, preprocess_input):
     newShape[0] = math.ceil((initialImageShape[0]/tilesize)+1)*tilesize
     newShape[1] = math.ceil((initialImageShape[1]/tilesize)+1)*tilesize
     imgOrig = np.zeros((newShape[0],newShape[1],3), np.uint8)
-    imgOrig[0:initialImageShape[0],0:initialImageShape[1],0:3] = img.copy()
+    imgOrig[0:initialImageShape[0],0:initialImageShape[1],0:3] = img
+    del img
 
-    # coloured overlay visualizing classes
+    # results of the finished columns: coloured overlay, background probability and
+    # for debugging the probability of every class
+    numberClasses = 5
     label_overlay = np.zeros((newShape[0],newShape[1],3), np.uint8)
-    # maks of the background
-    background_mask = np.zeros((newShape[0],newShape[1],1), np.float32)
-
-    # loop over the image, cut it in tiles, predict each tile (segmentation) and 
-    # assemble the predicted tiles back to a full image
-    h, w = newShape
-    for i in range(0,w-tilesize,tilesize):
-        for j in range(0,h-tilesize,tilesize):
-            # get a tile
-            cropped_image = imgOrig[j:j+tilesize, i:i+tilesize]
-            # preprocess the image
-            imgPre=preprocess(cropped_image,get_preprocessing(preprocess_input))
-            # feed it into the network and predict the output
-            mask=model.predict(imgPre)
-            # generate the coloured overlay
-            overlay=generateColourOverlayMax(mask)
-            label_overlay[j:j+tilesize, i:i+tilesize]=overlay
-            # extract the background mask
-            background_mask[j:j+tilesize, i:i+tilesize]=extract_background_mask(mask)
+    background_mask = np.zeros((newShape[0],newShape[1]), np.uint8)
+    debugImages = np.zeros((newShape[0],newShape[1],numberClasses), np.uint8) if settings.debugImages else None
+
+    # sum of the weighted class probabilities of all tiles and sum of the weights, for the
+    # columns bufferStart to bufferStart+tilesize. Tiles start at bufferStart or right of it
+    probabilities = np.zeros((newShape[0],tilesize,numberClasses), np.float32)
+    weights = np.zeros((newShape[0],tilesize), np.float32)
+    bufferStart = 0
+    weight = tileWeight(tilesize, settings.overlap)
+
+    def finish(count):
+        overlay, classImages = finishColumns(probabilities, weights, count)
+        label_overlay[:, bufferStart:bufferStart+count] = overlay
+        background_mask[:, bufferStart:bufferStart+count] = classImages[..., 0]
+        if(debugImages is not None):
+            debugImages[:, bufferStart:bufferStart+count] = classImages
+        # move the remaining columns to the start of the buffer
+        probabilities[:, :tilesize-count] = probabilities[:, count:].copy()
+        probabilities[:, tilesize-count:] = 0
+        weights[:, :tilesize-count] = weights[:, count:].copy()
+        weights[:, tilesize-count:] = 0
+
+    # cut the image in overlapping tiles, predict them batch by batch and blend them into the probability map
+    positions = [(x,y) for x in tilePositions(initialImageShape[1], tilesize, settings.overlap)
+                       for y in tilePositions(initialImageShape[0], tilesize, settings.overlap)]
+    print("predict "+str(len(positions))+" tiles")
+    for batchPositions, batch in tileBatches(imgOrig, positions, settings.batchSize, preprocess_input):
+        masks = model.predict_on_batch(batch)
+        for (x,y), mask in zip(batchPositions, np.asarray(masks)):
+            if(x > bufferStart):
+                # no later tile reaches the columns left of this tile
+                finish(x-bufferStart)
+                bufferStart = x
+            mask = cv2.resize(mask[..., :numberClasses], patch_size, interpolation = cv2.INTER_LINEAR)
+            probabilities[y:y+tilesize, x-bufferStart:x-bufferStart+tilesize] += mask*weight[..., None]
+            weights[y:y+tilesize, x-bufferStart:x-bufferStart+tilesize] += weight
+    while(bufferStart < newShape[1]):
+        count = min(tilesize, newShape[1]-bufferStart)
+        finish(count)
+        bufferStart += count
+
+    if(debugImages is not None):
+        for index,name in enumerate(classNames):
+            cv2.imwrite(os.path.dirname(imgPath)+"/"+name+".jpg", debugImages[..., index])
+    # background_mask is the probability of the background as uint8, 255 = background
     return imgOrig, label_overlay, background_mask
 
 def printLegend(image):
@@ -202,44 +239,99 @@ def printLegend(image):
     image = cv2.putText(image, 'Background', (int(boxStart[0]+boxWidth*1.2),int(boxStart[1]+boxWidth*0.7)), cv2.FONT_HERSHEY_SIMPLEX, 2, (0,0,0), 2, cv2.LINE_AA)
     return image
 
-def softenBackgroundMask(maskOverlay):
+# transparency of the background at the borders of the mask, one step per erosion
+softenSteps = np.arange(0.9,0.1,-0.1)
+# rows above and below a strip the background mask depends on: the closing (2+2) and 2 per erosion
+maskHalo = 4+2*len(softenSteps)
+# rows above and below a strip the blurred background depends on
+blurHalo = 9
+
+def softenBackgroundMask(maskOverlay, first=0, last=None):
     """
     This function does not remove the background completly since this would hide a mistake the segmentation made
     but instead it blurrs and darkens the background.
+    Only the rows first to last are returned. The rows around them that the closing and
+    the erosions need are taken from maskOverlay, so the image can be processed in strips
+
+    Args:
+        maskOverlay: background probability of the whole image (2D, uint8 with 255 = background)
+        first (int): first row of the strip
+        last (int): row after the strip, None for the end of the image
     """
+    if(last is None):
+        last = maskOverlay.shape[0]
+    start = max(0, first-maskHalo)
+    end = min(maskOverlay.shape[0], last+maskHalo)
     # close holes in mask background
     kernel = np.ones((5,5),np.float32)
-    maskOverlay=cv2.morphologyEx(maskOverlay, cv2.MORPH_CLOSE, kernel)
-    maskOverlay = np.expand_dims(maskOverlay, axis=2)
+    maskOverlay = cv2.morphologyEx(maskOverlay[start:end].astype(np.float32)/255, cv2.MORPH_CLOSE, kernel)
 
     # The mask gets fluffed to make the transition smooth
-    fluffyMask=1.0-maskOverlay
+    fluffyMask = 1.0-maskOverlay
     # loop over the transparency gradient and degrade the corners
-    for i in np.arange(0.9,0.1,-0.1):
-        kernel = np.ones((5,5),np.float32)
+    for i in softenSteps:
         maskOverlayNew = cv2.erode(maskOverlay,kernel,iterations = 1)
-        maskOverlayNew = np.expand_dims(maskOverlayNew, axis=2)
-        diff=(maskOverlay-maskOverlayNew)*i
+        diff = (maskOverlay-maskOverlayNew)*np.float32(i)
 
-        fluffyMask=cv2.max(fluffyMask,diff)
-        maskOverlay=maskOverlayNew
+        fluffyMask = np.maximum(fluffyMask,diff)
+        maskOverlay = maskOverlayNew
 
-    return np.expand_dims(fluffyMask, axis=2)
+    return fluffyMask[first-start:last-start]
 
-def createModel(pathToModel: str):
+def overlayLabels(image, imgLabel):
+    """
+    Overlays the coloured labels on the grayscaled image
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    return cv2.addWeighted(gray, 0.7, imgLabel, 0.3, 0.0)
+
+def suppressBackground(imgOrig, maskOverlay, first, last):
+    """
+    Blurs the background of the rows first to last and darkens it to blue, the
+    foreground stays as it is. The transition is smoothed with softenBackgroundMask
+    """
+    softBackgroundMask = softenBackgroundMask(maskOverlay, first, last)[..., None]
+    # the blur needs the rows around the strip
+    start = max(0, first-blurHalo)
+    end = min(imgOrig.shape[0], last+blurHalo)
+    blurredBackground = cv2.blur(imgOrig[start:end],(19,19))[first-start:last-start]
+    blueBackground = np.empty(blurredBackground.shape, np.uint8)
+    blueBackground[:] = backgroundCol
+    mixedBackground = cv2.addWeighted(blueBackground, 0.7, blurredBackground, 0.3, 0.0)
+    image = imgOrig[first:last]
+    return (image*softBackgroundMask+mixedBackground*(1-softBackgroundMask)).astype(np.uint8)
+
+# files of the model in the model folder: the keras weights and the models exported for the cpu runtimes
+modelFiles = {"keras": "seg3.h5", "onnx": "seg3.onnx", "tflite": "seg3.tflite"}
+# preprocessing of the exported models, written together with them
+modelInfoFile = "seg3.json"
+
+def createModel(pathToModel: str, threads: int = 0):
     """
     Sets up the model. The model needs to match the way it was trained, so
     don't change this parameters here.
+    Tensorflow and segmentation_models are only imported here, the exported
+    models don't need them.
 
     Args:
         pathToModel (str): path where the model is located in the file system
+        threads (int): number of threads tensorflow uses for one operation, 0 for the default
     """
+    import tensorflow as tf
+    import segmentation_models as sm
+    if(threads > 0):
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError:
+            print("tensorflow is already running, the number of threads can't be changed")
     # define the classes
     CLASSES = ['background', 'ground', 'vegsmall', 'vegbig', 'fish']
     # set the backbone
     BACKBONE = 'efficientnetb3'
     # model name
-    modelName = 'seg3.h5'
+    modelName = modelFiles["keras"]
     preprocess_input = sm.get_preprocessing(BACKBONE)
     # load best weights
     n_classes = 1 if len(CLASSES) == 1 else (len(CLASSES) + 1) 
@@ -249,42 +341,205 @@ def createModel(pathToModel: str):
 
     return model, preprocess_input
 
+class affinePreprocessing:
+    """
+    Preprocessing of the backbone as affine transformation per colour channel
+    (value * scale + offset). Used with the exported models instead of the
+    preprocessing function of segmentation_models
+    """
+    def __init__(self, scale, offset):
+        self.scale = np.asarray(scale, np.float32)
+        self.offset = np.asarray(offset, np.float32)
+
+    def __call__(self, batch):
+        return batch.astype(np.float32) * self.scale + self.offset
+
+def fitPreprocessing(preprocess_input):
+    """
+    Determines scale and offset per colour channel of the preprocessing function
+    of the backbone and checks that it really is an affine transformation
+
+    Args:
+        preprocess_input: preprocessing function of the backbone
+    """
+    # the preprocessing may change the array, so it always gets a copy
+    zero = preprocess_input(np.zeros((1, 1, 1, 3), np.float32)).reshape(3)
+    full = preprocess_input(np.full((1, 1, 1, 3), 255, np.float32)).reshape(3)
+    scale = (full - zero) / 255
+    probe = np.random.default_rng(0).uniform(0, 255, (1, 16, 16, 3)).astype(np.float32)
+    if(not np.allclose(preprocess_input(probe.copy()), probe * scale + zero, atol=1e-4)):
+        raise ValueError("the preprocessing of the backbone is not an affine transformation per channel")
+    return scale, zero
+
+class onnxModel:
+    """
+    Runs an exported ONNX model with onnxruntime on the cpu. Offers predict_on_batch
+    like the keras model
+    """
+    def __init__(self, path: str, threads: int = 0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        # 0 lets onnxruntime use all cores
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.inputName = self.session.get_inputs()[0].name
+
+    def predict_on_batch(self, batch):
+        return self.session.run(None, {self.inputName: batch.astype(np.float32)})[0]
+
+class tfliteModel:
+    """
+    Runs an exported TFLite model on the cpu. Uses tflite_runtime if it is installed,
+    otherwise the interpreter of tensorflow. Offers predict_on_batch like the keras model
+    """
+    def __init__(self, path: str, threads: int = 0):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=threads if threads > 0 else None)
+        self.inputIndex = self.interpreter.get_input_details()[0]["index"]
+        self.outputIndex = self.interpreter.get_output_details()[0]["index"]
+        self.shape = None
+
+    def predict_on_batch(self, batch):
+        # the last batch of an image can be smaller
+        if(batch.shape != self.shape):
+            self.interpreter.resize_tensor_input(self.inputIndex, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.shape = batch.shape
+        self.interpreter.set_tensor(self.inputIndex, batch.astype(np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.outputIndex).copy()
+
+def loadModel(pathToModel: str, backend: str = "keras", threads: int = 0):
+    """
+    Returns the model and the preprocessing function for one backend
+
+    Args:
+        pathToModel (str): path where the model is located in the file system
+        backend (str): "keras" for the keras weights, "onnx" or "tflite" for the exported models (see exportModel)
+        threads (int): number of threads for the prediction, 0 for the default of the runtime
+    """
+    if(backend == "keras"):
+        return createModel(pathToModel, threads)
+    if(backend not in modelFiles):
+        raise ValueError("unknown segmentation backend " + backend)
+    pathToExport = pathToModel + "/" + modelFiles[backend]
+    if(not os.path.exists(pathToExport)):
+        raise FileNotFoundError(pathToExport + " doesn't exist, export the model first: python segmentation.py " + pathToModel + " " + backend)
+    with open(pathToModel + "/" + modelInfoFile) as f:
+        info = json.load(f)
+    preprocess_input = affinePreprocessing(info["scale"], info["offset"])
+    if(backend == "onnx"):
+        return onnxModel(pathToExport, threads), preprocess_input
+    return tfliteModel(pathToExport, threads), preprocess_input
+
+def exportModel(pathToModel: str, modelFormat: str = "onnx", tolerance: float = 1e-3):
+    """
+    Exports the keras model once for a cpu runtime, so the segmentation runs without
+    tensorflow. The preprocessing of the backbone is saved next to it (seg3.json).
+    Afterwards the exported model is compared with the keras model on random tiles.
+    Needs tensorflow and segmentation_models, for ONNX additionally tf2onnx
+
+    Args:
+        pathToModel (str): path where the model is located in the file system
+        modelFormat (str): "onnx" or "tflite"
+        tolerance (float): largest allowed difference of the class probabilities
+    """
+    if(modelFormat not in ("onnx", "tflite")):
+        raise ValueError("unknown model format " + modelFormat)
+    import tensorflow as tf
+    model, preprocess_input = createModel(pathToModel)
+    pathToExport = pathToModel + "/" + modelFiles[modelFormat]
+    print("export segmentation model to " + pathToExport)
+    spec = tf.TensorSpec((None, model_patch_size[1], model_patch_size[0], 3), tf.float32, name="input")
+    if(modelFormat == "onnx"):
+        import tf2onnx
+        tf2onnx.convert.from_keras(model, input_signature=[spec], opset=13, output_path=pathToExport)
+    else:
+        function = tf.function(lambda batch: model(batch, training=False)).get_concrete_function(spec)
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([function], model)
+        with open(pathToExport, "wb") as f:
+            f.write(converter.convert())
+
+    scale, offset = fitPreprocessing(preprocess_input)
+    with open(pathToModel + "/" + modelInfoFile, "w") as f:
+        json.dump({"scale": scale.tolist(), "offset": offset.tolist(), "patchSize": list(model_patch_size),
+                   "classes": classNames}, f, indent=2)
+
+    # compare both models on random tiles
+    exported, _ = loadModel(pathToModel, modelFormat)
+    tiles = np.random.default_rng(0).integers(0, 256, (4, model_patch_size[1], model_patch_size[0], 3), dtype=np.uint8)
+    expected = np.asarray(model.predict_on_batch(preprocess_input(tiles.copy())))
+    result = exported.predict_on_batch(affinePreprocessing(scale, offset)(tiles))
+    difference = np.abs(expected - result).max()
+    changed = np.mean(np.argmax(expected, axis=-1) != np.argmax(result, axis=-1))
+    print("largest difference of the probabilities " + str(difference) + ", pixels with another class " + str(changed * 100) + "%")
+    if(difference > tolerance):
+        print("WARNING: the exported model differs from the keras model by more than " + str(tolerance))
+    return pathToExport
+
+# models that are already loaded, key is the path to the model, the backend and the number of threads
+_modelCache = {}
+
+def getModel(pathToModel: str, backend: str = "keras", threads: int = 0):
+    """
+    Returns the model and the preprocessing function, see loadModel. The model
+    is only created once per process, later calls return the same model
 
-def segmentImage(imgInPath: str):
+    Args:
+        pathToModel (str): path where the model is located in the file system
+        backend (str): "keras", "onnx" or "tflite"
+        threads (int): number of threads for the prediction, 0 for the default of the runtime
+    """
+    key = (os.path.abspath(pathToModel), backend, threads)
+    if(key not in _modelCache):
+        _modelCache[key] = loadModel(pathToModel, backend, threads)
+    return _modelCache[key]
+
+
+def segmentImage(imgInPath: str, settings=None):
     """
     Main method of image segmentation
 
     Args:
         imgInPath (str): path to the location of the CombinedImageNL image
+        settings (segmentationSettings): batch size and overlap of the tiles, None for the defaults
     """
     print("AI based image segmentation")
+    if(settings is None):
+        settings = dt.segmentationSettings()
     # create the model and the image preprocessing function
-    pathToModel = "models"
-    model, preprocessing_fu = createModel(pathToModel)
+    model, preprocessing_fu = getModel(settings.modelPath, settings.backend, settings.threads)
     # predict the image in tiles and reassemble them
-    imgOrig, imgLabel, maskOverlay = tileImage(imgInPath + "/CombinedImageNL.jpg" , model, preprocessing_fu)
+    imgOrig, imgLabel, maskOverlay = tileImage(imgInPath + "/CombinedImageNL.jpg" , model, preprocessing_fu, settings)
+
+    # the output images are computed in horizontal strips, so only one strip of the float
+    # arrays exists at a time. Each image is written when it is complete and its memory is reused
+    height = imgOrig.shape[0]
+    strips = [(first, min(first+settings.stripHeight, height)) for first in range(0, height, settings.stripHeight)]
+    output = np.empty(imgOrig.shape, np.uint8)
 
-    # create a background mask with softend corners
-    softBackgroundMask=softenBackgroundMask(maskOverlay)
-    
     # overlay the labels on the grayscaled image
-    gray = cv2.cvtColor(imgOrig, cv2.COLOR_BGR2GRAY)
-    gray = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-    addedImg = cv2.addWeighted(gray, 0.7, imgLabel, 0.3, 0.0)
-    addedImg=printLegend(addedImg)
-    cv2.imwrite(imgInPath+"/Segmented.jpg", addedImg) 
+    for first, last in strips:
+        output[first:last] = overlayLabels(imgOrig[first:last], imgLabel[first:last])
+    cv2.imwrite(imgInPath+"/Segmented.jpg", printLegend(output))
 
     # mask out backround
-    blurredBackground=cv2.blur(imgOrig,(19,19))
-    blueBackground = np.zeros(imgOrig.shape, np.uint8)
-    blueBackground[:]=(100,2,2)
-    mixedBackground=cv2.addWeighted(blueBackground, 0.7, blurredBackground, 0.3, 0.0)
-    imgCleaned=(imgOrig*softBackgroundMask+mixedBackground*(1-softBackgroundMask)).astype(np.uint8)
-    cv2.imwrite(imgInPath+"/Cleaned.jpg", imgCleaned)
+    for first, last in strips:
+        output[first:last] = suppressBackground(imgOrig, maskOverlay, first, last)
+    cv2.imwrite(imgInPath+"/Cleaned.jpg", output)
 
     # add labels to cleaned image
-    gray = cv2.cvtColor(imgCleaned, cv2.COLOR_BGR2GRAY)
-    imgCleanedGray = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
-    addedImgClean = cv2.addWeighted(imgCleanedGray, 0.7, imgLabel, 0.3, 0.0)
-    addedImgClean=printLegend(addedImgClean)
-    cv2.imwrite(imgInPath+"/CleanedSeg.jpg", addedImgClean)    
+    for first, last in strips:
+        output[first:last] = overlayLabels(output[first:last], imgLabel[first:last])
+    cv2.imwrite(imgInPath+"/CleanedSeg.jpg", printLegend(output))
+
+################### Main #####################
+
+# the model is exported with: python segmentation.py pathToModel onnx|tflite
+if __name__ == "__main__":
+    exportModel(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "onnx")
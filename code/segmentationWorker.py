@@ -0,0 +1,204 @@
+import os
+import sys
+import copy
+import time
+import tempfile
+import threading
+import subprocess
+import traceback
+from pathlib import Path
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import datatypes as dt
+
+##################################################
+# Worker process for the ai based image segmentation
+# Loading tensorflow and the model takes several seconds.
+# The worker is a separate process on this computer that
+# loads them once and then segments the images of many
+# trips and runs. The main program only sends the path
+# of the trip folder and waits for the answer, it never
+# imports tensorflow itself.
+# If no worker is running, the first request starts one.
+# It stops after some time without requests.
+# The connection unpickles what it receives, so only
+# processes of the same user may connect: every worker
+# creates a random key and writes it to a file that
+# only the user can read (~/.sonarMapper).
+# A request for another model than the one the worker
+# has loaded stops the worker and a new one is started.
+##################################################
+
+# seconds to wait for a new worker to load the model and accept requests
+workerStartTimeout=300
+
+# Returns the path of the file with the key of the worker on a port
+def keyPath(port):
+    return os.path.join(Path.home(),".sonarMapper","segmentationWorker_"+str(port)+".key")
+
+# Creates a random key for the worker on a port and writes it to a file only the user can read
+# return: key
+def writeAuthKey(port):
+    key=os.urandom(32)
+    path=keyPath(port)
+    os.makedirs(os.path.dirname(path),mode=0o700,exist_ok=True)
+    tmpPath=path+"."+str(os.getpid())+".tmp"
+    with os.fdopen(os.open(tmpPath,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o600),"wb") as f:
+        f.write(key)
+    os.replace(tmpPath,path)
+    return key
+
+# Connects to the worker on a port with the key from its key file
+# return: connection to the worker
+def _connect(port):
+    path=keyPath(port)
+    if(not os.path.exists(path)):
+        # no worker was started yet
+        raise ConnectionRefusedError
+    with open(path,"rb") as f:
+        key=f.read()
+    return Client(("localhost",port),authkey=key)
+
+# Runs the worker: loads the model and answers requests until it is stopped or idle too long
+# port[in]        port on localhost to listen on
+# pathToModel[in] folder of the model
+# idleMinutes[in] the worker stops after this many minutes without a request
+# backend[in]     runtime of the model: "keras", "onnx" or "tflite"
+# threads[in]     number of threads for the prediction, 0 for the default of the runtime
+def serve(port,pathToModel,idleMinutes,backend="keras",threads=0):
+    # only the worker imports tensorflow or the runtime of the exported model
+    import segmentation
+    print("loading segmentation model")
+    segmentation.getModel(pathToModel,backend,threads)
+    # the key is written before the worker listens, so a client that can connect reads the new key
+    authKey=writeAuthKey(port)
+
+    lastRequest=[time.time()]
+    busy=threading.Lock()
+    # stops the worker when it is idle too long. The listener can't be interrupted, so the process is ended
+    def watchIdle():
+        while(True):
+            time.sleep(10)
+            with busy:
+                if(time.time()-lastRequest[0]>idleMinutes*60):
+                    print("segmentation worker idle, stopping")
+                    os._exit(0)
+    threading.Thread(target=watchIdle,daemon=True).start()
+
+    with Listener(("localhost",port),authkey=authKey) as listener:
+        print("segmentation worker listening on port "+str(port))
+        while(True):
+            try:
+                connection=listener.accept()
+            except (AuthenticationError,EOFError,ConnectionResetError):
+                # a process without the key, or a client that gave up
+                continue
+            with connection:
+                try:
+                    request=connection.recv()
+                except (EOFError,ConnectionResetError):
+                    # the client only checked if the worker is running
+                    continue
+                with busy:
+                    if(request[0]=="stop"):
+                        connection.send(("done",None))
+                        break
+                    _,imgInPath,settings=request
+                    if((settings.modelPath,settings.backend,settings.threads)!=(pathToModel,backend,threads)):
+                        # the client starts a new worker with its model
+                        print("request for another model, stopping")
+                        connection.send(("otherModel",None))
+                        break
+                    try:
+                        segmentation.segmentImage(imgInPath,settings)
+                        connection.send(("done",None))
+                    except Exception:
+                        connection.send(("error",traceback.format_exc()))
+                    lastRequest[0]=time.time()
+
+# Starts a worker in the background. It keeps running after this program ends
+# settings[in] segmentationSettings
+def startWorker(settings):
+    print("starting segmentation worker")
+    logPath=os.path.join(tempfile.gettempdir(),"sonarMapperSegmentationWorker.log")
+    command=[sys.executable,os.path.abspath(__file__),str(settings.workerPort),
+             os.path.abspath(settings.modelPath),str(settings.workerIdleMinutes),settings.backend,str(settings.threads)]
+    if(os.name=="posix"):
+        detach={"start_new_session":True}
+    else:
+        detach={"creationflags":subprocess.CREATE_NEW_PROCESS_GROUP|subprocess.DETACHED_PROCESS}
+    with open(logPath,"a") as log:
+        subprocess.Popen(command,stdout=log,stderr=subprocess.STDOUT,stdin=subprocess.DEVNULL,
+                         cwd=os.path.dirname(os.path.abspath(__file__)),**detach)
+
+# Connects to the worker, a worker is started if none is running
+# settings[in] segmentationSettings
+# return: connection to the worker
+def connectWorker(settings):
+    try:
+        return _connect(settings.workerPort)
+    except ConnectionRefusedError:
+        startWorker(settings)
+    # wait until the worker has loaded the model
+    start=time.time()
+    while(True):
+        try:
+            return _connect(settings.workerPort)
+        except (ConnectionRefusedError,ConnectionResetError,EOFError,AuthenticationError):
+            # the worker is still starting or the old worker is just stopping
+            if(time.time()-start>workerStartTimeout):
+                raise RuntimeError("segmentation worker did not start, see "+
+                                   os.path.join(tempfile.gettempdir(),"sonarMapperSegmentationWorker.log"))
+            time.sleep(1)
+
+# Segments the images of a trip in the worker, see segmentation.segmentImage
+# imgInPath[in] path to the location of the CombinedImageNL image
+# settings[in]  segmentationSettings
+def segmentImage(imgInPath,settings=None):
+    if(settings is None):
+        settings=dt.segmentationSettings()
+    print("AI based image segmentation in the worker")
+    request=copy.copy(settings)
+    request.modelPath=os.path.abspath(settings.modelPath)
+    with connectWorker(settings) as connection:
+        connection.send(("segment",os.path.abspath(imgInPath),request))
+        status,message=connection.recv()
+    if(status=="otherModel"):
+        print("the segmentation worker has another model loaded, starting a new one")
+        _waitUntilStopped(settings)
+        with connectWorker(settings) as connection:
+            connection.send(("segment",os.path.abspath(imgInPath),request))
+            status,message=connection.recv()
+    if(status!="done"):
+        raise RuntimeError("segmentation failed in the worker:\n"+message)
+
+# Stops a running worker
+# settings[in] segmentationSettings
+def stopWorker(settings=None):
+    if(settings is None):
+        settings=dt.segmentationSettings()
+    try:
+        with _connect(settings.workerPort) as connection:
+            connection.send(("stop",))
+            connection.recv()
+    except ConnectionRefusedError:
+        return
+    _waitUntilStopped(settings)
+
+# Waits until the worker on the port does not accept connections anymore
+# settings[in] segmentationSettings
+def _waitUntilStopped(settings):
+    start=time.time()
+    while(time.time()-start<workerStartTimeout):
+        try:
+            with _connect(settings.workerPort):
+                pass
+        except (ConnectionRefusedError,ConnectionResetError,EOFError,AuthenticationError):
+            return
+        time.sleep(0.2)
+
+################### Main #####################
+
+# the worker is started with: python segmentationWorker.py port pathToModel idleMinutes backend threads
+if __name__ == "__main__":
+    serve(int(sys.argv[1]),sys.argv[2],float(sys.argv[3]),sys.argv[4],int(sys.argv[5]))
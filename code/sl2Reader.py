@@ -0,0 +1,173 @@
+import mmap
+import os
+import struct
+import functools
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import datatypes as dt
+import segmentStore
+
+##################################################
+# Native reader for Lowrance sl2 files. Replaces the
+# preprocessing with R and the sonaR package.
+# The file is memory mapped, the frame headers are
+# decoded with numpy and the intensities of each
+# channel are written to a segment store.
+# Layout based on sonaR by KennethTM (https://github.com/KennethTM/sonaR)
+##################################################
+
+# size of the header at the beginning of the file
+fileHeaderSize=8
+# size of the header in front of every frame
+frameHeaderSize=144
+# number of pings gathered at once when reading the intensities of a segment
+pingChunk=1024
+
+# meters per foot, the sl2 file stores ranges and depths in feet
+feetToMeter=0.3048
+# meters per second per knot
+knotsToMeterPerSecond=0.514444
+# earth radius used by Lowrance for their mercator coordinates
+lowranceEarthRadius=6356752.3142
+
+# channel numbers used in the sl2 file
+channelNames={0:"Primary",
+              1:"Secondary",
+              2:"Downscan",
+              3:"LeftSidescan",
+              4:"RightSidescan",
+              5:"Sidescan",
+              9:"3D"}
+
+# layout of one frame header
+frameHeaderDtype=np.dtype({
+    'names':['frameSize','channel','packetSize','frameIndex','upperLimit','lowerLimit',
+             'frequency','waterDepth','keelDepth','gpsSpeed','temperature','xLowrance',
+             'yLowrance','waterSpeed','course','altitude','heading','flags','time'],
+    'formats':['<u2','<u2','<u2','<u4','<f4','<f4',
+               'u1','<f4','<f4','<f4','<f4','<i4',
+               '<i4','<f4','<f4','<f4','<f4','<u2','<u4'],
+    'offsets':[28,32,34,36,40,44,
+               50,64,68,100,104,108,
+               112,116,120,124,128,132,140],
+    'itemsize':frameHeaderSize})
+
+# Opens a sl2 file and decodes all frame headers
+# input:
+# pathToSl2 path to the sl2 file
+# return: raw bytes of the file as numpy array (memory mapped), frame positions, frame headers
+def readSl2(pathToSl2):
+    print("read sl2 file "+pathToSl2)
+    with open(pathToSl2,"rb") as f:
+        mm=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    raw=np.frombuffer(mm,dtype=np.uint8)
+    fileSize=len(raw)
+
+    # the frames have different sizes, therefore the start of each frame has to be
+    # found by walking from one frame to the next
+    framePositions=[]
+    pos=fileHeaderSize
+    while(pos+frameHeaderSize<=fileSize):
+        frameSize,=struct.unpack_from("<H",mm,pos+28)
+        packetSize,=struct.unpack_from("<H",mm,pos+34)
+        if(frameSize==0 or pos+frameHeaderSize+packetSize>fileSize):
+            # end of the file or a truncated last frame
+            break
+        framePositions.append(pos)
+        pos=pos+frameSize
+    framePositions=np.array(framePositions,dtype=np.int64)
+
+    # gather all headers into one array and interpret it with the header layout
+    headerBytes=raw[framePositions[:,None]+np.arange(frameHeaderSize)]
+    headers=headerBytes.view(frameHeaderDtype).ravel()
+    print("found "+str(len(headers))+" frames")
+    return raw, framePositions, headers
+
+# Reads the intensities of a list of pings
+# raw[in]         raw bytes of the sl2 file
+# pingOffsets[in] position of the frames of the pings
+# packetSize[in]  number of samples per ping
+# return: numpy array with packetSize rows and one column per ping
+def readPings(raw,pingOffsets,packetSize):
+    data=np.empty((packetSize,len(pingOffsets)),np.uint8)
+    samples=np.arange(packetSize)[:,None]
+    # gather the pings in chunks, an index array for all pings would be 8 times the data
+    for start in range(0,len(pingOffsets),pingChunk):
+        offsets=pingOffsets[start:start+pingChunk]+frameHeaderSize
+        data[:,start:start+len(offsets)]=raw[offsets[None,:]+samples]
+    return data
+
+# Splits one channel into zoom segments. A new segment starts whenever the range
+# or the number of samples of the ping changes
+# raw[in]            raw bytes of the sl2 file
+# framePositions[in] position of all frames
+# headers[in]        all frame headers
+# channel[in]        name of the channel (Primary, Secondary, Downscan, Sidescan)
+# return: list of segmentData, the data of each segment is read on demand
+def getChannelSegments(raw,framePositions,headers,channel):
+    channelNumber=[nr for nr,name in channelNames.items() if name==channel][0]
+    selection=np.flatnonzero(headers['channel']==channelNumber)
+    segments=[]
+    if(len(selection)==0):
+        return segments
+    channelHeaders=headers[selection]
+    channelPositions=framePositions[selection]
+
+    changed=((np.diff(channelHeaders['upperLimit'])!=0) |
+             (np.diff(channelHeaders['lowerLimit'])!=0) |
+             (np.diff(channelHeaders['packetSize'])!=0))
+    starts=np.concatenate(([0],np.flatnonzero(changed)+1))
+    ends=np.concatenate((starts[1:],[len(channelHeaders)]))
+
+    for nr,(start,end) in enumerate(zip(starts,ends)):
+        segment=dt.segmentData()
+        segment.properties.name=str(nr)
+        segment.properties.frames=int(end-start)
+        segment.properties.pixelY=int(channelHeaders['packetSize'][start])
+        segment.properties.minRange=float(channelHeaders['upperLimit'][start])*feetToMeter
+        segment.properties.maxRange=float(channelHeaders['lowerLimit'][start])*feetToMeter
+        segment.properties.startIndex=int(start)
+        segment.loader=functools.partial(readPings,raw,channelPositions[start:end],segment.properties.pixelY)
+        segments.append(segment)
+    return segments
+
+# Writes the meta information of all frames in the same format as the R preprocessing
+# headers[in]  all frame headers
+# metaPath[in] path of the csv file to write
+def writeMetaInformation(headers,metaPath):
+    lon=headers['xLowrance']/lowranceEarthRadius*(180/np.pi)
+    lat=(2*np.arctan(np.exp(headers['yLowrance']/lowranceEarthRadius))-np.pi/2)*(180/np.pi)
+    meta=pd.DataFrame({
+        'SurveyTypeLabel':[channelNames.get(int(c),"Other") for c in headers['channel']],
+        'Latitude':lat,
+        'Longitude':lon,
+        'XLowrance':headers['xLowrance'],
+        'YLowrance':headers['yLowrance'],
+        'MinRange':headers['upperLimit']*feetToMeter,
+        'MaxRange':headers['lowerLimit']*feetToMeter,
+        'WaterDepth':headers['waterDepth']*feetToMeter,
+        'WaterTemperature':headers['temperature'],
+        'GNSSAltitude':headers['altitude']*feetToMeter,
+        'GNSSSpeed':headers['gpsSpeed']*knotsToMeterPerSecond,
+        'GNSSHeading':headers['course']})
+    meta.to_csv(metaPath)
+
+# Reads a sl2 file and prepares everything that is needed for the processing
+# The meta information is written to sl.csv in the trip folder and every channel
+# to its own segment store (for example Downscan.seg, see segmentStore)
+# pathToSl2[in]        path to the sl2 file
+# pathToTripFolder[in] folder where the results of this file are stored
+# channels[in]         list of channel names that should be extracted
+def preprocessFile(pathToSl2,pathToTripFolder,channels):
+    if(not os.path.exists(pathToSl2)):
+        raise FileNotFoundError("sl2 file not found: "+pathToSl2)
+    Path(pathToTripFolder).mkdir(parents=True, exist_ok=True)
+    raw, framePositions, headers=readSl2(pathToSl2)
+    writeMetaInformation(headers,pathToTripFolder+"/sl.csv")
+    for channel in channels:
+        segments=getChannelSegments(raw,framePositions,headers,channel)
+        print(channel+": "+str(len(segments))+" segments")
+        if(len(segments)>0):
+            segmentStore.writeStore(segmentStore.storePath(pathToTripFolder+"/"+channel),segments)
@@ -3,6 +3,8 @@
 import datatypes as dt
 import georef
 import assembleImages
+import sl2Reader
+import segmentStore
 import utilities as utils
 from pathlib import Path
 import sys
@@ -15,119 +17,172 @@ pathToR='"C:/Program Files/R/R-4.0.2/bin/x64/Rscript.exe"'
 
 
     
-################### Main #####################
-    
-# get path from command line argument
-pathToConfig=sys.argv[1]
-# set path in source code
-#pathToConfig="PATH/config.ini"  #if you want to run it from the editor you can set the path to the config here
-
-selection,coord= dt.readConfig(pathToConfig)
-
-#callR
-if(selection.callR):
-    print("start preprocessing")
-    python_file_path = Path(__file__).parent.resolve()
-    path_to_r_script = os.path.join(python_file_path,"sonaR.R")
-    os.system(pathToR+" "+path_to_r_script+" "+pathToConfig)
-
-for file in selection.files:
-    print("######################################")
-    print("######################################")
-    print("processing file "+file)
-    print("######################################")
-    print("######################################")
-    
-    pathToTripFolder=selection.basepath+"/"+file
-
-    pathToDown=pathToTripFolder+"/Downscan"
-    pathToDownIm=pathToTripFolder+"/downImages"
-        
-    pathToSide=pathToTripFolder+"/Sidescan"
-    pathToSideIm=pathToTripFolder+"/sideImages"
-        
-    pathToPrim=pathToTripFolder+"/Primary"
-    pathToPrimIm=pathToTripFolder+"/primImages"
-        
-    pathToSecond=pathToTripFolder+"/Secondary"
-    pathToSecondIm=pathToTripFolder+"/downSecond"
-        
-    metaPath=pathToTripFolder+"/sl.csv"
-    if(selection.coordCorr):
-        utils.fixPosition(metaPath,2)
-        metaPath=pathToTripFolder+"/slEdited.csv"
-
-    if(selection.side):
-        print("####### process sideScan #######")
-        utils.check_if_scan_exsists(pathToSide, "")
-        Path(pathToSideIm).mkdir(parents=True, exist_ok=True)
-        img, prop=assembleImages.processOneView(pathToSide,pathToSideIm,side=True,cmap=selection.cmapSide,cutOffDept=1000)
-        assembleImages.printLegendAndSave(img,prop,pathToSide,side=True,legend=True, filename="SidescanfinalImage")
-    
-    if(selection.down):
-        print("####### process downScan #######")
-        utils.check_if_scan_exsists(pathToDown, "")
-        Path(pathToDownIm).mkdir(parents=True, exist_ok=True)
-        img, prop=assembleImages.processOneView(pathToDown,pathToDownIm,side=False,cmap=selection.cmapDown,cutOffDept=selection.cutOffDept)
-        assembleImages.printLegendAndSave(img,prop,pathToDown,side=False,legend=True, filename="DownscanfinalImage")
-    
-    if(selection.prime):
-        print("####### process primeScan #######")
-        utils.check_if_scan_exsists(pathToPrim, "")
-        Path(pathToPrimIm).mkdir(parents=True, exist_ok=True)
-        img, prop=assembleImages.processOneView(pathToPrim,pathToPrimIm,side=False,cmap=selection.cmapPrime,cutOffDept=selection.cutOffDept)
-        assembleImages.printLegendAndSave(img,prop,pathToPrim,side=False,legend=True, filename="PrimaryfinalImage")
-
-    if(selection.combinedDownPrime or selection.segmentation):
-        utils.check_if_scan_exsists(pathToPrim, "####### combinedDownAndPrimeView selected in config. This requires both downScan and primary to be processed. ") and utils.check_if_scan_exsists(pathToDown, "####### combinedDownAndPrimeView selected in config. This requires both downScan and primary to be processed. ")
-        # get the minimal dept between Down and prime image
-        minDepth= assembleImages.getSmallerDepth(pathToDown,pathToPrim)
-        minDepth=min(minDepth,selection.cutOffDept)
-        #process the prime image again, but this time with a the colour stype of Down to keep it comparable
-        pathToPrimeMono=pathToTripFolder+"/PrimaryMonochrome"
-        Path(pathToPrimeMono).mkdir(parents=True, exist_ok=True)
-        primeImg,_ =assembleImages.processOneView(pathToPrim,pathToPrimeMono,side=False,cmap=selection.cmapDown,cutOffDept=minDepth)
-        # process down
-        Path(pathToDownIm).mkdir(parents=True, exist_ok=True)
-        downImg, prop=assembleImages.processOneView(pathToDown,pathToDownIm,side=False,cmap=selection.cmapDown,cutOffDept=minDepth)
-        #combine images
-        combinedImg= utils.combineImages(downImg,primeImg)
-        if (selection.combinedDownPrime):
-            # if just the combined image is requested save it with a legend
-            assembleImages.printLegendAndSave(utils.openCvToPilImage(combinedImg),prop,pathToPrim,side=False,legend=True,filename="CombinedImage")
-        if (selection.segmentation):
-            # if ai based image segmentation should be applied the base is the combined image without a legend (NL=no legend)
-            assembleImages.printLegendAndSave(utils.openCvToPilImage(combinedImg),prop,pathToPrim,side=False,legend=False,filename="CombinedImage", pathToMeta=metaPath, rmUnderground=True)
-        
-    if(selection.second):
-        print("####### process secondScan #######")
-        utils.check_if_scan_exsists(pathToSecond, "")
-        Path(pathToSecondIm).mkdir(parents=True, exist_ok=True)
-        img, prop=assembleImages.processOneView(pathToSecond,pathToSecondIm,side=False,cmap=selection.cmapPrime)
-        assembleImages.printLegendAndSave(img,prop,pathToSecond,side=False,legend=True, filename="SecondaryfinalImage")
-        
-    if(selection.georef):
-        #if necesary produce side view
-        Path(pathToSideIm).mkdir(parents=True, exist_ok=True)
-        assembleImages.processOneView(pathToSide,pathToSideIm,side=True,cmap=selection.cmapSide,cutOffDept=1000)
-        # produce mosaic
-        georef.mosaic(coord,pathToSide,pathToSideIm,metaPath,cmap=selection.cmapSide)
-        
-    if(selection.track):
-        utils.plotTrackWithDept(metaPath)
-
-    if(selection.segmentation):
-        # apply ai based image segmentation
-        # !!! This part needs additional libaries like for example tensorflow !!!
-        # !!! Read in the readme under ai based image segmentation what you need to install !!!
-        from segmentation import segmentImage
-        segmentImage(os.path.dirname(pathToPrim))
-
-
-
-print("####### done #######")
-
-
-
+# Runs the whole processing for all files in the config
+# pathToConfig[in] path to the config file
+def main(pathToConfig):
+    selection,coord= dt.readConfig(pathToConfig)
+
+    #callR
+    if(selection.callR and selection.reader=="R"):
+        print("start preprocessing")
+        python_file_path = Path(__file__).parent.resolve()
+        path_to_r_script = os.path.join(python_file_path,"sonaR.R")
+        os.system(pathToR+" "+path_to_r_script+" "+pathToConfig)
+
+    # side scan of all files for the merged mosaic
+    mergeTrips=[]
+    for file, sl2File in zip(selection.files, selection.sl2Files):
+        print("######################################")
+        print("######################################")
+        print("processing file "+file)
+        print("######################################")
+        print("######################################")
+
+        pathToTripFolder=selection.basepath+"/"+file
+
+        pathToDown=pathToTripFolder+"/Downscan"
+        pathToDownIm=pathToTripFolder+"/downImages"
+
+        pathToSide=pathToTripFolder+"/Sidescan"
+        pathToSideIm=pathToTripFolder+"/sideImages"
+
+        pathToPrim=pathToTripFolder+"/Primary"
+        pathToPrimIm=pathToTripFolder+"/primImages"
+
+        pathToSecond=pathToTripFolder+"/Secondary"
+        pathToSecondIm=pathToTripFolder+"/downSecond"
+
+        channels=["Primary","Secondary","Downscan","Sidescan"]
+        if(selection.callR and selection.reader=="python"):
+            # read the sl2 file directly and write the segment stores
+            print("start preprocessing")
+            sl2Reader.preprocessFile(selection.basepath+"/"+sl2File,pathToTripFolder,channels)
+        else:
+            # convert the image csv files of the R preprocessing to segment stores
+            for channel in channels:
+                segmentStore.importCsvFolder(pathToTripFolder+"/"+channel,overwrite=selection.callR)
+
+        metaPath=pathToTripFolder+"/sl.csv"
+        if(selection.coordCorr):
+            utils.fixPosition(metaPath,2)
+            metaPath=pathToTripFolder+"/slEdited.csv"
+
+        combined=selection.combinedDownPrime or selection.segmentation
+        # plan which channels are needed with which colour map, so rendered channels are
+        # shared between the views and released after their last use
+        plan=assembleImages.viewPlan(selection.render)
+        if(selection.side):
+            plan.require(pathToSide,selection.cmapSide)
+        if(selection.down):
+            plan.require(pathToDown,selection.cmapDown)
+        if(selection.prime):
+            plan.require(pathToPrim,selection.cmapPrime)
+        if(combined):
+            plan.require(pathToPrim,selection.cmapDown)
+            plan.require(pathToDown,selection.cmapDown)
+        if(selection.second):
+            plan.require(pathToSecond,selection.cmapPrime)
+        if(selection.georef and not coord.mergeTrips):
+            plan.require(pathToSide,selection.cmapSide)
+
+        if(selection.side):
+            print("####### process sideScan #######")
+            utils.check_if_scan_exsists(segmentStore.storePath(pathToSide), "")
+            Path(pathToSideIm).mkdir(parents=True, exist_ok=True)
+            sideView=assembleImages.savedView(pathToSide,pathToSideIm,side=True,cmap=selection.cmapSide,cutOffDept=1000,filename="SidescanfinalImage",settings=selection.render)
+            assembleImages.renderViews([sideView],selection.render,plan)
+
+        # the mosaic directly follows the side scan image, so the side scan the plan keeps for it is released early
+        if(selection.georef):
+            Path(pathToSideIm).mkdir(parents=True, exist_ok=True)
+            if(coord.mergeTrips):
+                # the mosaic of all files is produced after the last file
+                mergeTrips.append((pathToSide,pathToSideIm,metaPath))
+            else:
+                # produce mosaic
+                georef.mosaic(coord,pathToSide,pathToSideIm,metaPath,cmap=selection.cmapSide,settings=selection.render,plan=plan)
+
+        # the down scan, the primary and the combined view are rendered together, so a channel that
+        # several of them need with the same colour map is rendered only once
+        views=[]
+        if(selection.down):
+            print("####### process downScan #######")
+            utils.check_if_scan_exsists(segmentStore.storePath(pathToDown), "")
+            Path(pathToDownIm).mkdir(parents=True, exist_ok=True)
+            views.append(assembleImages.savedView(pathToDown,pathToDownIm,side=False,cmap=selection.cmapDown,cutOffDept=selection.cutOffDept,filename="DownscanfinalImage",settings=selection.render))
+
+        if(selection.prime):
+            print("####### process primeScan #######")
+            utils.check_if_scan_exsists(segmentStore.storePath(pathToPrim), "")
+            Path(pathToPrimIm).mkdir(parents=True, exist_ok=True)
+            views.append(assembleImages.savedView(pathToPrim,pathToPrimIm,side=False,cmap=selection.cmapPrime,cutOffDept=selection.cutOffDept,filename="PrimaryfinalImage",settings=selection.render))
+
+        if(combined):
+            utils.check_if_scan_exsists(segmentStore.storePath(pathToPrim), "####### combinedDownAndPrimeView selected in config. This requires both downScan and primary to be processed. ") and utils.check_if_scan_exsists(segmentStore.storePath(pathToDown), "####### combinedDownAndPrimeView selected in config. This requires both downScan and primary to be processed. ")
+            # get the minimal dept between Down and prime image
+            minDepth= assembleImages.getSmallerDepth(pathToDown,pathToPrim)
+            minDepth=min(minDepth,selection.cutOffDept)
+            #process the prime image again, but this time with a the colour stype of Down to keep it comparable
+            pathToPrimeMono=pathToTripFolder+"/PrimaryMonochrome"
+            Path(pathToPrimeMono).mkdir(parents=True, exist_ok=True)
+            primeMonoView=assembleImages.scaledView(pathToPrim,pathToPrimeMono,side=False,cmap=selection.cmapDown,cutOffDept=minDepth)
+            # process down
+            Path(pathToDownIm).mkdir(parents=True, exist_ok=True)
+            downCutView=assembleImages.scaledView(pathToDown,pathToDownIm,side=False,cmap=selection.cmapDown,cutOffDept=minDepth)
+            views+=[primeMonoView,downCutView]
+
+        assembleImages.renderViews(views,selection.render,plan)
+
+        if(combined):
+            #combine images
+            combinedImg= utils.combineImages(downCutView.image,primeMonoView.image)
+            prop=downCutView.assembleProp
+            if (selection.combinedDownPrime):
+                # if just the combined image is requested save it with a legend
+                assembleImages.printLegendAndSave(utils.openCvToPilImage(combinedImg),prop,pathToPrim,side=False,legend=True,filename="CombinedImage")
+            if (selection.segmentation):
+                # if ai based image segmentation should be applied the base is the combined image without a legend (NL=no legend)
+                assembleImages.printLegendAndSave(utils.openCvToPilImage(combinedImg),prop,pathToPrim,side=False,legend=False,filename="CombinedImage", pathToMeta=metaPath, rmUnderground=True)
+
+        if(selection.second):
+            print("####### process secondScan #######")
+            utils.check_if_scan_exsists(segmentStore.storePath(pathToSecond), "")
+            Path(pathToSecondIm).mkdir(parents=True, exist_ok=True)
+            secondView=assembleImages.savedView(pathToSecond,pathToSecondIm,side=False,cmap=selection.cmapPrime,cutOffDept=selection.cutOffDept,filename="SecondaryfinalImage",settings=selection.render)
+            assembleImages.renderViews([secondView],selection.render,plan)
+
+        # all views of the trip are rendered, stop the worker processes of the plan
+        plan.close()
+
+        if(selection.track):
+            utils.plotTrackWithDept(metaPath)
+
+        if(selection.segmentation):
+            # apply ai based image segmentation
+            # !!! This part needs additional libaries like for example tensorflow !!!
+            # !!! Read in the readme under ai based image segmentation what you need to install !!!
+            if(selection.ai.useWorker):
+                # the worker process keeps the model loaded for the next trips and runs
+                from segmentationWorker import segmentImage
+            else:
+                from segmentation import segmentImage
+            segmentImage(os.path.dirname(pathToPrim),selection.ai)
+
+
+
+    if(len(mergeTrips)>0):
+        georef.mergedMosaic(coord,mergeTrips,selection.basepath+"/MergedMosaic.tif",cmap=selection.cmapSide,settings=selection.render)
+
+    print("####### done #######")
 
 
+################### Main #####################
+    
+# the processing is started only when the script is run directly. This is necessary because the
+# worker processes for the parallel rendering import this file again
+if __name__ == "__main__":
+    # get path from command line argument
+    pathToConfig=sys.argv[1]
+    # set path in source code
+    #pathToConfig="PATH/config.ini"  #if you want to run it from the editor you can set the path to the config here
+    main(pathToConfig)
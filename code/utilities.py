@@ -2,15 +2,16 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import os
 import re
-import geopy.distance
 import contextily
 import rasterio
+import rasterio.windows
+from rasterio.enums import Resampling
 import sys
 import errno
 import geopandas as gpd
 from shapely.geometry import Point
 import datatypes as dt
-from pyproj import CRS
+from pyproj import CRS, Geod
 from pyproj.aoi import AreaOfInterest
 from pyproj.database import query_utm_crs_info
 import cv2
@@ -23,26 +24,114 @@ from PIL import Image
 # Date: 2022-08-27
 ##################################################
 
-# Converts a image as png and the coordinate this image covers to a geotif. This is a file with geo information which can be 
-# for example be imported to QGIS
+# size of the internal tiles of the geotif
+geoTifBlockSize=256
+
+# Opens a geotif for the mosaic. This is a file with geo information which can be
+# for example be imported to QGIS. The file is tiled and compressed, so it can be
+# written window by window (see writeGeoTifWindow)
 # input:
-# pathToImage  path to the png image
-# coord        coordinates of the image
-def convertToGeoTif(pathToImage, coord):    
-    dataset = rasterio.open(pathToImage, 'r')
-    bands = [1,2,3]
-    data = dataset.read(bands)
-    transform = rasterio.transform.from_bounds(coord.west, coord.south, coord.east,coord.north, data.shape[1], data.shape[2])
-    crs = {'init': 'epsg:4326'}
-    
-    writePath=os.path.dirname(pathToImage)
-    
-    _, width, height = data.shape
-    with rasterio.open(writePath+"/GeoMosaic.tif", 'w', driver='GTiff',
-                       width=width, height=height,
-                       count=3, dtype=data.dtype, nodata=0,
-                       transform=transform, crs=crs) as dst:
-        dst.write(data, indexes=bands)
+# pathToTif  path of the geotif to write
+# coord      coordinates of the image
+# width      width of the image in pixels
+# height     height of the image in pixels
+# crs        coordinate system of the image, None = WGS84 with the borders of coord
+# transform  position of the image in crs, needed if crs is set
+# return opened rasterio dataset
+def openGeoTif(pathToTif, coord, width, height, crs=None, transform=None):
+    if(crs is None):
+        transform = rasterio.transform.from_bounds(coord.west, coord.south, coord.east, coord.north, width, height)
+        crs = 'EPSG:4326'
+    return rasterio.open(pathToTif, 'w', driver='GTiff',
+                         width=width, height=height,
+                         count=3, dtype='uint8', nodata=0,
+                         transform=transform, crs=crs,
+                         tiled=True, blockxsize=geoTifBlockSize, blockysize=geoTifBlockSize,
+                         compress='deflate', BIGTIFF='IF_SAFER')
+
+# Opens an existing geotif of a mosaic to replace parts of it (see writeGeoTifWindow)
+# input:
+# pathToTif  path of the geotif
+# return opened rasterio dataset
+def updateGeoTif(pathToTif):
+    return rasterio.open(pathToTif, 'r+')
+
+# Writes a part of the mosaic to the geotif
+# input:
+# geoTif   geotif opened with openGeoTif
+# cvImage  part of the mosaic with 4 channels, the first row is the southern one
+# col      column of the left side of the part in the geotif
+# row      row of the top (northern) side of the part in the geotif
+def writeGeoTifWindow(geoTif, cvImage, col, row):
+    # flip to north up. The bands are in the same order as in the png written by openCV before
+    data = cvImage[::-1, :, [2, 1, 0]].transpose(2, 0, 1)
+    window = rasterio.windows.Window(col, row, data.shape[2], data.shape[1])
+    geoTif.write(data, window=window)
+
+# Reads a part of the mosaic from the geotif, the inverse of writeGeoTifWindow
+# input:
+# geoTif   geotif opened with updateGeoTif
+# col      column of the left side of the part in the geotif
+# row      row of the top (northern) side of the part in the geotif
+# width    width of the part in pixels
+# height   height of the part in pixels
+# return part of the mosaic with 4 channels, the first row is the southern one
+def readGeoTifWindow(geoTif, col, row, width, height):
+    data = geoTif.read(window=rasterio.windows.Window(col, row, width, height))
+    cvImage = np.zeros((height, width, 4), np.uint8)
+    cvImage[:, :, :3] = data.transpose(1, 2, 0)[::-1, :, [2, 1, 0]]
+    cvImage[:, :, 3] = np.where(cvImage[:, :, :3].any(axis=2), 255, 0)
+    return cvImage
+
+# Adds overviews (reduced resolutions) to the geotif, so it can be displayed fast in
+# for example QGIS. The overviews are only created here, they are filled with updateOverviews
+# input:
+# geoTif  geotif opened with openGeoTif
+def addOverviews(geoTif):
+    factors = []
+    factor = 2
+    while(max(geoTif.width, geoTif.height) / factor >= geoTifBlockSize):
+        factors.append(factor)
+        factor = factor * 2
+    if(len(factors) > 0):
+        geoTif.build_overviews(factors, Resampling.nearest)
+        geoTif.update_tags(ns='rio_overview', resampling='average')
+
+# Updates the overviews of a geotif above the parts that changed. Every overview level is calculated
+# from the level below by averaging 2x2 pixels, pixels without data (0 in all bands) are left out
+# input:
+# pathToTif  path of the geotif with overviews (see addOverviews)
+# windows    changed parts of the geotif (column, row, width, height)
+def updateOverviews(pathToTif, windows):
+    if(len(windows) == 0):
+        return
+    with rasterio.open(pathToTif) as geoTif:
+        numberLevels = len(geoTif.overviews(1))
+    for level in range(numberLevels):
+        # the level below, level -1 is the full resolution
+        below = {} if level == 0 else {'OVERVIEW_LEVEL': level - 1}
+        with rasterio.open(pathToTif, **below) as source, rasterio.open(pathToTif, 'r+', OVERVIEW_LEVEL=level) as target:
+            changed = []
+            for col, row, width, height in windows:
+                # the part of this level above the changed part
+                left = col // 2
+                top = row // 2
+                right = min(-(-(col + width) // 2), target.width)
+                bottom = min(-(-(row + height) // 2), target.height)
+                if(right <= left or bottom <= top):
+                    continue
+                data = source.read(window=rasterio.windows.Window(2 * left, 2 * top, 2 * (right - left), 2 * (bottom - top)),
+                                   boundless=True, fill_value=0).astype(np.uint32)
+                blocks = data.reshape(data.shape[0], bottom - top, 2, right - left, 2)
+                # the same pixels are left out in every band, so dark colours keep their hue
+                valid = blocks.sum(axis=0) > 0
+                total = (blocks * valid).sum(axis=(2, 4))
+                count = valid.sum(axis=(1, 3))
+                reduced = (total + count // 2) // np.maximum(count, 1)
+                reduced = np.where(count > 0, reduced, 0).astype(np.uint8)
+                target.write(reduced, window=rasterio.windows.Window(left, top, right - left, bottom - top))
+                changed.append((left, top, right - left, bottom - top))
+        windows = changed
         
 # Function to plot the track on a map and colour by dept
 # This function will download the map data from OpenStreetMap and therefore needs internet
@@ -92,6 +181,9 @@ def plotTrackWithDept(pathToMeta):
 # This leads to problems when georeferencing it. Therefore it is necessary to stretch them apart
 # This is currently done by simply looking for 2 positions that are a measurable distance apart and assigning 
 # the position in between linearly.
+# Starting at the first position, the next anchor is the position after the first one that is at least
+# distance away from the current anchor (geodesic distance). The positions between two anchors are
+# interpolated by their index.
 # This function will create a corrected meta data file
 # input:
 # filename filepath to meta data
@@ -99,60 +191,57 @@ def plotTrackWithDept(pathToMeta):
 def fixPosition(filename,distance):
     print("fix position")
     outFile=os.path.dirname(filename)+"/slEdited.csv"
-    #print("exists "+str(os.path.exists(outFile)))
     if(not os.path.exists(outFile)):
-        #print("fix file "+str(filename))
         data = pd.read_csv(filename)
-        
-        Lat=data["Latitude"].copy()
-        Lon=data["Longitude"].copy()
-        Type=data["SurveyTypeLabel"]
-        Heading=data["GNSSHeading"]
-    
-        index1=0
-        index2=1
-        maxIndex=len(Lat)
-        
-        tenPercent=maxIndex/10
-        printCounter=0
-        
-        maxReached=False
-        while(maxReached==False):
-            dist=0
-            point1=(Lat[index1],Lon[index1])
-            while(dist<distance and index2<maxIndex):
-                point2=(Lat[index2],Lon[index2])
-                dist=geopy.distance.geodesic(point1, point2).m
-                index2+=1
-            if(index2==maxIndex):
-                index2=maxIndex-1
-                maxReached=True
-            # print("distance "+str(dist))
-            # print("index "+str(index2))
-            
-            startPoint=(Lat[index1],Lon[index1])
-            dindex=index2-index1
-            dlat=(Lat[index2]-Lat[index1])/dindex
-            dlon=(Lon[index2]-Lon[index1])/dindex
-                    
-            for i in range(0,dindex,1):
-                Lat[i+index1]=startPoint[0]+i*dlat
-                Lon[i+index1]=startPoint[1]+i*dlon
-            index1=index2
-            if(index1>printCounter):
-                printCounter=printCounter+tenPercent
-                print(str(int(printCounter/tenPercent)*10)+"%")
-            
-        
-        newData=pd.DataFrame(Type)
-        newData["Latitude"]=Lat
-        newData["Longitude"]=Lon
-        newData["GNSSHeading"]=Heading
+        lat=data["Latitude"].to_numpy(dtype=np.float64)
+        lon=data["Longitude"].to_numpy(dtype=np.float64)
+        anchors=findPositionAnchors(lat,lon,distance)
+        index=np.arange(len(lat))
+
+        newData=pd.DataFrame(data["SurveyTypeLabel"])
+        newData["Latitude"]=np.interp(index,anchors,lat[anchors])
+        newData["Longitude"]=np.interp(index,anchors,lon[anchors])
+        newData["GNSSHeading"]=data["GNSSHeading"]
         newData["WaterDepth"]=data["WaterDepth"]
         
         newData.to_csv(outFile)
         print("end of fix position")
 
+# Searches the anchor positions of fixPosition. The distance along the track is never smaller than
+# the direct distance, so the search for the next anchor starts where the track is distance long
+# (searchsorted) and only the direct distances from there on are calculated
+# lat[in]      latitudes of all positions
+# lon[in]      longitudes of all positions
+# distance[in] minimal distance between 2 anchors in meter
+# return: indices of the anchors, the first and the last position are always anchors
+def findPositionAnchors(lat,lon,distance):
+    numberPositions=len(lat)
+    if(numberPositions<2):
+        return np.arange(numberPositions)
+    geod=Geod(ellps="WGS84")
+    _,_,steps=geod.inv(lon[:-1],lat[:-1],lon[1:],lat[1:])
+    track=np.concatenate(([0],np.cumsum(steps)))
+    anchors=[0]
+    anchor=0
+    while(anchor<numberPositions-1):
+        # the first position that can be far enough away
+        candidate=max(int(np.searchsorted(track,track[anchor]+distance*(1-1e-9))),anchor+1)
+        found=numberPositions
+        block=64
+        while(candidate<numberPositions):
+            end=min(candidate+block,numberPositions)
+            _,_,dist=geod.inv(np.full(end-candidate,lon[anchor]),np.full(end-candidate,lat[anchor]),lon[candidate:end],lat[candidate:end])
+            far=np.flatnonzero(dist>=distance)
+            if(len(far)>0):
+                found=candidate+int(far[0])
+                break
+            candidate=end
+            block*=2
+        # the next anchor is the position after the first one that is far enough away
+        anchor=min(found+1,numberPositions-1)
+        anchors.append(anchor)
+    return np.array(anchors)
+
 # Function to read the meta information
 # input
 # path  path to meta information
@@ -0,0 +1,344 @@
+import os
+import io
+import json
+import math
+import shutil
+import sqlite3
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from affine import Affine
+from PIL import Image
+from pathlib import Path
+
+##################################################
+# Export of a mosaic as slippy map tiles
+# The geotif of the mosaic is warped to web mercator
+# (EPSG:3857) and cut into the tiles of the highest
+# zoom level. The lower zoom levels are built by
+# reducing 2x2 tiles of the level above. The tiles of
+# the highest level are produced in z-order, so the
+# four tiles below a tile are finished one after the
+# other and only a few tiles per level are kept in
+# memory. Tiles without data are not written.
+# The tiles are written as png with transparency
+# either into a folder (z/x/y.png, XYZ) or into one
+# MBTiles file (sqlite).
+# After an update of the mosaic only the tiles above
+# the changed parts are produced again, together with
+# the tiles of the lower zoom levels above them.
+##################################################
+
+tileSize=256
+# half of the size of the world in web mercator in meters
+worldHalf=20037508.342789244
+# number of tiles per side that are warped at once
+blockTiles=8
+
+# Returns the metadata of a tile set
+# name[in]    name of the tile set
+# bounds[in]  west, south, east, north in WGS84
+# return: dictionary with the values as strings, as in MBTiles
+def _metadata(name,bounds,minZoom,maxZoom):
+    return {"name":name,"format":"png","type":"overlay","version":"1",
+            "bounds":",".join(str(value) for value in bounds),
+            "minzoom":str(minZoom),"maxzoom":str(maxZoom)}
+
+# Converts a png tile back to an rgba image
+def _decodeTile(png):
+    return np.array(Image.open(io.BytesIO(png)).convert("RGBA"))
+
+# Writes the tiles into a folder z/x/y.png, the metadata is written to metadata.json
+class xyzWriter:
+    def __init__(self,pathToFolder,name,update=False):
+        # without update the folder is written again completely
+        if(not update and os.path.exists(pathToFolder)):
+            shutil.rmtree(pathToFolder)
+        self.path=pathToFolder
+        self.name=name
+
+    def _tilePath(self,zoom,x,y):
+        return self.path+"/"+str(zoom)+"/"+str(x)+"/"+str(y)+".png"
+
+    def write(self,zoom,x,y,png):
+        Path(os.path.dirname(self._tilePath(zoom,x,y))).mkdir(parents=True, exist_ok=True)
+        with open(self._tilePath(zoom,x,y),"wb") as f:
+            f.write(png)
+
+    # returns the tile as rgba image, None if it doesn't exist
+    def read(self,zoom,x,y):
+        path=self._tilePath(zoom,x,y)
+        if(not os.path.exists(path)):
+            return None
+        with open(path,"rb") as f:
+            return _decodeTile(f.read())
+
+    def delete(self,zoom,x,y):
+        path=self._tilePath(zoom,x,y)
+        if(os.path.exists(path)):
+            os.remove(path)
+
+    # returns the metadata of the existing tiles, None if there are none
+    @staticmethod
+    def readMetadata(pathToFolder):
+        path=pathToFolder+"/metadata.json"
+        if(not os.path.exists(path)):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def close(self,bounds,minZoom,maxZoom):
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        with open(self.path+"/metadata.json","w") as f:
+            json.dump(_metadata(self.name,bounds,minZoom,maxZoom),f)
+
+# Writes the tiles into one MBTiles file. The rows of MBTiles count from the south (TMS)
+class mbtilesWriter:
+    def __init__(self,pathToFile,name,update=False):
+        # without update the file is written again completely
+        if(not update and os.path.exists(pathToFile)):
+            os.remove(pathToFile)
+        self.connection=sqlite3.connect(pathToFile)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        self.name=name
+
+    def write(self,zoom,x,y,png):
+        self.connection.execute("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?)",(zoom,x,(1<<zoom)-1-y,sqlite3.Binary(png)))
+
+    # returns the tile as rgba image, None if it doesn't exist
+    def read(self,zoom,x,y):
+        row=self.connection.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                    (zoom,x,(1<<zoom)-1-y)).fetchone()
+        if(row is None):
+            return None
+        return _decodeTile(row[0])
+
+    def delete(self,zoom,x,y):
+        self.connection.execute("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",(zoom,x,(1<<zoom)-1-y))
+
+    # returns the metadata of the existing file, None if there is none
+    @staticmethod
+    def readMetadata(pathToFile):
+        if(not os.path.exists(pathToFile)):
+            return None
+        connection=sqlite3.connect(pathToFile)
+        try:
+            return dict(connection.execute("SELECT name, value FROM metadata").fetchall())
+        except sqlite3.Error:
+            return None
+        finally:
+            connection.close()
+
+    def close(self,bounds,minZoom,maxZoom):
+        self.connection.execute("DELETE FROM metadata")
+        self.connection.executemany("INSERT INTO metadata VALUES (?,?)",_metadata(self.name,bounds,minZoom,maxZoom).items())
+        self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        self.connection.commit()
+        self.connection.close()
+
+# Returns the size of a tile in meters (web mercator) at a zoom level
+def _tileMeters(zoom):
+    return 2*worldHalf/(1<<zoom)
+
+# Returns the zoom level whose pixels are at least as fine as the pixels of the mosaic
+# pixelSizeMeters[in] size of a pixel of the mosaic on the ground
+# latitude[in]        latitude of the mosaic, web mercator stretches the pixels by 1/cos(latitude)
+def nativeZoom(pixelSizeMeters,latitude):
+    groundPerPixel=2*worldHalf/tileSize*math.cos(math.radians(latitude))
+    return max(0,min(24,math.ceil(math.log2(groundPerPixel/pixelSizeMeters))))
+
+# Returns the range of tiles covering the bounds at a zoom level
+# bounds[in] left, bottom, right, top in web mercator
+# return: first and last column, first and last row
+def _tileRange(bounds,zoom):
+    size=_tileMeters(zoom)
+    last=(1<<zoom)-1
+    x0=min(max(int(math.floor((bounds[0]+worldHalf)/size)),0),last)
+    x1=min(max(int(math.floor((bounds[2]+worldHalf)/size-1e-9)),0),last)
+    y0=min(max(int(math.floor((worldHalf-bounds[3])/size)),0),last)
+    y1=min(max(int(math.floor((worldHalf-bounds[1])/size-1e-9)),0),last)
+    return x0,x1,y0,y1
+
+# Returns the position of a tile in z-order. Tiles with the same parent follow each other
+def _zOrder(x,y):
+    code=0
+    for bit in range(24):
+        code|=((x>>bit)&1)<<(2*bit) | ((y>>bit)&1)<<(2*bit+1)
+    return code
+
+# Converts a tile to png, the alpha channel is 0 where there is no data
+# tile[in] rgba image
+def _encodeTile(tile):
+    buffer=io.BytesIO()
+    Image.fromarray(tile,"RGBA").save(buffer,"PNG")
+    return buffer.getvalue()
+
+# Builds a tile from the four tiles below it. 2x2 pixels are averaged, pixels without data are left out
+# quads[in] tiles below in the order top left, top right, bottom left, bottom right, None if empty
+# return: rgba tile
+def _reduceTiles(quads):
+    full=np.zeros((2*tileSize,2*tileSize,4),np.uint8)
+    for index,quad in enumerate(quads):
+        if(quad is not None):
+            row=(index//2)*tileSize
+            col=(index%2)*tileSize
+            full[row:row+tileSize,col:col+tileSize]=quad
+    blocks=full.reshape(tileSize,2,tileSize,2,4).astype(np.uint32)
+    valid=(blocks[...,3]>0)
+    count=valid.sum(axis=(1,3))
+    total=(blocks[...,:3]*valid[...,None]).sum(axis=(1,3))
+    tile=np.zeros((tileSize,tileSize,4),np.uint8)
+    tile[...,:3]=((total+count[...,None]//2)//np.maximum(count,1)[...,None]).astype(np.uint8)
+    tile[...,3]=np.where(count>0,255,0)
+    return tile
+
+# Collects the tiles of all zoom levels. A tile is built from the tiles below as soon as the
+# next tile of the level belongs to another parent
+class _pyramid:
+    def __init__(self,writer,minZoom):
+        self.writer=writer
+        self.minZoom=minZoom
+        # per zoom level: parent of the collected tiles and the four tiles below it
+        self.children={}
+        self.count=0
+
+    def add(self,zoom,x,y,tile):
+        if(tile[...,3].any()):
+            self.writer.write(zoom,x,y,_encodeTile(tile))
+            self.count+=1
+        if(zoom<=self.minZoom):
+            return
+        parent=(x//2,y//2)
+        if(zoom in self.children and self.children[zoom][0]!=parent):
+            self.flush(zoom)
+        if(zoom not in self.children):
+            self.children[zoom]=(parent,[None]*4)
+        self.children[zoom][1][(y%2)*2+x%2]=tile
+
+    def flush(self,zoom):
+        parent,quads=self.children.pop(zoom)
+        self.add(zoom-1,parent[0],parent[1],_reduceTiles(quads))
+
+    def finish(self,maxZoom):
+        for zoom in range(maxZoom,self.minZoom,-1):
+            if(zoom in self.children):
+                self.flush(zoom)
+
+# Writes a tile that was produced again, it is removed if it has no data anymore
+# return: True if the tile was written
+def _replaceTile(writer,zoom,x,y,tile):
+    if(tile[...,3].any()):
+        writer.write(zoom,x,y,_encodeTile(tile))
+        return True
+    writer.delete(zoom,x,y)
+    return False
+
+# Produces the tiles of the lower zoom levels again above the changed tiles of the highest level.
+# The four tiles below a tile are read back from the writer
+# changed[in] changed tiles (x, y) of the highest zoom level
+# return: number of written tiles
+def _updateParents(writer,changed,minZoom,maxZoom):
+    count=0
+    for zoom in range(maxZoom,minZoom,-1):
+        parents=sorted({(x//2,y//2) for x,y in changed},key=lambda tile: _zOrder(*tile))
+        for x,y in parents:
+            quads=[writer.read(zoom,2*x+dx,2*y+dy) for dy in (0,1) for dx in (0,1)]
+            count+=_replaceTile(writer,zoom-1,x,y,_reduceTiles(quads))
+        changed=parents
+    return count
+
+# Returns the tiles of the highest zoom level above the changed parts of the mosaic
+# source[in]  opened geotif of the mosaic
+# windows[in] changed parts of the geotif (column, row, width, height)
+# tileRange[in] first and last column, first and last row of all tiles, see _tileRange
+# return: set of tiles (x, y)
+def _changedTiles(source,windows,maxZoom,tileRange):
+    x0,x1,y0,y1=tileRange
+    pixel=_tileMeters(maxZoom)/tileSize
+    changed=set()
+    for col,row,width,height in windows:
+        # one pixel of the mosaic and of the tiles more on every side, the bilinear warp reaches into the neighbouring pixels
+        window=rasterio.windows.Window(col-1,row-1,width+2,height+2)
+        left,bottom,right,top=transform_bounds(source.crs,"EPSG:3857",*rasterio.windows.bounds(window,source.transform))
+        tx0,tx1,ty0,ty1=_tileRange((left-pixel,bottom-pixel,right+pixel,top+pixel),maxZoom)
+        changed.update((x,y) for x in range(max(tx0,x0),min(tx1,x1)+1) for y in range(max(ty0,y0),min(ty1,y1)+1))
+    return changed
+
+# Exports a mosaic as slippy map tiles in web mercator
+# pathToTif[in]       path of the geotif of the mosaic
+# tileFormat[in]      "xyz" for a folder with z/x/y.png, "mbtiles" for one MBTiles file
+# pixelSizeMeters[in] size of a pixel of the mosaic, used to find the highest zoom level
+# maxZoom[in]         highest zoom level, 0 = the level that fits the pixel size
+# windows[in]         changed parts of the geotif (column, row, width, height) since the last export,
+#                     only the tiles above them are produced again. None = all tiles
+# return: path of the folder or MBTiles file
+def exportTiles(pathToTif,tileFormat,pixelSizeMeters,maxZoom=0,windows=None):
+    print("####### export web tiles #######")
+    with rasterio.open(pathToTif) as source:
+        bounds=transform_bounds(source.crs,"EPSG:3857",*source.bounds)
+        geoBounds=transform_bounds(source.crs,"EPSG:4326",*source.bounds)
+        if(maxZoom<=0):
+            maxZoom=nativeZoom(pixelSizeMeters,(geoBounds[1]+geoBounds[3])/2)
+        # the lowest zoom level is the first one where the whole mosaic is in one tile
+        minZoom=maxZoom
+        while(minZoom>0):
+            x0,x1,y0,y1=_tileRange(bounds,minZoom)
+            if(x0==x1 and y0==y1):
+                break
+            minZoom-=1
+        print("zoom levels "+str(minZoom)+" to "+str(maxZoom))
+
+        name=os.path.splitext(os.path.basename(pathToTif))[0]
+        if(tileFormat=="mbtiles"):
+            pathToOut=os.path.splitext(pathToTif)[0]+".mbtiles"
+            writerClass=mbtilesWriter
+        else:
+            pathToOut=os.path.splitext(pathToTif)[0]+"_tiles"
+            writerClass=xyzWriter
+        # the existing tiles can only be updated if they cover the same area and zoom levels
+        update=windows is not None and writerClass.readMetadata(pathToOut)==_metadata(name,geoBounds,minZoom,maxZoom)
+        writer=writerClass(pathToOut,name,update)
+
+        # the pixels of the warped mosaic are exactly the pixels of the tiles of the highest level
+        x0,x1,y0,y1=_tileRange(bounds,maxZoom)
+        size=_tileMeters(maxZoom)
+        transform=Affine(size/tileSize,0,x0*size-worldHalf,0,-size/tileSize,worldHalf-y0*size)
+        pyramid=_pyramid(writer,minZoom)
+        # blocks of tiles aligned to blockTiles are continuous in z-order
+        blocks=[(bx,by) for bx in range(x0//blockTiles,x1//blockTiles+1) for by in range(y0//blockTiles,y1//blockTiles+1)]
+        if(update):
+            changed=_changedTiles(source,windows,maxZoom,(x0,x1,y0,y1))
+            blocks=list({(x//blockTiles,y//blockTiles) for x,y in changed})
+            print("web tiles to update: "+str(len(changed)))
+        with WarpedVRT(source,crs="EPSG:3857",transform=transform,width=(x1-x0+1)*tileSize,height=(y1-y0+1)*tileSize,
+                       resampling=Resampling.bilinear) as warped:
+            for bx,by in sorted(blocks,key=lambda block: _zOrder(*block)):
+                tx0=max(bx*blockTiles,x0)
+                tx1=min((bx+1)*blockTiles-1,x1)
+                ty0=max(by*blockTiles,y0)
+                ty1=min((by+1)*blockTiles-1,y1)
+                window=rasterio.windows.Window((tx0-x0)*tileSize,(ty0-y0)*tileSize,(tx1-tx0+1)*tileSize,(ty1-ty0+1)*tileSize)
+                data=warped.read(window=window).transpose(1,2,0)
+                tiles=[(x,y) for x in range(tx0,tx1+1) for y in range(ty0,ty1+1)]
+                if(update):
+                    tiles=[tile for tile in tiles if tile in changed]
+                for x,y in sorted(tiles,key=lambda tile: _zOrder(*tile)):
+                    row=(y-ty0)*tileSize
+                    col=(x-tx0)*tileSize
+                    tile=np.zeros((tileSize,tileSize,4),np.uint8)
+                    tile[...,:3]=data[row:row+tileSize,col:col+tileSize]
+                    tile[...,3]=np.where(tile[...,:3].any(axis=2),255,0)
+                    if(update):
+                        pyramid.count+=_replaceTile(writer,maxZoom,x,y,tile)
+                    else:
+                        pyramid.add(maxZoom,x,y,tile)
+        if(update):
+            pyramid.count+=_updateParents(writer,changed,minZoom,maxZoom)
+        else:
+            pyramid.finish(maxZoom)
+        writer.close(geoBounds,minZoom,maxZoom)
+    print(("updated " if update else "saved ")+str(pyramid.count)+" web tiles "+pathToOut)
+    return pathToOut